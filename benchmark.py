@@ -0,0 +1,316 @@
+import sys, argparse, json, os, runpy, shutil, statistics, subprocess, tempfile, time
+from sys import path
+Folder = os.path.dirname(os.path.abspath(__file__))
+path.append(os.path.join(Folder, 'helper'))
+from concurrent.futures import ThreadPoolExecutor
+from aws.account import ConfigureAccounts
+from aws.fake import InstallFake
+from aws.registry import GetResourceRegion
+from aws.tag import UpdateTags
+from services.services import GetServices
+from services.synthetic import SyntheticCur
+
+### resource usage is only available on unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#################################################
+#                                               #
+#            DEFINE VARIABLES                   #
+#                                               #
+#################################################
+
+UpdateTagsFileName = os.path.join(Folder, 'update-tags.py')
+TagColumns = {'Channel': 'tag_channel', 'Capability': 'tag_capability'}
+
+### update-tags.py options of each case; api calls AwsTag directly once per resource
+Cases = {
+    'sequential': ['--workers', '1', '--ec2-batch-size', '0', '--no-prefetch', '--no-s3-merge', '--no-dedup',
+                   '--no-cache', '--no-read-batch'],
+    'default': [],
+    'workers': ['--workers', '16'],
+    'tagging-api': ['--workers', '16', '--backend', 'tagging-api'],
+    'plan': ['plan', '--workers', '16'],
+    'discover': ['discover', '--workers', '16'],
+    'api': None
+}
+
+### run in a fresh interpreter per start: import the tagging api, optionally prewarm ec2, then tag one instance;
+### requests are answered locally, so the times are those of importing botocore, loading models and signing
+StartupProbe = '''import json, sys, time
+Started = time.perf_counter()
+sys.path.append(sys.argv[1])
+from aws.tag import UpdateTags
+Imported = time.perf_counter()
+from aws.client import RegisterClientHook, Prewarm
+from aws.fake import AnswerLocally
+RegisterClientHook(AnswerLocally)
+if sys.argv[2] == 'prewarm':
+    Prewarm(['ec2'], 'us-east-1')
+Warmed = time.perf_counter()
+assert UpdateTags('ec2', 'i-0123456789abcdef0', {'Channel': 'web'}, 'us-east-1')
+Called = time.perf_counter()
+print(json.dumps({'import_ms': (Imported - Started) * 1000, 'prewarm_ms': (Warmed - Imported) * 1000,
+                  'first_call_ms': (Called - Warmed) * 1000, 'total_ms': (Called - Started) * 1000}))
+'''
+StartupCases = ['cold', 'prewarm']
+
+#################################################
+#                                               #
+#            DEFINE FUNCTIONS                   #
+#                                               #
+#################################################
+
+def GetReport(Spec):
+    """Return the synthetic report of a benchmark spec"""
+
+    return SyntheticCur(Spec['rows'], TagColumns=list(TagColumns.values()), Seed=Spec['seed'],
+                        Regions=Spec.get('regions'), Accounts=GetAccountIds(Spec))
+
+def GetAccountIds(Spec):
+    """Return the account ids of a benchmark spec; the first one holds the base credentials"""
+
+    return ['%012d' % (123456789012 + Number) for Number in range(Spec.get('accounts', 1))]
+
+def GetResourceTags(Report):
+    """Return list of (service, resource id, tags dictionary, region, account) of the resources of a report with
+    known tags"""
+
+    Services = GetServices()
+    Resources = []
+    for CsvName, ResourceId, Values, Region, Account in Report.GetResources():
+        Tags = {AwsTagName: Values[CsvTagName] for AwsTagName, CsvTagName in TagColumns.items() \
+                if Values[CsvTagName] != 'Unknown'}
+        if Tags:
+            Resources.append((Services[CsvName], ResourceId, Tags,
+                              GetResourceRegion(Services[CsvName], ResourceId, Region), Account))
+
+    return Resources
+
+def GetMaxRss():
+    """Return peak resident memory of this process in MB, or None"""
+
+    if resource is None:
+        return None
+
+    MaxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return MaxRss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def RunChild(Spec):
+    """Run one case in this process against a fake backend and write result.json to the current folder"""
+
+    Fake = InstallFake(Latency=Spec['latency'], Jitter=Spec['jitter'], Rate=Spec['fake_rate'],
+                       ThrottleRate=Spec['throttle_rate'], ErrorRate=Spec['error_rate'], Seed=Spec['seed'],
+                       Account=GetAccountIds(Spec)[0])
+    Resources = GetResourceTags(GetReport(Spec))
+    for Service, ResourceId, Tags, Region, Account in Resources[:int(len(Resources) * Spec['pretagged'])]:
+        Fake.Put(Service, ResourceId, Tags, Region)
+    ### discover lists every resource, so those without tags have to exist as well
+    if Spec['case'] == 'discover':
+        for Service, ResourceId, Tags, Region, Account in Resources[int(len(Resources) * Spec['pretagged']):]:
+            Fake.Put(Service, ResourceId, {}, Region)
+    Linked = Spec.get('accounts', 1) > 1
+
+    Started = time.perf_counter()
+    if Spec['case'] == 'api':
+        if Linked:
+            ConfigureAccounts()
+        with ThreadPoolExecutor(Spec['workers']) as Pool:
+            list(Pool.map(lambda Resource: UpdateTags(*Resource[:4], Account=Resource[4]), Resources))
+        Rows = len(Resources)
+    else:
+        sys.argv = [UpdateTagsFileName, '--input', Spec['input']] + Cases[Spec['case']]
+        for AwsTagName, CsvTagName in TagColumns.items():
+            sys.argv += ['--tag', AwsTagName + '=' + CsvTagName]
+        for Region in Spec.get('regions') or []:
+            sys.argv += ['--region', Region]
+        if Linked:
+            sys.argv += ['--assume-role']
+        try:
+            runpy.run_path(UpdateTagsFileName, run_name='__main__')
+        except SystemExit:
+            pass
+        Rows = len(Resources) if Spec['case'] == 'discover' else Spec['rows']
+    Seconds = time.perf_counter() - Started
+
+    Calls = Fake.GetCalls()
+    with open('result.json', 'w') as f:
+        json.dump({'case': Spec['case'], 'rows': Rows, 'seconds': Seconds, 'calls': sum(Calls.values()),
+                   'methods': {Service + '.' + Method: Count for (Service, Method), Count in sorted(Calls.items())},
+                   'max_rss_mb': GetMaxRss()}, f)
+
+def RunCase(Spec, WorkDir):
+    """Run one case in a child process so its memory and module state are its own; return its result or None"""
+
+    CaseDir = tempfile.mkdtemp(prefix=Spec['case'] + '-', dir=WorkDir)
+    with open(os.path.join(CaseDir, 'output.log'), 'w') as Output:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(Spec)], cwd=CaseDir,
+                       stdout=Output, stderr=subprocess.STDOUT)
+
+    try:
+        with open(os.path.join(CaseDir, 'result.json'), 'r') as f:
+            return json.load(f)
+    except Exception:
+        print('Case ' + Spec['case'] + ' failed, see ' + os.path.join(CaseDir, 'output.log'))
+        return None
+
+def RunStartup(Case, Runs):
+    """Start a fresh interpreter Runs times for a startup case and return the median times, or None"""
+
+    ### dummy credentials and no config files, so nothing on this machine changes what botocore loads
+    Env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark', \
+               AWS_CONFIG_FILE=os.devnull, AWS_SHARED_CREDENTIALS_FILE=os.devnull, AWS_EC2_METADATA_DISABLED='true')
+    for Name in ('AWS_PROFILE', 'AWS_SESSION_TOKEN'):
+        Env.pop(Name, None)
+
+    Times = []
+    for Run in range(Runs):
+        Child = subprocess.run([sys.executable, '-c', StartupProbe, os.path.join(Folder, 'helper'), Case], env=Env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if Child.returncode != 0:
+            print('Case startup-' + Case + ' failed: ' + Child.stdout.strip().splitlines()[-1])
+            return None
+        Times.append(json.loads(Child.stdout))
+
+    Result = {'case': 'startup-' + Case, 'runs': Runs}
+    for Name in Times[0]:
+        Result[Name] = statistics.median(Time[Name] for Time in Times)
+
+    return Result
+
+def FormatStartup(Result):
+    """Return the summary line of a startup result"""
+
+    return 'Bench: Case=' + Result['case'] + ' Runs=' + str(Result['runs']) + ' Import=' \
+           + '%.0f' % Result['import_ms'] + 'ms Prewarm=' + '%.0f' % Result['prewarm_ms'] + 'ms FirstCall=' \
+           + '%.0f' % Result['first_call_ms'] + 'ms Total=' + '%.0f' % Result['total_ms'] + 'ms'
+
+def FormatResult(Result):
+    """Return the summary line of a result"""
+
+    Rate = Result['rows'] / Result['seconds'] if Result['seconds'] else 0
+
+    return 'Bench: Case=' + Result['case'] + ' Rows=' + str(Result['rows']) + ' Seconds=' \
+           + '%.2f' % Result['seconds'] + ' Rows/s=' + '%.0f' % Rate + ' Calls=' + str(Result['calls']) \
+           + ' Calls/Row=' + '%.4f' % (Result['calls'] / max(1, Result['rows'])) + ' MaxRss=' \
+           + ('%.0f' % Result['max_rss_mb'] + 'MB' if Result['max_rss_mb'] is not None else 'unknown')
+
+def GetRegressions(Results, Baseline, Tolerance):
+    """Return lines of results slower or making more calls per row than the baseline by more than Tolerance"""
+
+    Before = {(Result['case'], Result.get('rows')): Result for Result in Baseline}
+    Regressions = []
+    for Result in Results:
+        Old = Before.get((Result['case'], Result.get('rows')))
+        if Old is None:
+            continue
+        if 'total_ms' in Result:
+            if Result['total_ms'] > Old['total_ms'] * (1 + Tolerance):
+                Regressions.append('Regression: Case=' + Result['case'] + ' Total=' + '%.0f' % Result['total_ms'] \
+                                   + 'ms Baseline=' + '%.0f' % Old['total_ms'] + 'ms')
+            continue
+        Rate, OldRate = Result['rows'] / Result['seconds'], Old['rows'] / Old['seconds']
+        if Rate < OldRate * (1 - Tolerance):
+            Regressions.append('Regression: Case=' + Result['case'] + ' Rows=' + str(Result['rows']) \
+                               + ' Rows/s=' + '%.0f' % Rate + ' Baseline=' + '%.0f' % OldRate)
+        if Result['calls'] > Old['calls'] * (1 + Tolerance):
+            Regressions.append('Regression: Case=' + Result['case'] + ' Rows=' + str(Result['rows']) \
+                               + ' Calls=' + str(Result['calls']) + ' Baseline=' + str(Old['calls']))
+
+    return Regressions
+
+#################################################
+#                                               #
+#            PROGRAM ENTRY                      #
+#                                               #
+#################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure rows/s, API calls per row and memory of update-tags.py \
+                                     and the AwsTag API against an in-memory fake of the AWS tagging apis')
+    parser.add_argument('--rows', type=int, action='append', default=[], help='line items of the synthetic \
+                        report; can be repeated, i.e. --rows 1000 --rows 1000000; default is 10000')
+    parser.add_argument('--case', action='append', default=[], choices=list(Cases), help='case to run; can be \
+                        repeated; default is every case')
+    parser.add_argument('--format', choices=['csv', 'csv.gz', 'parquet'], default='csv.gz', help='format of the \
+                        synthetic report; default is csv.gz')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every fake call takes; default is 0.02')
+    parser.add_argument('--jitter', type=float, default=0.01, help='up to this many seconds are added to each \
+                        call; default is 0.01')
+    parser.add_argument('--fake-rate', type=int, default=0, help='calls per second of a service and region above \
+                        which the fake throttles; default 0 never throttles on rate')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of calls throttled at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with InternalError')
+    parser.add_argument('--pretagged', type=float, default=0.5, help='share of resources which already carry \
+                        their tags; default is 0.5')
+    parser.add_argument('--workers', type=int, default=16, help='threads of the api case; default is 16')
+    parser.add_argument('--region', action='append', default=[], help='region the resources of the report are \
+                        spread over; can be repeated; default is us-east-1 alone')
+    parser.add_argument('--accounts', type=int, default=1, help='number of accounts the resources of the report \
+                        are spread over, tagged through an assumed role except for the first; default is 1')
+    parser.add_argument('--startup', type=int, default=0, help='instead of the cases, start a fresh interpreter \
+                        this many times to time importing the tagging api and its first call, cold and with ec2 \
+                        prewarmed; medians are reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic report and the fake')
+    parser.add_argument('--json', help='file the results are written to')
+    parser.add_argument('--baseline', help='results of an earlier --json run to compare with; exits with 1 on \
+                        a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='share rows/s may drop, or calls may grow, \
+                        before it counts as a regression; default is 0.2')
+    parser.add_argument('--keep', action='store_true', help='keep reports, logs and results of every case')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    Args = parser.parse_args()
+
+    ### a child runs one case and reports through result.json
+    if Args.child:
+        RunChild(json.loads(Args.child))
+        sys.exit()
+
+    WorkDir = tempfile.mkdtemp(prefix='tagging-bench-')
+    Results = []
+    try:
+        for Case in StartupCases if Args.startup > 0 else []:
+            Result = RunStartup(Case, Args.startup)
+            if Result:
+                print(FormatStartup(Result))
+                Results.append(Result)
+        for Rows in [] if Args.startup > 0 else Args.rows or [10000]:
+            Input = os.path.join(WorkDir, 'report-' + str(Rows) + '.' + Args.format)
+            Started = time.perf_counter()
+            GetReport({'rows': Rows, 'seed': Args.seed, 'regions': Args.region, 'accounts': Args.accounts}).Write(Input)
+            print('Report: Rows=' + str(Rows) + ' File=' + Input + ' Seconds=' + '%.1f' % (time.perf_counter() \
+                  - Started))
+            for Case in Args.case or list(Cases):
+                Result = RunCase({'case': Case, 'rows': Rows, 'input': Input, 'latency': Args.latency,
+                                  'jitter': Args.jitter, 'fake_rate': Args.fake_rate,
+                                  'throttle_rate': Args.throttle_rate, 'error_rate': Args.error_rate,
+                                  'pretagged': Args.pretagged, 'workers': Args.workers, 'seed': Args.seed,
+                                  'regions': Args.region, 'accounts': Args.accounts}, WorkDir)
+                if Result:
+                    print(FormatResult(Result))
+                    Results.append(Result)
+    finally:
+        if Args.keep:
+            print('Kept: ' + WorkDir)
+        else:
+            shutil.rmtree(WorkDir, ignore_errors=True)
+
+    if Args.json:
+        with open(Args.json, 'w') as f:
+            json.dump(Results, f, indent=1)
+
+    if Args.baseline:
+        with open(Args.baseline, 'r') as f:
+            Regressions = GetRegressions(Results, json.load(f), Args.tolerance)
+        for Line in Regressions:
+            print(Line)
+        sys.exit(1 if Regressions else 0)
+
+### worker processes started with spawn import this file as __mp_main__
+elif __name__ != '__mp_main__':
+    print('I\'m not a module.')
+    sys.exit()
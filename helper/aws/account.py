@@ -0,0 +1,215 @@
+"""This module provides cached assume-role sessions for tagging the resources of linked accounts"""
+import os
+import sys
+import threading
+### run as a script, i.e. python3 helper/aws/account.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.arn import GetArnAccount, GetUrlAccount, IsAccount
+from aws.client import GetPool, SetAccountSessions
+from aws.ratelimit import Call
+
+
+class AccountSessions:
+    """Assume a role once per linked account and share its credentials by every client of the account
+
+    The credentials of an account are botocore RefreshableCredentials, so the role is
+    assumed when the account is first used and again only when they are about to expire,
+    by whichever call notices first while the others wait. Resources of the account of
+    the base credentials, and resources whose account is unknown, use the base
+    credentials. Several accounts may assume their role at the same time.
+    """
+
+    def __init__(self, RoleName='OrganizationAccountAccessRole', SessionName='aws-tagging', Duration=3600,
+                 ExternalId=None, Region=None, Profile=None, Pool=None):
+        """Constructor"""
+
+        self.RoleName = RoleName
+        self.SessionName = SessionName
+        self.Duration = Duration
+        self.ExternalId = ExternalId
+        self.Region = Region
+        self.Profile = Profile
+        self.Pool = Pool if Pool is not None else GetPool()
+        self.AssumeCount = 0
+        self.__Identity = None
+        self.__Credentials = {}
+        self.__Locks = {}
+        self.__Lock = threading.Lock()
+
+    def GetIdentity(self):
+        """Return (Account, Partition) of the base credentials, asking sts once"""
+
+        if self.__Identity is None:
+            with self.__Lock:
+                if self.__Identity is None:
+                    Client = self.Pool.GetClient('sts', self.Region, self.Profile)
+                    response = Call('sts', self.Region, Client.get_caller_identity)
+                    self.__Identity = (response['Account'], response['Arn'].split(':')[1])
+
+        return self.__Identity
+
+    def GetHomeAccount(self):
+        """Return account of the base credentials"""
+
+        return self.GetIdentity()[0]
+
+    def GetRoleArn(self, Account):
+        """Return ARN of the role assumed in an account"""
+
+        return 'arn:' + self.GetIdentity()[1] + ':iam::' + Account + ':role/' + self.RoleName
+
+    def GetAccount(self, Account):
+        """Return account whose role is assumed, or None for the base account and values which are no account id"""
+
+        if not IsAccount(Account) or Account == self.GetHomeAccount():
+            return None
+
+        return Account
+
+    def GetCredentials(self, Account):
+        """Return the shared refreshable credentials of an account, assuming its role on first use"""
+
+        Credentials = self.__Credentials.get(Account)
+        if Credentials is not None:
+            return Credentials
+
+        ### one lock per account, so accounts assume their roles concurrently but each only once
+        with self.__Lock:
+            Lock = self.__Locks.setdefault(Account, threading.Lock())
+        with Lock:
+            Credentials = self.__Credentials.get(Account)
+            if Credentials is None:
+                ### botocore is imported with the first client, not when this module is
+                from botocore.credentials import RefreshableCredentials
+                Credentials = RefreshableCredentials.create_from_metadata(
+                    metadata = self.__Assume(Account),
+                    refresh_using = lambda: self.__Assume(Account),
+                    method = 'sts-assume-role'
+                )
+                self.__Credentials[Account] = Credentials
+
+        return Credentials
+
+    def GetAccountsCount(self):
+        """Return number of accounts whose role was assumed"""
+
+        return len(self.__Credentials)
+
+    def __Assume(self, Account):
+        """Assume the role of an account and return its credentials as botocore metadata"""
+
+        Client = self.Pool.GetClient('sts', self.Region, self.Profile)
+        Params = {'RoleArn': self.GetRoleArn(Account), 'RoleSessionName': self.SessionName,
+                  'DurationSeconds': self.Duration}
+        if self.ExternalId:
+            Params['ExternalId'] = self.ExternalId
+        Credentials = Call('sts', self.Region, Client.assume_role, **Params)['Credentials']
+        with self.__Lock:
+            self.AssumeCount += 1
+
+        return {
+            'access_key': Credentials['AccessKeyId'],
+            'secret_key': Credentials['SecretAccessKey'],
+            'token': Credentials['SessionToken'],
+            'expiry_time': Credentials['Expiration'].isoformat()
+        }
+
+
+_Accounts = None
+
+def ConfigureAccounts(RoleName='OrganizationAccountAccessRole', SessionName='aws-tagging', Duration=3600,
+                      ExternalId=None, Region=None, Profile=None):
+    """Tag resources of linked accounts through an assumed role in every client pool of this process"""
+
+    global _Accounts
+    _Accounts = AccountSessions(RoleName, SessionName, Duration, ExternalId, Region, Profile)
+    SetAccountSessions(_Accounts)
+
+    return _Accounts
+
+def GetAccounts():
+    """Return the process-wide account sessions, or None if every call uses the base credentials"""
+
+    return _Accounts
+
+_Callers = {}
+_CallersLock = threading.Lock()
+
+def GetCallerAccount(Profile=None, Pool=None):
+    """Return account of the base credentials of a profile, asking sts once per process"""
+
+    Account = _Callers.get(Profile)
+    if Account is None:
+        with _CallersLock:
+            Account = _Callers.get(Profile)
+            if Account is None:
+                if _Accounts is not None and _Accounts.Profile == Profile:
+                    Account = _Accounts.GetHomeAccount()
+                else:
+                    Client = (Pool if Pool is not None else GetPool()).GetClient('sts', None, Profile)
+                    Account = Call('sts', None, Client.get_caller_identity)['Account']
+                _Callers[Profile] = Account
+
+    return Account
+
+def GetLinkedAccount(Account):
+    """Return Account if its role is assumed, or None for the base credentials"""
+
+    Accounts = _Accounts
+
+    return Accounts.GetAccount(Account) if Accounts and Account else None
+
+def GetResourceAccount(ResourceId, Account=None):
+    """Return account whose role is assumed for a resource: the account of its ARN or queue URL, else Account,
+    i.e. from the report; None means the base credentials"""
+
+    if _Accounts is None:
+        return None
+
+    return GetLinkedAccount(GetArnAccount(ResourceId) or GetUrlAccount(ResourceId) or Account)
+
+if __name__ == '__main__':
+    import datetime
+
+    class FakeSts:
+        """sts client answering for account 111111111111"""
+
+        def __init__(self):
+            self.Calls = 0
+
+        def get_caller_identity(self):
+            return {'Account': '111111111111', 'Arn': 'arn:aws:iam::111111111111:user/ops'}
+
+        def assume_role(self, **Params):
+            self.Calls += 1
+            Expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+            return {'Credentials': {'AccessKeyId': 'AK' + Params['RoleArn'][13:25], 'SecretAccessKey': 's',
+                                    'SessionToken': 't', 'Expiration': Expiration}}
+
+    class FakePool:
+        """Pool returning the same fake sts client"""
+
+        def __init__(self):
+            self.Sts = FakeSts()
+
+        def GetClient(self, Service, Region=None, Profile=None, Credentials=None, Account=None):
+            return self.Sts
+
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: the base account and non-account values use the base credentials', end='')
+    Accounts = AccountSessions(Pool=FakePool())
+    assert Accounts.GetAccount('111111111111') is None and Accounts.GetAccount('') is None
+    assert Accounts.GetAccount('222222222222') == '222222222222'
+    assert Accounts.GetRoleArn('222222222222') == 'arn:aws:iam::222222222222:role/OrganizationAccountAccessRole'
+    print('...OK')
+    print('TEST 2: assume a role once per account across threads', end='')
+    Threads = [threading.Thread(target=Accounts.GetCredentials, args=(Account,)) \
+               for Account in ['222222222222', '333333333333'] * 8]
+    for Thread in Threads:
+        Thread.start()
+    for Thread in Threads:
+        Thread.join()
+    assert Accounts.AssumeCount == 2 and Accounts.GetAccountsCount() == 2
+    assert Accounts.GetCredentials('222222222222').get_frozen_credentials().access_key == 'AK222222222222'
+    print('...OK')
@@ -0,0 +1,143 @@
+"""This module provides functions to parse AWS ARNs"""
+import re
+
+### region codes, i.e. us-east-1, eu-central-2 or us-gov-west-1
+RegionPattern = re.compile(r'^[a-z]{2}(-gov|-iso[a-z]?)?-[a-z]+-\d+$')
+
+### account ids, i.e. 123456789012
+AccountPattern = re.compile(r'^\d{12}$')
+
+
+def IsArn(ResourceId):
+    """Return True if resource id is a full ARN, i.e. arn:aws:sqs:us-east-1:123456789012:queue"""
+
+    return ResourceId.startswith('arn:') and ResourceId.count(':') >= 5
+
+def ParseArn(Arn):
+    """Return ARN as dictionary with Partition, Service, Region, Account and Resource, or None"""
+
+    if not IsArn(Arn):
+        return None
+
+    Partition, Service, Region, Account, Resource = Arn.split(':', 5)[1:]
+
+    return {
+        'Partition': Partition,
+        'Service': Service,
+        'Region': Region if Region else None,
+        'Account': Account if Account else None,
+        'Resource': Resource
+    }
+
+def GetArnRegion(Arn):
+    """Return region of ARN, or None for global resources and non-ARN ids"""
+
+    Parsed = ParseArn(Arn)
+
+    return Parsed['Region'] if Parsed else None
+
+def GetArnAccount(Arn):
+    """Return account of ARN, or None for ARNs without one, i.e. s3 buckets, and non-ARN ids"""
+
+    Parsed = ParseArn(Arn)
+
+    return Parsed['Account'] if Parsed else None
+
+def IsAccount(Value):
+    """Return True if value is a 12 digit account id"""
+
+    return bool(Value) and AccountPattern.match(Value) is not None
+
+def IsRegion(Value):
+    """Return True if value is a region code, i.e. us-east-1, rather than global or a location name"""
+
+    return bool(Value) and RegionPattern.match(Value) is not None
+
+def GetUrlRegion(Url):
+    """Return region of an AWS endpoint URL, i.e. us-east-1 for https://sqs.us-east-1.amazonaws.com/1/q, or None"""
+
+    if not Url.startswith('https://'):
+        return None
+
+    Parts = Url[8:].split('/', 1)[0].split('.')
+
+    return Parts[1] if len(Parts) > 2 and IsRegion(Parts[1]) else None
+
+def GetUrlAccount(Url):
+    """Return account in the path of an AWS endpoint URL, i.e. of a queue URL, or None"""
+
+    if not Url.startswith('https://'):
+        return None
+
+    Parts = Url[8:].split('/')
+
+    return Parts[1] if len(Parts) > 2 and IsAccount(Parts[1]) else None
+
+def GetEc2ResourceId(ResourceId):
+    """Return the bare ec2 id, i.e. i-0abc for arn:aws:ec2:us-east-1:123456789012:instance/i-0abc"""
+
+    if ResourceId.startswith('arn:'):
+        return ResourceId.split(':')[-1].split('/')[-1]
+
+    return ResourceId
+
+def GetLogGroupName(ResourceId):
+    """Return the log group name, i.e. app for arn:aws:logs:us-east-1:123456789012:log-group:app:*"""
+
+    if ResourceId.startswith('arn:'):
+        Name = ResourceId.split(':log-group:', 1)[-1]
+        return Name[:-2] if Name.endswith(':*') else Name
+
+    return ResourceId
+
+def GetBucketName(ResourceId):
+    """Return the bucket name, i.e. my-bucket for arn:aws:s3:::my-bucket"""
+
+    return ResourceId.split(':')[-1] if ResourceId.startswith('arn:') else ResourceId
+
+def GetQueueUrl(ResourceId):
+    """Return the queue URL, i.e. https://sqs.us-east-1.amazonaws.com/123456789012/q for
+    arn:aws:sqs:us-east-1:123456789012:q"""
+
+    Parsed = ParseArn(ResourceId)
+    if not Parsed:
+        return ResourceId
+
+    return 'https://sqs.' + str(Parsed['Region']) + '.amazonaws.com/' + str(Parsed['Account']) + '/' \
+           + Parsed['Resource']
+
+def GetResourceName(ResourceId):
+    """Return the last part of an ARN, i.e. the stream name of arn:aws:kinesis:...:stream/name"""
+
+    return ResourceId.split(':')[-1].split('/')[-1]
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: parse regional ARN', end='')
+    Parsed = ParseArn('arn:aws:logs:us-west-2:123456789012:log-group:/aws/lambda/app:*')
+    assert Parsed['Region'] == 'us-west-2' and Parsed['Account'] == '123456789012'
+    assert Parsed['Resource'] == 'log-group:/aws/lambda/app:*'
+    print('...OK')
+    print('TEST 2: parse global ARN', end='')
+    assert GetArnRegion('arn:aws:s3:::my-bucket') is None
+    assert ParseArn('arn:aws:s3:::my-bucket')['Resource'] == 'my-bucket'
+    print('...OK')
+    print('TEST 3: reject non-ARN ids', end='')
+    assert ParseArn('i-0abc') is None and not IsArn('https://sqs.us-east-1.amazonaws.com/1/q')
+    print('...OK')
+    print('TEST 4: get regions of queue URLs and report values', end='')
+    assert GetUrlRegion('https://sqs.eu-west-2.amazonaws.com/123456789012/q') == 'eu-west-2'
+    assert IsRegion('us-gov-west-1') and not IsRegion('global') and not IsRegion('US East (N. Virginia)')
+    print('...OK')
+    print('TEST 5: get accounts of ARNs and queue URLs', end='')
+    assert GetArnAccount('arn:aws:sqs:us-east-1:123456789012:q') == '123456789012'
+    assert GetArnAccount('arn:aws:s3:::my-bucket') is None
+    assert GetUrlAccount('https://sqs.eu-west-2.amazonaws.com/q') is None
+    assert GetUrlAccount('https://sqs.eu-west-2.amazonaws.com/123456789012/q') == '123456789012'
+    print('...OK')
+    print('TEST 6: convert ARNs listed by the tagging api to the ids apis want', end='')
+    assert GetQueueUrl('arn:aws:sqs:eu-west-2:123456789012:q') == 'https://sqs.eu-west-2.amazonaws.com/123456789012/q'
+    assert GetQueueUrl('https://sqs.eu-west-2.amazonaws.com/1/q') == 'https://sqs.eu-west-2.amazonaws.com/1/q'
+    assert GetResourceName('arn:aws:elasticfilesystem:us-east-1:123456789012:file-system/fs-1') == 'fs-1'
+    assert GetResourceName('arn:aws:route53:::hostedzone/Z1') == 'Z1' and GetResourceName('j-1') == 'j-1'
+    print('...OK')
@@ -0,0 +1,333 @@
+"""This module provides batching of tag calls: many ec2 ids per create_tags() call, one get/put round
+trip per s3 bucket and many ids per read for services whose read method takes a list"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+### run as a script, i.e. python3 helper/aws/batch.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.tag import AwsTag
+from aws.arn import GetEc2ResourceId, GetBucketName
+from aws.registry import GetAdapter, GetResourceRegion
+from aws.account import GetResourceAccount
+from aws.ratelimit import Call
+
+
+class Ec2TagBatcher:
+    """Group ec2 resources by identical tag set and flush them with AwsTag.CreateTagsBatch()
+
+    Add() and Flush() return a list of (Ref, ResourceId, Error) tuples for every row that was
+    sent, where Ref is whatever the caller passed in (i.e. the csv row number) and Error is
+    None on success. Add() and Flush() may be called from several threads; the API call
+    for a full group is made by the thread that filled it. Groups are kept per region and
+    linked account and sent with an AwsTag of that region and account. With Remove, Add()
+    takes a list of tag names instead of a dictionary and groups are flushed with
+    AwsTag.DeleteTagsBatch().
+    """
+
+    MaxBatchSize = GetAdapter('ec2').MaxBatch
+
+    def __init__(self, BatchSize=1000, Region=None, Profile=None, Tag=None, Remove=False):
+        """Constructor"""
+
+        self.BatchSize = max(1, min(BatchSize, Ec2TagBatcher.MaxBatchSize))
+        self.Remove = Remove
+        self.Tag = Tag if Tag is not None else AwsTag('ec2', Region, Profile)
+        self.__Tags = {(self.Tag.Region, self.Tag.Account): self.Tag}
+        self.__Groups = {}
+        self.__Lock = threading.Lock()
+        self.FlushCount = 0
+
+    def Add(self, ResourceId, Tags, Ref=None, Region=None, Account=None):
+        """Queue a resource and its tags dictionary; flushes and returns results when its group is full"""
+
+        Key = (Region if Region else self.Tag.Region, Account if Account else self.Tag.Account,
+               tuple(sorted(Tags)) if self.Remove else tuple(sorted(Tags.items())))
+        with self.__Lock:
+            Group = self.__Groups.setdefault(Key, {})
+            Group.setdefault(GetEc2ResourceId(ResourceId), []).append((Ref, ResourceId))
+            if len(Group) < self.BatchSize:
+                return []
+            del self.__Groups[Key]
+
+        return self.__FlushGroup(Key, Group)
+
+    def Flush(self):
+        """Send every queued group and return results"""
+
+        with self.__Lock:
+            Groups = list(self.__Groups.items())
+            self.__Groups.clear()
+
+        Results = []
+        for Key, Group in Groups:
+            Results.extend(self.__FlushGroup(Key, Group))
+
+        return Results
+
+    def GetPendingCount(self):
+        """Return number of queued rows"""
+
+        with self.__Lock:
+            return sum(len(Refs) for Group in self.__Groups.values() for Refs in Group.values())
+
+    def __FlushGroup(self, Key, Group):
+        """Send one group and map per-id failures back to the queued rows"""
+
+        with self.__Lock:
+            self.FlushCount += 1
+            Tag = self.__Tags.get(Key[:2])
+            if Tag is None:
+                Tag = AwsTag('ec2', Key[0], self.Tag.Profile, self.Tag.Pool, Key[1])
+                self.__Tags[Key[:2]] = Tag
+        try:
+            if self.Remove:
+                Failed = Tag.DeleteTagsBatch(list(Group.keys()), list(Key[2]))
+            else:
+                Failed = Tag.CreateTagsBatch(list(Group.keys()), dict(Key[2]))
+        except Exception as e:
+            Failed = dict.fromkeys(Group.keys(), str(e))
+
+        Results = []
+        for Ec2Id, Refs in Group.items():
+            for Ref, ResourceId in Refs:
+                Results.append((Ref, ResourceId, Failed.get(Ec2Id)))
+
+        return Results
+
+
+class S3TagMerger:
+    """Coalesce all pending tag changes of a bucket into one get_bucket_tagging() and one put_bucket_tagging()
+
+    put_bucket_tagging() replaces the whole tag set, so each bucket's tags are read once,
+    the queued rows are applied in order, and the merged set is written once, only if it
+    changed. When Overwrite is False a row's tag is skipped if the bucket or an earlier row
+    already set it, as if the rows had been processed one by one. Flushing returns
+    (Ref, ResourceId, WrittenTags, SkippedTagNames, Error) tuples, where Error is None on
+    success and WrittenTags is empty if every tag of the row was skipped.
+    Buckets are held until Flush(), or until more than MaxBuckets are pending, in which
+    case the oldest bucket is flushed by Add(). A bucket is read and written in the region
+    and linked account its first row names, or the merger's if none does.
+    """
+
+    def __init__(self, Overwrite=False, MaxBuckets=10000, Region=None, Profile=None, Tag=None):
+        """Constructor"""
+
+        self.Overwrite = Overwrite
+        self.MaxBuckets = MaxBuckets
+        self.Tag = Tag if Tag is not None else AwsTag('s3', Region, Profile)
+        self.__Tags = {(self.Tag.Region, self.Tag.Account): self.Tag}
+        self.__Buckets = OrderedDict()
+        self.__Lock = threading.Lock()
+        self.FlushCount = 0
+
+    def Add(self, ResourceId, Tags, Ref=None, Region=None, Account=None):
+        """Queue a row's tags for its bucket; returns results if the oldest bucket had to be flushed"""
+
+        Bucket = GetBucketName(ResourceId)
+        with self.__Lock:
+            self.__Buckets.setdefault(Bucket, (Region, Account, []))[2].append((Ref, ResourceId, Tags))
+            if len(self.__Buckets) <= self.MaxBuckets:
+                return []
+            Oldest, (Region, Account, Rows) = self.__Buckets.popitem(last=False)
+
+        return self.FlushBucket(Oldest, Rows, Region, Account)
+
+    def PopAll(self):
+        """Return and forget every pending (Bucket, Rows, Region, Account), i.e. to flush them on several threads"""
+
+        with self.__Lock:
+            Buckets = [(Bucket, Rows, Region, Account) for Bucket, (Region, Account, Rows) in self.__Buckets.items()]
+            self.__Buckets.clear()
+
+        return Buckets
+
+    def Flush(self):
+        """Flush every pending bucket and return results"""
+
+        Results = []
+        for Bucket, Rows, Region, Account in self.PopAll():
+            Results.extend(self.FlushBucket(Bucket, Rows, Region, Account))
+
+        return Results
+
+    def FlushBucket(self, Bucket, Rows, Region=None, Account=None):
+        """Read, merge and write the tags of one bucket"""
+
+        Key = (Region if Region else self.Tag.Region, Account if Account else self.Tag.Account)
+        with self.__Lock:
+            self.FlushCount += 1
+            Tag = self.__Tags.get(Key)
+            if Tag is None:
+                Tag = AwsTag('s3', Key[0], self.Tag.Profile, self.Tag.Pool, Key[1])
+                self.__Tags[Key] = Tag
+        try:
+            Current = Call('s3', Tag.Region, Tag.GetBucketTags, Bucket)
+        except Exception as e:
+            return [(Ref, ResourceId, Tags, [], str(e)) for Ref, ResourceId, Tags in Rows]
+
+        Merged = dict(Current)
+        Results = []
+        for Ref, ResourceId, Tags in Rows:
+            Skipped = [TagName for TagName in Tags if not self.Overwrite and TagName in Merged]
+            Written = {TagName: TagValue for TagName, TagValue in Tags.items() if TagName not in Skipped}
+            Merged.update(Written)
+            Results.append((Ref, ResourceId, Written, Skipped))
+
+        Error = None
+        if Merged != Current:
+            try:
+                Call('s3', Tag.Region, Tag.PutBucketTags, Bucket, Merged)
+            except Exception as e:
+                Error = str(e)
+        if Error is None:
+            Tag.CacheTags(Bucket, Merged, True)
+
+        return [(Ref, ResourceId, Written, Skipped, Error if Written else None) \
+                for Ref, ResourceId, Written, Skipped in Results]
+
+
+class TagReadBatcher:
+    """Coalesce tag reads of resources whose service reads many ids per call and read them with
+    AwsTag.GetTagsBatch()
+
+    Rows are grouped per service, region and linked account, and a group is read once it
+    holds the MaxReadBatch ids of its service, i.e. 200 per ec2 describe_tags() or 20 per
+    cloudtrail list_tags(). Add() and Flush() return a list of (Ref, ResourceId, Tags,
+    Error) tuples, where Ref is whatever the caller passed in and Error is None if the
+    tags could be read; a resource the tag cache knows is answered by Add() at once.
+    Add() and Flush() may be called from several threads; the read of a full group is
+    made by the thread that filled it.
+    """
+
+    def __init__(self, Profile=None, Pool=None):
+        """Constructor"""
+
+        self.Profile = Profile
+        self.Pool = Pool
+        self.__Tags = {}
+        self.__Groups = {}
+        self.__Lock = threading.Lock()
+        self.FlushCount = 0
+
+    @staticmethod
+    def IsBatched(Service):
+        """Return True if reads of the service are worth coalescing"""
+
+        Adapter = GetAdapter(Service)
+
+        return Adapter is not None and Adapter.IsReadBatched()
+
+    def Add(self, Service, ResourceId, Ref=None, Region=None, Account=None):
+        """Queue a resource whose tags are needed; returns results when its group is full or its tags are cached"""
+
+        Key = (Service, GetResourceRegion(Service, ResourceId, Region), GetResourceAccount(ResourceId, Account))
+        Cached = self.__GetTag(Key).GetCachedTags(ResourceId)
+        if Cached is not None:
+            return [(Ref, ResourceId, Cached, None)]
+
+        with self.__Lock:
+            Group = self.__Groups.setdefault(Key, {})
+            Group.setdefault(ResourceId, []).append(Ref)
+            if len(Group) < GetAdapter(Service).MaxReadBatch:
+                return []
+            del self.__Groups[Key]
+
+        return self.FlushGroup(Key, Group)
+
+    def PopAll(self):
+        """Return and forget every pending (Key, Group), i.e. to flush them on several threads"""
+
+        with self.__Lock:
+            Groups = list(self.__Groups.items())
+            self.__Groups.clear()
+
+        return Groups
+
+    def Flush(self):
+        """Read every queued group and return results"""
+
+        Results = []
+        for Key, Group in self.PopAll():
+            Results.extend(self.FlushGroup(Key, Group))
+
+        return Results
+
+    def GetPendingCount(self):
+        """Return number of queued rows"""
+
+        with self.__Lock:
+            return sum(len(Refs) for Group in self.__Groups.values() for Refs in Group.values())
+
+    def FlushGroup(self, Key, Group):
+        """Read one group and fan the tags or errors out to its queued rows"""
+
+        with self.__Lock:
+            self.FlushCount += 1
+        try:
+            Tags, Failed = self.__GetTag(Key).GetTagsBatch(list(Group.keys()))
+        except Exception as e:
+            Tags, Failed = {}, dict.fromkeys(Group.keys(), str(e))
+
+        return [(Ref, ResourceId, Tags.get(ResourceId), Failed.get(ResourceId)) \
+                for ResourceId, Refs in Group.items() for Ref in Refs]
+
+    def __GetTag(self, Key):
+        """Return the AwsTag of a service, region and account, created on first use"""
+
+        with self.__Lock:
+            Tag = self.__Tags.get(Key)
+            if Tag is None:
+                Tag = AwsTag(Key[0], Key[1], self.Profile, self.Pool, Key[2])
+                self.__Tags[Key] = Tag
+
+        return Tag
+
+if __name__ == '__main__':
+    import math
+    from aws.fake import InstallFake
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    print('TEST 1: one missing id in a full ec2 batch fails only its row', end='')
+    Batcher = Ec2TagBatcher(1000)
+    Ids = ['i-%05d' % Number for Number in range(1000)]
+    Fake.Delete('ec2', Ids[517])
+    Results = []
+    for Number, ResourceId in enumerate(Ids):
+        Results.extend(Batcher.Add(ResourceId, {'Channel': 'web'}, Number))
+    assert len(Results) == 1000 and [Ref for Ref, ResourceId, Error in Results if Error] == [517]
+    assert Batcher.FlushCount == 1 and Fake.GetCalls()[('ec2', 'create_tags')] == 2
+    print('...OK')
+    print('TEST 2: an id an error does not name fails only its row in a logarithmic number of calls', end='')
+    Ids = ['i-%05d' % Number for Number in range(1000, 2000)]
+    Fake.Delete('ec2', Ids[301], Named=False)
+    Results = []
+    for Number, ResourceId in enumerate(Ids):
+        Results.extend(Batcher.Add(ResourceId, {'Channel': 'web'}, Number))
+    Results.extend(Batcher.Flush())
+    assert [Ref for Ref, ResourceId, Error in Results if Error] == [301] and Batcher.GetPendingCount() == 0
+    assert Fake.GetCalls()[('ec2', 'create_tags')] - 2 <= 2 * math.ceil(math.log2(len(Ids))) + 1
+    print('...OK')
+    print('TEST 3: a bucket without a tag set is read as empty and written once for all its rows', end='')
+    Merger = S3TagMerger()
+    Merger.Add('arn:aws:s3:::b1', {'Channel': 'web'}, 1)
+    Merger.Add('b1', {'Owner': 'ops'}, 2)
+    Results = Merger.Flush()
+    assert Results == [(1, 'arn:aws:s3:::b1', {'Channel': 'web'}, [], None), (2, 'b1', {'Owner': 'ops'}, [], None)]
+    assert Fake.GetTags('s3', 'b1') == {'Channel': 'web', 'Owner': 'ops'}
+    assert Fake.GetCalls()[('s3', 'get_bucket_tagging')] == 1 and Fake.GetCalls()[('s3', 'put_bucket_tagging')] == 1
+    print('...OK')
+    print('TEST 4: tags the bucket or an earlier row has are skipped when Overwrite is False', end='')
+    Fake.Put('s3', 'b2', {'Channel': 'app', 'Keep': 'x'})
+    Merger.Add('b2', {'Channel': 'web', 'Owner': 'ops'}, 3)
+    Merger.Add('b2', {'Owner': 'dev'}, 4)
+    Results = Merger.Flush()
+    assert Results == [(3, 'b2', {'Owner': 'ops'}, ['Channel'], None), (4, 'b2', {}, ['Owner'], None)]
+    assert Fake.GetTags('s3', 'b2') == {'Channel': 'app', 'Keep': 'x', 'Owner': 'ops'}
+    print('...OK')
+    print('TEST 5: a bucket whose tags do not change is not written', end='')
+    Merger.Add('b2', {'Channel': 'web'}, 5)
+    assert Merger.Flush() == [(5, 'b2', {}, ['Channel'], None)]
+    assert Fake.GetCalls()[('s3', 'put_bucket_tagging')] == 2 and Merger.FlushCount == 3
+    print('...OK')
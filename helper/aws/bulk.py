@@ -0,0 +1,245 @@
+"""This module provides a bulk tag writer and remover over the Resource Groups Tagging API"""
+import os
+import random
+import sys
+import threading
+import time
+### run as a script, i.e. python3 helper/aws/bulk.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from botocore.exceptions import ClientError
+from aws.client import GetPool
+from aws.registry import GetResourceRegion
+from aws.account import GetResourceAccount
+from aws.tag import AwsTag
+from aws.ratelimit import Call
+
+
+class BulkTagger:
+    """Write tags for ARNs of any service with resourcegroupstaggingapi.tag_resources()
+
+    ARNs are grouped by the region whose api serves them, linked account and identical
+    tag set and sent up to 20 per call; ARNs without a region, i.e. of s3 or global
+    services, take the home region of their service or the Region of their row.
+    Entries of FailedResourcesMap with a 5xx status are re-sent after a backoff; a call
+    failing without a response, i.e. on a connection error, fails its whole group; other
+    failures, and
+    batches that still fail after MaxRetries, fall back to the per-service AwsTag methods
+    when Fallback is True. Add() and Flush() return (Ref, ResourceId, Error) tuples like
+    Ec2TagBatcher, where Error is None on success, and like it may be shared by threads.
+    With Remove, Add() takes a list of tag names instead of a dictionary, groups are sent
+    with untag_resources() and fall back to the per-service untag methods.
+    """
+
+    MaxBatchSize = 20
+
+    def __init__(self, BatchSize=20, MaxRetries=3, Fallback=True, Profile=None, Pool=None, Remove=False,
+                 MaxBackoff=20.0):
+        """Constructor"""
+
+        self.BatchSize = max(1, min(BatchSize, BulkTagger.MaxBatchSize))
+        self.MaxRetries = MaxRetries
+        self.MaxBackoff = MaxBackoff
+        self.Fallback = Fallback
+        self.Profile = Profile
+        self.Pool = Pool if Pool is not None else GetPool()
+        self.Remove = Remove
+        self.__Groups = {}
+        self.__Lock = threading.Lock()
+        self.FlushCount = 0
+        self.FallbackCount = 0
+
+    def Add(self, Service, ResourceArn, Tags, Ref=None, Region=None, Account=None):
+        """Queue an ARN and its tags dictionary; flushes and returns results when its group is full"""
+
+        Key = (GetResourceRegion(Service, ResourceArn, Region), GetResourceAccount(ResourceArn, Account),
+               tuple(sorted(Tags)) if self.Remove else tuple(sorted(Tags.items())))
+        with self.__Lock:
+            Group = self.__Groups.setdefault(Key, {})
+            Group.setdefault(ResourceArn, []).append((Ref, Service))
+            if len(Group) < self.BatchSize:
+                return []
+            del self.__Groups[Key]
+
+        return self.__FlushGroup(Key, Group)
+
+    def Flush(self):
+        """Send every queued group and return results"""
+
+        with self.__Lock:
+            Groups = list(self.__Groups.items())
+            self.__Groups.clear()
+
+        Results = []
+        for Key, Group in Groups:
+            Results.extend(self.__FlushGroup(Key, Group))
+
+        return Results
+
+    def GetPendingCount(self):
+        """Return number of queued rows"""
+
+        with self.__Lock:
+            return sum(len(Refs) for Group in self.__Groups.values() for Refs in Group.values())
+
+    def TagResources(self, Region, ResourceArns, Tags, Account=None):
+        """Call tag_resources() once and return FailedResourcesMap"""
+
+        Client = self.Pool.GetClient('resourcegroupstaggingapi', Region, self.Profile, Account=Account)
+
+        response = Call('resourcegroupstaggingapi', Region, Client.tag_resources,
+            ResourceARNList = ResourceArns,
+            Tags = Tags
+        )
+
+        return response.get('FailedResourcesMap', {})
+
+    def UntagResources(self, Region, ResourceArns, TagNames, Account=None):
+        """Call untag_resources() once and return FailedResourcesMap"""
+
+        Client = self.Pool.GetClient('resourcegroupstaggingapi', Region, self.Profile, Account=Account)
+
+        response = Call('resourcegroupstaggingapi', Region, Client.untag_resources,
+            ResourceARNList = ResourceArns,
+            TagKeys = TagNames
+        )
+
+        return response.get('FailedResourcesMap', {})
+
+    def __FlushGroup(self, Key, Group):
+        """Send one group and return results; the group is off the queue, so its rows fail rather than vanish if
+        anything goes wrong"""
+
+        try:
+            return self.__SendGroup(Key, Group)
+        except Exception as e:
+            return [(Ref, ResourceArn, str(e)) for ResourceArn, Refs in Group.items() for Ref, Service in Refs]
+
+    def __SendGroup(self, Key, Group):
+        """Send one group, retrying 5xx failures and falling back per resource for the rest"""
+
+        Region, Account, Tags = Key[0], Key[1], list(Key[2]) if self.Remove else dict(Key[2])
+        Pending = list(Group.keys())
+        Failed = {}
+
+        for Attempt in range(self.MaxRetries + 1):
+            if not Pending:
+                break
+            if Attempt:
+                time.sleep(random.uniform(0, min(self.MaxBackoff, 0.1 * 2 ** Attempt)))
+            Sent, Pending = Pending, []
+            with self.__Lock:
+                self.FlushCount += 1
+            try:
+                if self.Remove:
+                    FailedMap = self.UntagResources(Region, Sent, Tags, Account)
+                else:
+                    FailedMap = self.TagResources(Region, Sent, Tags, Account)
+            except ClientError as c:
+                Error = c.response.get('Error', {})
+                StatusCode = c.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+                FailedMap = dict.fromkeys(Sent, {'StatusCode': StatusCode, 'ErrorCode': Error.get('Code', ''),
+                                                 'ErrorMessage': Error.get('Message', str(c))})
+            except Exception as e:
+                FailedMap = dict.fromkeys(Sent, {'StatusCode': 0, 'ErrorCode': type(e).__name__,
+                                                 'ErrorMessage': str(e)})
+            for ResourceArn in Sent:
+                Failure = FailedMap.get(ResourceArn)
+                if Failure is None:
+                    Failed.pop(ResourceArn, None)
+                    self.__CacheTags(Group[ResourceArn][0][1], Region, Account, ResourceArn, Tags)
+                    continue
+                Failed[ResourceArn] = Failure.get('ErrorCode', '') + ': ' + Failure.get('ErrorMessage', '')
+                if Failure.get('StatusCode', 400) >= 500:
+                    Pending.append(ResourceArn)
+
+        Results = []
+        for ResourceArn, Refs in Group.items():
+            Error = Failed.get(ResourceArn)
+            if Error is not None and self.Fallback:
+                Error = self.__FallbackUpdate(Refs[0][1], Region, Account, ResourceArn, Tags, Error)
+            for Ref, Service in Refs:
+                Results.append((Ref, ResourceArn, Error))
+
+        return Results
+
+    def __CacheTags(self, Service, Region, Account, ResourceArn, Tags):
+        """Merge tags written, or drop tags removed, through the tagging api into or from the tag cache"""
+
+        try:
+            Tag = AwsTag(Service, Region, self.Profile, self.Pool, Account)
+            if self.Remove:
+                Tag.CacheTags(ResourceArn, {}, Removed=Tags)
+            else:
+                Tag.CacheTags(ResourceArn, Tags)
+        except Exception:
+            pass
+
+    def __FallbackUpdate(self, Service, Region, Account, ResourceArn, Tags, Error):
+        """Update, or remove tags of, one resource with its per-service method and return the remaining error, or
+        None"""
+
+        with self.__Lock:
+            self.FallbackCount += 1
+        try:
+            Tag = AwsTag(Service, Region, self.Profile, self.Pool, Account)
+            if self.Remove:
+                Tag.RemoveTags(ResourceArn, Tags)
+            else:
+                Tag.UpdateTags(ResourceArn, Tags)
+        except Exception as e:
+            return Error + '; fallback failed: ' + str(e)
+
+        return None
+
+if __name__ == '__main__':
+    from botocore.exceptions import EndpointConnectionError
+    from aws.fake import InstallFake
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    Arns = ['arn:aws:lambda:us-east-1:123456789012:function:fn-%d' % Number for Number in range(3)]
+
+    class FlakyTagger(BulkTagger):
+        """BulkTagger whose tag_resources() calls answer Failures in turn"""
+
+        def __init__(self, Failures, **kwargs):
+            """Constructor"""
+
+            super().__init__(**kwargs)
+            self.Failures = list(Failures)
+            self.Calls = 0
+
+        def TagResources(self, Region, ResourceArns, Tags, Account=None):
+            """Fail or answer as queued, then tag for real"""
+
+            self.Calls += 1
+            Failure = self.Failures.pop(0) if self.Failures else None
+            if isinstance(Failure, Exception):
+                raise Failure
+            if Failure:
+                return Failure
+            return super().TagResources(Region, ResourceArns, Tags, Account)
+
+    print('TEST 1: a connection error fails the group and falls back per resource', end='')
+    Tagger = FlakyTagger([EndpointConnectionError(endpoint_url='https://tagging')])
+    for Number, Arn in enumerate(Arns):
+        assert Tagger.Add('lambda', Arn, {'Channel': 'web'}, Number) == []
+    Results = Tagger.Flush()
+    assert sorted(Results) == [(Number, Arn, None) for Number, Arn in enumerate(Arns)]
+    assert Tagger.FallbackCount == 3 and Tagger.GetPendingCount() == 0
+    assert all(Fake.GetTags('lambda', Arn) == {'Channel': 'web'} for Arn in Arns)
+    print('...OK')
+    print('TEST 2: without fallback every row of the group is reported failed', end='')
+    Tagger = FlakyTagger([EndpointConnectionError(endpoint_url='https://tagging')], Fallback=False)
+    for Number, Arn in enumerate(Arns):
+        Tagger.Add('lambda', Arn, {'Owner': 'ops'}, Number)
+    Results = Tagger.Flush()
+    assert len(Results) == 3 and all('Could not connect' in Error for Ref, Arn, Error in Results)
+    print('...OK')
+    print('TEST 3: 5xx entries are re-sent after a backoff', end='')
+    Tagger = FlakyTagger([{Arns[0]: {'StatusCode': 500, 'ErrorCode': 'InternalServiceException'}}], Fallback=False)
+    for Number, Arn in enumerate(Arns):
+        Tagger.Add('lambda', Arn, {'Team': 'a'}, Number)
+    assert [Error for Ref, Arn, Error in Tagger.Flush()] == [None] * 3 and Tagger.Calls == 2
+    assert Fake.GetTags('lambda', Arns[0]) == {'Channel': 'web', 'Team': 'a'}
+    print('...OK')
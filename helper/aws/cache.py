@@ -0,0 +1,183 @@
+"""This module provides a cache of resource tags kept in memory and in SQLite across runs"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TagCache:
+    """Two-tier cache of resource tags keyed by (service, region, profile, resource id)
+
+    Reads hit an in-process LRU first, then SQLite; entries older than the TTL of their
+    service count as missing. AwsTag fills the cache from reads and merges successful
+    writes into entries it already holds, so a later run, or a duplicate row within a run,
+    does not ask AWS again; it keys entries on the region its client resolved and on the
+    account called, never on an empty region or profile, since the file outlives the
+    default region and credentials of one run. SQLite writes are committed every CommitEvery puts and on
+    Close(). Without a FileName only the in-memory tier is used.
+    """
+
+    def __init__(self, FileName=None, Ttl=86400, Ttls=None, MaxEntries=100000, CommitEvery=100):
+        """Constructor"""
+
+        self.FileName = FileName
+        self.Ttl = Ttl
+        self.Ttls = dict(Ttls or {})
+        self.MaxEntries = MaxEntries
+        self.CommitEvery = CommitEvery
+        self.Hits = 0
+        self.Misses = 0
+        self.__Lru = OrderedDict()
+        self.__Pending = 0
+        self.__Lock = threading.Lock()
+        self.__Db = None
+
+        if FileName:
+            ### worker processes of --processes share the file, so wait for each other's commits
+            self.__Db = sqlite3.connect(FileName, timeout=30, check_same_thread=False)
+            self.__Db.execute('PRAGMA journal_mode=WAL')
+            self.__Db.execute('PRAGMA synchronous=NORMAL')
+            self.__Db.execute('CREATE TABLE IF NOT EXISTS tags (service TEXT, region TEXT, profile TEXT, '
+                              'resource_id TEXT, tags TEXT, updated REAL, '
+                              'PRIMARY KEY (service, region, profile, resource_id)) WITHOUT ROWID')
+
+    @staticmethod
+    def GetKey(Service, Region, Profile, ResourceId):
+        """Return the cache key; None region and profile are stored as empty strings"""
+
+        return (Service, Region or '', Profile or '', ResourceId)
+
+    def Get(self, Service, Region, Profile, ResourceId):
+        """Return a copy of the cached tags dictionary, or None if missing or expired"""
+
+        Key = self.GetKey(Service, Region, Profile, ResourceId)
+        Oldest = time.time() - self.Ttls.get(Service, self.Ttl)
+        with self.__Lock:
+            Entry = self.__Lru.get(Key)
+            if Entry is not None:
+                self.__Lru.move_to_end(Key)
+            elif self.__Db is not None:
+                Row = self.__Db.execute('SELECT tags, updated FROM tags WHERE service=? AND region=? AND profile=? '
+                                        'AND resource_id=?', Key).fetchone()
+                if Row is not None:
+                    Entry = (json.loads(Row[0]), Row[1])
+                    self.__Remember(Key, Entry)
+
+            if Entry is None or Entry[1] < Oldest:
+                self.Misses += 1
+                return None
+
+            self.Hits += 1
+            return dict(Entry[0])
+
+    def Put(self, Service, Region, Profile, ResourceId, Tags):
+        """Cache the complete tags of a resource"""
+
+        Key = self.GetKey(Service, Region, Profile, ResourceId)
+        with self.__Lock:
+            self.__Store(Key, dict(Tags))
+
+    def Update(self, Service, Region, Profile, ResourceId, Tags, Removed=()):
+        """Merge written tags into a cached entry and drop the Removed tag names; a resource which is not cached
+        stays unknown"""
+
+        Key = self.GetKey(Service, Region, Profile, ResourceId)
+        Oldest = time.time() - self.Ttls.get(Service, self.Ttl)
+        with self.__Lock:
+            Entry = self.__Lru.get(Key)
+            if Entry is None and self.__Db is not None:
+                Row = self.__Db.execute('SELECT tags, updated FROM tags WHERE service=? AND region=? AND profile=? '
+                                        'AND resource_id=?', Key).fetchone()
+                Entry = (json.loads(Row[0]), Row[1]) if Row else None
+            if Entry is None or Entry[1] < Oldest:
+                return
+            Merged = dict(Entry[0])
+            Merged.update(Tags)
+            for TagName in Removed:
+                Merged.pop(TagName, None)
+            self.__Store(Key, Merged)
+
+    def Purge(self):
+        """Delete expired entries from SQLite"""
+
+        if self.__Db is None:
+            return
+
+        with self.__Lock:
+            for Service, Ttl in list(self.Ttls.items()) + [(None, self.Ttl)]:
+                if Service is None:
+                    self.__Db.execute('DELETE FROM tags WHERE updated < ? AND service NOT IN (%s)' \
+                                      % ','.join('?' * len(self.Ttls)), [time.time() - Ttl] + list(self.Ttls))
+                else:
+                    self.__Db.execute('DELETE FROM tags WHERE updated < ? AND service = ?', (time.time() - Ttl, Service))
+            self.__Db.commit()
+            self.__Pending = 0
+
+    def Close(self):
+        """Commit and close SQLite"""
+
+        with self.__Lock:
+            if self.__Db is not None:
+                self.__Db.commit()
+                self.__Db.close()
+                self.__Db = None
+
+    def __Store(self, Key, Tags):
+        """Write an entry to both tiers; caller holds the lock"""
+
+        Updated = time.time()
+        self.__Remember(Key, (Tags, Updated))
+        if self.__Db is not None:
+            self.__Db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)',
+                              Key + (json.dumps(Tags), Updated))
+            self.__Pending += 1
+            if self.__Pending >= self.CommitEvery:
+                self.__Db.commit()
+                self.__Pending = 0
+
+    def __Remember(self, Key, Entry):
+        """Add an entry to the LRU, evicting the least recently used; caller holds the lock"""
+
+        self.__Lru[Key] = Entry
+        self.__Lru.move_to_end(Key)
+        while len(self.__Lru) > self.MaxEntries:
+            self.__Lru.popitem(last=False)
+
+
+_Cache = None
+
+def ConfigureCache(FileName=None, Ttl=86400, Ttls=None, MaxEntries=100000):
+    """Enable the tag cache for every AwsTag read and write in this process"""
+
+    global _Cache
+    _Cache = TagCache(FileName, Ttl, Ttls, MaxEntries)
+
+    return _Cache
+
+def GetCache():
+    """Return the process-wide tag cache, or None if caching is disabled"""
+
+    return _Cache
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    print('I prefer to be a module; however, I can run some tests')
+    FileName = os.path.join(tempfile.mkdtemp(), 'test.db')
+    print('TEST 1: cache survives a restart', end='')
+    Cache = TagCache(FileName)
+    Cache.Put('ec2', None, None, 'i-1', {'Channel': 'web'})
+    Cache.Update('ec2', None, None, 'i-1', {'Owner': 'ops'})
+    Cache.Update('ec2', None, None, 'i-2', {'Owner': 'ops'})
+    Cache.Close()
+    Cache = TagCache(FileName)
+    assert Cache.Get('ec2', None, None, 'i-1') == {'Channel': 'web', 'Owner': 'ops'}
+    assert Cache.Get('ec2', None, None, 'i-2') is None
+    print('...OK')
+    print('TEST 2: entries expire per service', end='')
+    Cache = TagCache(FileName, Ttls={'ec2': -1})
+    assert Cache.Get('ec2', None, None, 'i-1') is None
+    Cache.Purge()
+    assert TagCache(FileName).Get('ec2', None, None, 'i-1') is None
+    print('...OK')
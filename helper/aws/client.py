@@ -0,0 +1,227 @@
+"""This module provides a thread-safe pool of AWS clients shared by all AwsTag code paths"""
+import threading
+
+
+class ClientPool:
+    """Cache botocore sessions and clients keyed by service, region, profile/credentials and account
+
+    The clients are those boto3 returns, created straight from botocore, so boto3 and
+    s3transfer are never imported; botocore itself is imported when the first client is
+    created, so importing the tagging modules stays cheap for runs which never call AWS.
+    Sessions are not thread-safe but the clients they create are, so sessions and clients
+    are created under a lock once per key and then shared by every thread. A session
+    serves every region, and all sessions share one ServiceLoader, so each service model
+    is read once per process. The sessions of a linked account share the refreshable
+    credentials of its assumed role.
+    """
+
+    def __init__(self, MaxPoolConnections=50, TcpKeepAlive=True, ConnectTimeout=10, ReadTimeout=60):
+        """Constructor"""
+
+        self.MaxPoolConnections = MaxPoolConnections
+        self.TcpKeepAlive = TcpKeepAlive
+        self.ConnectTimeout = ConnectTimeout
+        self.ReadTimeout = ReadTimeout
+        self.Config = None
+        self.__Lock = threading.Lock()
+        self.__Sessions = {}
+        self.__Clients = {}
+
+    @staticmethod
+    def CredentialsKey(Credentials):
+        """Return a hashable key for a credentials dictionary, i.e. the result of sts.assume_role()"""
+
+        if not Credentials:
+            return None
+
+        return (Credentials.get('AccessKeyId'), Credentials.get('SessionToken'))
+
+    def GetSession(self, Profile=None, Credentials=None, Account=None):
+        """Return the shared botocore session for profile/credentials and account"""
+
+        Key = (Profile, self.CredentialsKey(Credentials), Account)
+        Session = self.__Sessions.get(Key)
+        if Session is None:
+            ### assume the role outside the pool lock, so other accounts and services are not held up
+            AccountCredentials = _AccountSessions.GetCredentials(Account) if Account and _AccountSessions else None
+            with self.__Lock:
+                Session = self.__Sessions.get(Key)
+                if Session is None:
+                    Session = self.__NewSession(Profile, Credentials, AccountCredentials)
+                    self.__Sessions[Key] = Session
+
+        return Session
+
+    def GetClient(self, Service, Region=None, Profile=None, Credentials=None, Account=None):
+        """Return the shared client for service, region, profile/credentials and account; Account is a linked
+        account whose role is assumed, or None for the base credentials"""
+
+        Key = (Service, Region, Profile, self.CredentialsKey(Credentials), Account)
+        Client = self.__Clients.get(Key)
+        if Client is None:
+            Factory = _ClientFactory
+            Session = self.GetSession(Profile, Credentials, Account) if Factory is None else None
+            ### a factory has no use for the credentials, but still assumes the role like boto3 would
+            if Factory and Account and _AccountSessions:
+                _AccountSessions.GetCredentials(Account)
+            with self.__Lock:
+                Client = self.__Clients.get(Key)
+                if Client is None:
+                    if Factory:
+                        Client = Factory(Service, Region, Profile, Credentials)
+                    else:
+                        Client = Session.create_client(Service, region_name=Region, config=self.__GetConfig())
+                    for Hook in _ClientHooks:
+                        Hook(Client, Service, Region)
+                    self.__Clients[Key] = Client
+
+        return Client
+
+    def Prewarm(self, Services, Region=None, Profile=None):
+        """Create the clients of services now, so the first call of each does not wait for botocore and its
+        model; return the services which failed"""
+
+        Failed = []
+        for Service in Services:
+            try:
+                self.GetClient(Service, Region, Profile)
+            except Exception:
+                Failed.append(Service)
+
+        return Failed
+
+    def GetClientsCount(self):
+        """Return number of cached clients"""
+
+        return len(self.__Clients)
+
+    def Clear(self):
+        """Drop all cached sessions and clients"""
+
+        with self.__Lock:
+            self.__Clients.clear()
+            self.__Sessions.clear()
+
+    def __GetConfig(self):
+        """Return the client config, created with the first client; caller holds the lock"""
+
+        if self.Config is None:
+            from botocore.config import Config
+            self.Config = Config(
+                max_pool_connections = self.MaxPoolConnections,
+                tcp_keepalive = self.TcpKeepAlive,
+                connect_timeout = self.ConnectTimeout,
+                read_timeout = self.ReadTimeout
+            )
+
+        return self.Config
+
+    def __NewSession(self, Profile, Credentials, AccountCredentials=None):
+        """Create a botocore session sharing the process-wide loader; caller holds the lock"""
+
+        import botocore.session
+        Session = botocore.session.Session(profile=Profile)
+        Session.register_component('data_loader', GetLoader())
+        if AccountCredentials:
+            Session.register_component('credential_provider', GetCredentialResolver(AccountCredentials))
+        elif Credentials:
+            Session.set_credentials(Credentials['AccessKeyId'], Credentials['SecretAccessKey'],
+                                    Credentials.get('SessionToken'))
+
+        return Session
+
+
+_Pool = None
+_PoolLock = threading.Lock()
+_Loader = None
+_ClientHooks = []
+_ClientFactory = None
+_AccountSessions = None
+
+def RegisterClientHook(Hook):
+    """Call Hook(Client, Service, Region) for every client created by any pool from now on"""
+
+    if Hook not in _ClientHooks:
+        _ClientHooks.append(Hook)
+
+def SetClientFactory(Factory):
+    """Create the clients of every pool with Factory(Service, Region, Profile, Credentials) instead of botocore,
+    i.e. a fake backend for benchmarks; None restores botocore"""
+
+    global _ClientFactory
+    _ClientFactory = Factory
+
+def SetAccountSessions(Sessions):
+    """Create the clients of linked accounts in every pool with the credentials of Sessions.GetCredentials(Account),
+    i.e. aws.account.AccountSessions; None uses the base credentials for every account"""
+
+    global _AccountSessions
+    _AccountSessions = Sessions
+
+def GetCredentialResolver(Credentials):
+    """Return a botocore credential resolver which always answers Credentials, i.e. the refreshable credentials of
+    an assumed role, so every session given it shares them"""
+
+    from botocore.credentials import CredentialProvider, CredentialResolver
+
+    class SharedProvider(CredentialProvider):
+        """Provider of credentials created outside botocore's chain"""
+
+        METHOD = getattr(Credentials, 'method', None) or 'shared'
+
+        def load(self):
+            """Return the shared credentials"""
+
+            return Credentials
+
+    return CredentialResolver([SharedProvider()])
+
+def GetLoader():
+    """Return the botocore loader shared by every session of this process, importing botocore on first use"""
+
+    global _Loader
+    if _Loader is None:
+        with _PoolLock:
+            if _Loader is None:
+                from aws.loader import ServiceLoader
+                _Loader = ServiceLoader()
+
+    return _Loader
+
+def GetPool():
+    """Return the process-wide client pool, creating it with defaults on first use"""
+
+    global _Pool
+    if _Pool is None:
+        with _PoolLock:
+            if _Pool is None:
+                _Pool = ClientPool()
+
+    return _Pool
+
+def ConfigurePool(MaxPoolConnections=50, TcpKeepAlive=True, ConnectTimeout=10, ReadTimeout=60):
+    """Replace the process-wide client pool; call before any worker threads start"""
+
+    global _Pool
+    with _PoolLock:
+        _Pool = ClientPool(MaxPoolConnections, TcpKeepAlive, ConnectTimeout, ReadTimeout)
+
+    return _Pool
+
+def GetClient(Service, Region=None, Profile=None, Credentials=None, Account=None):
+    """Return a shared client from the process-wide pool"""
+
+    return GetPool().GetClient(Service, Region, Profile, Credentials, Account)
+
+def Prewarm(Services, Region=None, Profile=None, Wait=True):
+    """Create the clients of services in the process-wide pool ahead of their first call, i.e. while a small
+    invocation starts up; with Wait False a daemon thread does it and is returned"""
+
+    if Wait:
+        return GetPool().Prewarm(Services, Region, Profile)
+
+    Thread = threading.Thread(target=GetPool().Prewarm, args=(list(Services), Region, Profile),
+                              name='client-prewarm', daemon=True)
+    Thread.start()
+
+    return Thread
@@ -0,0 +1,292 @@
+"""This module provides discovery of the resources of every supported service, written as a report to tag"""
+import csv
+import gzip
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+### run as a script, i.e. python3 helper/aws/discover.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.client import GetPool
+from aws.prefetch import TagIndex
+from aws.ratelimit import Call, GetLimiters
+from aws.registry import GetAdapter, GetServiceNames
+
+### columns of a Cost and Usage Report which update-tags.py reads, before the tag columns
+ReportColumns = ['identity_line_item_id', 'line_item_usage_start_date', 'service', 'resource_id',
+                 'line_item_unblended_cost', 'product_region', 'line_item_usage_account_id']
+
+
+class ResourceDiscoverer:
+    """Enumerate the resources of the supported services of several regions and accounts into a report
+
+    Every ResourceList of the registry runs as a task of its own on Workers threads, one per
+    (list, region, account), so services and regions are listed concurrently while each
+    list pages through its resources in order, every page paced by aws.ratelimit. Lists of
+    global services and lists which cover every region run once per account. Each page is
+    written to FileName, csv or csv.gz, as soon as it arrives: one row per resource in the
+    columns of a Cost and Usage Report, with its region and account, so update-tags.py
+    reads the inventory like a report. TagColumns, a dictionary of AwsTagName to
+    CsvTagName, adds a column per tag holding the value the resource carries, found by a few
+    ec2 and tagging api scans per region, or Unknown, which update-tags.py skips.
+    """
+
+    def __init__(self, L, FileName, TagColumns=None, Services=None, Workers=16, Profile=None):
+        """Constructor"""
+
+        self.L = L
+        self.FileName = FileName
+        self.TagColumns = dict(TagColumns or {})
+        self.Services = list(Services) if Services else GetServiceNames()
+        for Service in self.Services:
+            if GetAdapter(Service) is None:
+                raise Exception('service ' + Service + ' is not supported')
+        self.Workers = max(1, Workers)
+        self.Profile = Profile
+        self.Pool = GetPool()
+
+        self.Total = 0
+        self.Lists = 0
+        self.Failed = 0
+        self.CallsCount = 0
+        self.__Started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.__Indexes = {}
+        self.__File = None
+        self.__Writer = None
+        self.__Lock = threading.Lock()
+
+    def Run(self, Regions=None, Accounts=None):
+        """List the resources of every account and region, None being the base account and default region, and write
+        the report; Regions holding all lists the enabled regions of each account"""
+
+        self.Open()
+        try:
+            Scopes = [(Account, self.GetIdentity(Account), self.GetRegions(Regions, Account)) \
+                      for Account in Accounts or [None]]
+            with ThreadPoolExecutor(max_workers=self.Workers, thread_name_prefix='discover') as Executor:
+                if self.TagColumns:
+                    Scans = {}
+                    for Account, Identity, Where in Scopes:
+                        self.__Indexes[Account] = TagIndex(self.Profile)
+                        for Region in self.GetTagRegions(Where):
+                            Scans[Executor.submit(self.ScanTags, Region, Account)] = (Region, Account)
+                    for Future in as_completed(Scans):
+                        Region, Account = Scans[Future]
+                        try:
+                            Future.result()
+                        except Exception as e:
+                            self.L.TeeLog('Discover: failed to scan tags of Region=' + Region + ' Account=' \
+                                          + str(Account or 'base') + ', writing them as Unknown: ' + str(e), 1)
+
+                Lists = {}
+                for Account, Identity, Where in Scopes:
+                    for Service in self.Services:
+                        Adapter = GetAdapter(Service)
+                        for Lister in Adapter.Lists:
+                            ### global services and lists of every region are listed once
+                            Once = Adapter.Global or Lister.RegionKey
+                            for Region in [Adapter.HomeRegion or Where[0]] if Once else Where:
+                                Future = Executor.submit(self.List, Service, Lister, Region, Account, Identity, Where)
+                                Lists[Future] = (Service, Lister.Method, Region, Account)
+                for Future in as_completed(Lists):
+                    self.Report(Lists[Future], Future)
+        finally:
+            self.Close()
+
+    def GetIdentity(self, Account=None):
+        """Return (AccountId, Partition) of an account, None being the account of the base credentials"""
+
+        Client = self.Pool.GetClient('sts', None, self.Profile, Account=Account)
+        response = Call('sts', None, Client.get_caller_identity)
+
+        return response['Account'], response['Arn'].split(':')[1]
+
+    def GetRegions(self, Regions, Account=None):
+        """Return regions listed in an account: the given ones, every enabled one for all, or the default one"""
+
+        Client = self.Pool.GetClient('ec2', None, self.Profile, Account=Account)
+        if Regions and 'all' in Regions:
+            with self.__Lock:
+                self.CallsCount += 1
+            response = Call('ec2', Client.meta.region_name, Client.describe_regions)
+            return sorted(Region['RegionName'] for Region in response['Regions'])
+        if Regions:
+            return list(Regions)
+        if not Client.meta.region_name:
+            raise Exception('no default region is configured; pass --region')
+
+        return [Client.meta.region_name]
+
+    def GetTagRegions(self, Regions):
+        """Return regions whose tags are scanned: the listed ones and the home regions of global services"""
+
+        HomeRegions = [GetAdapter(Service).HomeRegion for Service in self.Services if GetAdapter(Service).HomeRegion]
+
+        return list(dict.fromkeys(list(Regions) + HomeRegions))
+
+    def ScanTags(self, Region, Account=None):
+        """Index the values of the tag columns the resources of a region carry"""
+
+        Index = self.__Indexes[Account]
+        Names = list(self.TagColumns)
+        if 'ec2' in self.Services:
+            for Service, ResourceId, Tags, Where in Index.ScanEc2(Names, Region, Account):
+                Index.Put(Service, ResourceId, Tags, Where)
+        if any(Service != 'ec2' for Service in self.Services):
+            for Service, Arn, Tags, Where in Index.ScanTaggingApi(Names, Region, Account):
+                if Service != 'ec2':
+                    Index.Put(Service, Arn, Tags, Where)
+
+    def List(self, Service, Lister, Region, Account, Identity, Regions):
+        """Page through a list of a service in a region and write a row per resource; returns number of resources"""
+
+        Adapter = GetAdapter(Service)
+        AccountId, Partition = Identity
+        Index = self.__Indexes.get(Account)
+        Client = self.Pool.GetClient(Service, Region, self.Profile, Account=Account)
+        Count = 0
+        for Page in self.GetPages(Client, Service, Region, Lister):
+            Rows = []
+            for Id, Where in Lister.ParseResources(Page):
+                Where = Where or Region
+                ### a list of every region names resources of regions which are not discovered
+                if Lister.RegionKey and Where not in Regions:
+                    continue
+                ResourceId = Lister.GetResourceId(Id, Where, AccountId, Partition)
+                Tags = Index.GetTags(Service, ResourceId, Where) if Index else None
+                Rows.append([Adapter.CsvNames[0], ResourceId, '0',
+                             'global' if Adapter.Global and not Lister.RegionKey else Where, AccountId] \
+                            + [(Tags or {}).get(AwsTagName, 'Unknown') for AwsTagName in self.TagColumns])
+            self.Write(Rows)
+            Count += len(Rows)
+
+        return Count
+
+    def GetPages(self, Client, Service, Region, Lister):
+        """Yield the response pages of a list, each call paced by the limiter of the service and region"""
+
+        if not Lister.Paginated:
+            with self.__Lock:
+                self.CallsCount += 1
+            yield Call(Service, Region, getattr(Client, Lister.Method), **Lister.Extra)
+            return
+
+        ### botocore retries throttled pages itself, and the client hook of aws.ratelimit slows the limiter down
+        Limiters = GetLimiters()
+        Limiter = Limiters.GetLimiter(Service, Region) if Limiters else None
+        Pages = iter(Client.get_paginator(Lister.Method).paginate(**Lister.Extra))
+        while True:
+            if Limiter:
+                Limiter.Acquire()
+            Page = next(Pages, None)
+            if Page is None:
+                return
+            if Limiter:
+                Limiter.OnSuccess()
+            with self.__Lock:
+                self.CallsCount += 1
+            yield Page
+
+    def Report(self, Key, Future):
+        """Count and log a finished list"""
+
+        Service, Method, Region, Account = Key
+        Where = 'Service=' + Service + ' Method=' + Method + ' Region=' + Region + ' Account=' + str(Account or 'base')
+        try:
+            Count = Future.result()
+        except Exception as e:
+            with self.__Lock:
+                self.Failed += 1
+            self.L.TeeLog('Discover: failed to list ' + Where + ': ' + str(e), 1)
+            return
+
+        with self.__Lock:
+            self.Lists += 1
+            Number = self.Lists
+        self.L.TeeLog('Discover: ' + Where + ' Resources=' + str(Count), 0, Number)
+
+    def Open(self):
+        """Open the report, csv or csv.gz by its name, and write its header"""
+
+        ### gzip's default level 9 costs twice the time of level 6 for a slightly smaller file
+        if self.FileName.endswith('.gz'):
+            self.__File = gzip.open(self.FileName, 'wt', newline='', compresslevel=6)
+        else:
+            self.__File = open(self.FileName, 'w', newline='')
+        self.__Writer = csv.writer(self.__File)
+        self.__Writer.writerow(ReportColumns + list(self.TagColumns.values()))
+
+    def Write(self, Rows):
+        """Write rows of (service, resource id, cost, region, account, tag values...) with a line item id each"""
+
+        with self.__Lock:
+            for Row in Rows:
+                self.Total += 1
+                self.__Writer.writerow(['discover-' + str(self.Total), self.__Started] + Row)
+
+    def Close(self):
+        """Close the report"""
+
+        with self.__Lock:
+            if self.__File:
+                self.__File.close()
+                self.__File = None
+
+    def GetCounts(self):
+        """Return counters as dictionary, i.e. for a progress line"""
+
+        return {'Total': self.Total, 'Lists': self.Lists, 'Failed': self.Failed}
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        TagCalls = sum(Index.CallsCount for Index in self.__Indexes.values())
+
+        return 'Discover: File=' + self.FileName + ' Resources=' + str(self.Total) + ' Lists=' + str(self.Lists) \
+               + ' Failed=' + str(self.Failed) + ' Calls=' + str(self.CallsCount) + ' TagScanCalls=' + str(TagCalls)
+
+if __name__ == '__main__':
+    import tempfile
+    from aws.fake import InstallFake, QuietLog
+    from services.cur import OpenReport
+
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    for Number in range(2500):
+        Fake.Put('ec2', 'i-%017x' % Number, {'Channel': 'web'} if Number % 2 else {})
+    for Number in range(300):
+        Fake.Put('dynamodb', 'arn:aws:dynamodb:eu-west-1:123456789012:table/t-%d' % Number, {})
+        Fake.Put('sqs', 'https://sqs.us-east-1.amazonaws.com/123456789012/q-%d' % Number, {})
+    Fake.Put('s3', 'arn:aws:s3:::bucket-1', {'Channel': 'api'}, 'eu-west-1')
+    Fake.Put('s3', 'bucket-2', {}, 'ap-south-1')
+    Fake.Put('route53', 'Z1', {})
+    Folder = tempfile.mkdtemp()
+    print('TEST 1: every service is listed in every region', end='')
+    FileName = os.path.join(Folder, 'inventory.csv.gz')
+    Discoverer = ResourceDiscoverer(QuietLog(), FileName, {'Channel': 'tag_channel'}, Workers=8)
+    Discoverer.Run(['us-east-1', 'eu-west-1'])
+    Rows = {ResourceId: (Service, Tags, Region) for Row, Service, ResourceId, Tags, Region, Account \
+            in OpenReport(FileName).ReadTagRows({'Channel': 'tag_channel'}, 'product_region')}
+    assert Discoverer.Total == 2500 + 600 + 2 and Discoverer.Failed == 0
+    assert Discoverer.Lists == len([Lister for Service in GetServiceNames() for Lister in GetAdapter(Service).Lists \
+                                    for Region in ([1] if GetAdapter(Service).Global or Lister.RegionKey else [1, 2])])
+    assert Rows['i-%017x' % 1] == ('ec2', {'Channel': 'web'}, 'us-east-1') and 'i-%017x' % 2 not in Rows
+    assert Rows['bucket-1'] == ('s3', {'Channel': 'api'}, 'eu-west-1') and len(Rows) == 1251
+    print('...OK')
+    print('TEST 2: ids are written in the form a report shows', end='')
+    Header = OpenReport(FileName).GetHeader()
+    assert Header == ReportColumns + ['tag_channel']
+    Ids = [Values[0] for Number, Values in OpenReport(FileName).ReadRows(['resource_id'])]
+    assert 'arn:aws:dynamodb:eu-west-1:123456789012:table/t-7' in Ids and 'Z1' in Ids and 'bucket-2' not in Ids
+    assert 'https://sqs.us-east-1.amazonaws.com/123456789012/q-7' in Ids and len(Ids) == len(set(Ids))
+    print('...OK')
+    print('TEST 3: all lists the enabled regions and no tag columns skip the tag scans', end='')
+    Calls = Fake.GetCalls()
+    Discoverer = ResourceDiscoverer(QuietLog(), os.path.join(Folder, 'inventory.csv'), Services=['s3', 'sqs'])
+    Discoverer.Run(['all'])
+    Calls = {Key: Count - Calls.get(Key, 0) for Key, Count in Fake.GetCalls().items() if Count > Calls.get(Key, 0)}
+    assert Discoverer.Total == 302 and ('resourcegroupstaggingapi', 'get_resources') not in Calls
+    assert Calls[('s3', 'list_buckets')] == 1 and Calls[('sqs', 'list_queues')] == 3
+    print('...OK')
@@ -0,0 +1,558 @@
+"""This module provides an in-memory stand-in for the AWS tagging apis, used by benchmarks and offline runs"""
+import datetime
+import os
+import random
+import sys
+import threading
+import time
+### run as a script, i.e. python3 helper/aws/fake.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from botocore.exceptions import ClientError
+from aws.client import SetClientFactory
+from aws.arn import IsArn, ParseArn, GetArnRegion
+from aws.registry import GetAdapter, GetArnServiceName, ToTagList, ToTagDict
+
+
+class FakeAws:
+    """Tags of every registered service kept in memory behind clients with configurable latency and failures
+
+    Clients answer the write, read, untag and list methods of the service registry, i.e.
+    create_tags or list_tags_for_resource, shaped by each adapter's parameters, plus
+    describe_regions of ec2, tag_resources, untag_resources and get_resources of
+    resourcegroupstaggingapi, the paginators prefetch uses, and the get_caller_identity
+    and assume_role of sts, answering as Account. Every call sleeps Latency seconds plus up to Jitter, fails with
+    Throttling once its (service, region) exceeds Rate calls in a second or with
+    probability ThrottleRate, and with InternalError with probability ErrorRate. A
+    resource exists as soon as it is named, until Delete() makes every write, read and
+    untag naming it fail as a whole like a call naming a missing or malformed id does.
+    Pass CreateClient to aws.client.SetClientFactory(), or call InstallFake(), to route every pool through it.
+    """
+
+    ### parameter carrying the page token of each paginated method
+    __TokenParams = {'get_resources': 'PaginationToken'}
+
+    def __init__(self, Latency=0.0, Jitter=0.0, Rate=None, ThrottleRate=0.0, ErrorRate=0.0, Region='us-east-1',
+                 Seed=None, Account='123456789012'):
+        """Constructor"""
+
+        self.Latency = Latency
+        self.Jitter = Jitter
+        self.Rate = Rate
+        self.ThrottleRate = ThrottleRate
+        self.ErrorRate = ErrorRate
+        self.Region = Region
+        self.Account = Account
+        self.__Random = random.Random(Seed)
+        self.__Resources = {}
+        self.__Deleted = {}
+        self.__Calls = {}
+        self.__Windows = {}
+        self.__Lock = threading.Lock()
+
+    def CreateClient(self, Service, Region=None, Profile=None, Credentials=None):
+        """Return a client of the fake for a service and region"""
+
+        return FakeClient(self, Service, Region or self.Region)
+
+    def Put(self, Service, ResourceId, Tags, Region=None):
+        """Give a resource tags, i.e. to start a benchmark with part of the resources already tagged"""
+
+        with self.__Lock:
+            self.__Store(Service, Region or self.Region, ResourceId, Tags)
+
+    def Delete(self, Service, ResourceId, Region=None, Named=True):
+        """Make a resource missing; errors of calls naming it quote its id if Named, like ec2 does for ids which do
+        not exist, or do not, like for a malformed parameter"""
+
+        with self.__Lock:
+            Key = self.__GetKey(Service, Region or self.Region, ResourceId)
+            self.__Resources.pop(Key, None)
+            self.__Deleted[Key] = Named
+
+    def GetTags(self, Service, ResourceId, Region=None):
+        """Return tags of a resource as dictionary, or None if it was never tagged"""
+
+        Entry = self.__Resources.get(self.__GetKey(Service, Region or self.Region, ResourceId))
+
+        return dict(Entry[0]) if Entry else None
+
+    def GetCalls(self):
+        """Return dictionary of (service, method) to number of calls, failed ones included"""
+
+        with self.__Lock:
+            return dict(self.__Calls)
+
+    def GetCallsCount(self):
+        """Return number of calls"""
+
+        return sum(self.GetCalls().values())
+
+    def Invoke(self, Service, Region, Method, Params):
+        """Serve one call: count it, wait, maybe fail, then read or write tags"""
+
+        with self.__Lock:
+            self.__Calls[(Service, Method)] = self.__Calls.get((Service, Method), 0) + 1
+            Throttled = self.__IsThrottled(Service, Region)
+            Failed = not Throttled and self.__Random.random() < self.ErrorRate
+            Wait = self.Latency + self.__Random.random() * self.Jitter
+
+        if Wait > 0:
+            time.sleep(Wait)
+        if Throttled:
+            raise GetError(Method, 'Throttling', 'Rate exceeded', 400)
+        if Failed:
+            raise GetError(Method, 'InternalError', 'Injected failure', 500)
+
+        with self.__Lock:
+            Response = self.__Serve(Service, Region, Method, Params)
+        Response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+
+        return Response
+
+    def GetTokenParam(self, Method):
+        """Return the parameter name of the page token of a paginated method"""
+
+        return FakeAws.__TokenParams.get(Method, 'NextToken')
+
+    def __IsThrottled(self, Service, Region):
+        """Return True if a call exceeds the rate of its service and region; caller holds the lock"""
+
+        if self.ThrottleRate and self.__Random.random() < self.ThrottleRate:
+            return True
+        if not self.Rate:
+            return False
+
+        Second = int(time.monotonic())
+        Window = self.__Windows.get((Service, Region))
+        if Window is None or Window[0] != Second:
+            Window = [Second, 0]
+            self.__Windows[(Service, Region)] = Window
+        Window[1] += 1
+
+        return Window[1] > self.Rate
+
+    def __GetKey(self, Service, Region, ResourceId):
+        """Return the key of a resource in the form its service's api names it"""
+
+        Adapter = GetAdapter(Service)
+        Id = Adapter.GetId(ResourceId) if Adapter else ResourceId
+
+        return (Service, GetArnRegion(ResourceId) or Region, Id)
+
+    def __Store(self, Service, Region, ResourceId, Tags, Replace=False):
+        """Merge or replace tags of a resource, remembering its ARN; caller holds the lock"""
+
+        Key = self.__GetKey(Service, Region, ResourceId)
+        Entry = self.__Resources.setdefault(Key, [{}, None])
+        if Replace:
+            Entry[0] = {}
+        Entry[0].update(Tags)
+        if IsArn(ResourceId):
+            Entry[1] = ResourceId
+
+    def __CheckIds(self, Service, Region, Method, Ids):
+        """Fail a call naming a deleted resource; caller holds the lock"""
+
+        Missing = {}
+        for Id in Ids:
+            Key = self.__GetKey(Service, Region, Id)
+            if Key in self.__Deleted:
+                Missing[Id] = self.__Deleted[Key]
+        if not Missing:
+            return
+        if not all(Missing.values()):
+            raise GetError(Method, 'InvalidParameterValue', 'Invalid value for parameter', 400)
+        if Service == 'ec2':
+            raise GetError(Method, 'InvalidID.NotFound', "The IDs '" + ', '.join(Missing) + "' do not exist", 400)
+
+        raise GetError(Method, 'ResourceNotFoundException', "Resource '" + ', '.join(Missing) + "' not found", 400)
+
+    def __Remove(self, Service, Region, ResourceId, TagNames):
+        """Drop tag names of a resource; caller holds the lock"""
+
+        Entry = self.__Resources.get(self.__GetKey(Service, Region, ResourceId))
+        for TagName in TagNames if Entry else ():
+            Entry[0].pop(TagName, None)
+
+    def __Serve(self, Service, Region, Method, Params):
+        """Read or write tags for a call; caller holds the lock"""
+
+        if Service == 'resourcegroupstaggingapi':
+            return self.__ServeTaggingApi(Region, Method, Params)
+        if Service == 'sts':
+            return self.__ServeSts(Method, Params)
+
+        Adapter = GetAdapter(Service)
+        if Adapter is None:
+            raise GetError(Method, 'UnknownService', 'Service ' + Service + ' is not faked', 400)
+
+        ### route53 adds and removes tags with the same method
+        if Method == Adapter.Untag and Adapter.UntagParam in Params:
+            Ids = Params[Adapter.IdParam] if Adapter.IdList else [Params[Adapter.IdParam]]
+            Keys = Params[Adapter.UntagParam]
+            if Adapter.UntagWrap:
+                Keys = Keys[Adapter.UntagWrap]
+            Keys = [Key[Adapter.UntagKey] for Key in Keys] if Adapter.UntagKey else Keys
+            self.__CheckIds(Service, Region, Method, Ids)
+            for Id in Ids:
+                self.__Remove(Service, Region, Id, Keys)
+            return {}
+
+        if Method == Adapter.UntagAll:
+            Entry = self.__Resources.get(self.__GetKey(Service, Region, Params[Adapter.IdParam]))
+            if Entry:
+                Entry[0] = {}
+            return {}
+
+        if Method == Adapter.Write:
+            Ids = Params[Adapter.IdParam] if Adapter.IdList else [Params[Adapter.IdParam]]
+            Tags = Params[Adapter.TagsParam]
+            if Adapter.TagWrap:
+                Tags = Tags[Adapter.TagWrap]
+            Tags = dict(Tags) if Adapter.TagKeys is None else ToTagDict(Tags, *Adapter.TagKeys)
+            self.__CheckIds(Service, Region, Method, Ids)
+            for Id in Ids:
+                self.__Store(Service, Region, Id, Tags, Adapter.ReplacesTagSet)
+            return {}
+
+        for Lister in Adapter.Lists:
+            if Method == Lister.Method:
+                return self.__ServeList(Service, Region, Lister, Params)
+        if Method == 'describe_regions':
+            Regions = sorted(set(Where for (Name, Where, Id) in self.__Resources) | {self.Region})
+            return {'Regions': [{'RegionName': Where} for Where in Regions]}
+
+        if Method == Adapter.Read and Adapter.ReadFilter:
+            return self.__ServeDescribeTags(Service, Region, Params)
+
+        if Method != Adapter.Read:
+            raise GetError(Method, 'InvalidAction', Method + ' is not the tagging api of ' + Service, 400)
+
+        Ids = Params[Adapter.ReadIdParam] if Adapter.ReadIdList else [Params[Adapter.ReadIdParam]]
+        self.__CheckIds(Service, Region, Method, Ids)
+        Found = []
+        for Id in Ids:
+            Entry = self.__Resources.get(self.__GetKey(Service, Region, Id))
+            Tags = Entry[0] if Entry else {}
+            if not Tags and Adapter.EmptyCodes:
+                raise GetError(Method, Adapter.EmptyCodes[0], 'The resource has no tags', 404)
+            Tags = dict(Tags) if Adapter.ReadKeys is None else ToTagList(Tags, *Adapter.ReadKeys)
+            Found.append({Adapter.ReadIdKey: Id, Adapter.ReadEach: Tags} if Adapter.ReadEach else Tags)
+
+        Response = Found if Adapter.ReadEach else Found[0]
+        for Key in reversed(Adapter.ReadPath):
+            Response = {Key: Response}
+
+        return Response
+
+    def __ServeList(self, Service, Region, Lister, Params):
+        """Answer a list method of the registry with the resources of the service in the region, or in every region
+        for lists naming the region of each resource; ids are named as the real list names them"""
+
+        Prefix = Lister.GetResourceId('', Region, self.Account) if Lister.Arn else None
+        Found = []
+        ### resources of the fake have no type, so the first list of a service names them all
+        Resources = sorted(self.__Resources.items()) if Lister is GetAdapter(Service).Lists[0] else []
+        for (Name, Where, Id), (Tags, Arn) in Resources:
+            if Name != Service or Where != Region and not Lister.RegionKey:
+                continue
+            Id = Id[len(Prefix):] if Prefix and Id.startswith(Prefix) else Id
+            Entry = {Lister.IdKey: Id} if Lister.IdKey else Id
+            if Lister.RegionKey:
+                Entry[Lister.RegionKey] = Where
+            Found.append(Entry)
+
+        ### only flat lists come in pages
+        if len(Lister.Path) == 1:
+            return GetPage({Lister.Path[0]: Found}, Lister.Path[0], Params.get('MaxResults', 1000),
+                           Params.get('NextToken'), 'NextToken')
+        Response = Found
+        for Key in reversed(Lister.Path):
+            Response = {Key: Response}
+
+        return Response
+
+    def __ServeSts(self, Method, Params):
+        """Answer get_caller_identity as Account and assume_role with credentials valid for its duration"""
+
+        if Method == 'get_caller_identity':
+            return {'Account': self.Account, 'Arn': 'arn:aws:iam::' + self.Account + ':user/fake'}
+        if Method == 'assume_role':
+            Expiration = datetime.datetime.now(datetime.timezone.utc) \
+                         + datetime.timedelta(seconds=Params.get('DurationSeconds', 3600))
+            return {'Credentials': {'AccessKeyId': 'ASIA' + Params['RoleArn'].split(':')[4], 'SecretAccessKey': 'fake',
+                                    'SessionToken': 'fake', 'Expiration': Expiration}}
+
+        raise GetError(Method, 'InvalidAction', Method + ' is not faked for sts', 400)
+
+    def __ServeDescribeTags(self, Service, Region, Params):
+        """Answer ec2 style describe_tags with resource-id and key filters, one page at a time"""
+
+        Filters = {Filter['Name']: Filter['Values'] for Filter in Params.get('Filters', [])}
+        Ids = Filters.get('resource-id')
+        Keys = Filters.get('key')
+        if Ids is None:
+            Ids = [Id for (Name, Where, Id) in self.__Resources if Name == Service and Where == Region]
+
+        Tags = []
+        for Id in Ids:
+            Entry = self.__Resources.get(self.__GetKey(Service, Region, Id))
+            for TagName, TagValue in (Entry[0] if Entry else {}).items():
+                if Keys is None or TagName in Keys:
+                    Tags.append({'ResourceId': Id, 'ResourceType': 'instance', 'Key': TagName, 'Value': TagValue})
+
+        return GetPage({'Tags': Tags}, 'Tags', Params.get('MaxResults', 1000), Params.get('NextToken'), 'NextToken')
+
+    def __ServeTaggingApi(self, Region, Method, Params):
+        """Answer tag_resources and get_resources of the Resource Groups Tagging API"""
+
+        if Method == 'tag_resources':
+            for Arn in Params['ResourceARNList']:
+                self.__Store(GetArnServiceName(ParseArn(Arn)['Service']), Region, Arn, Params['Tags'])
+            return {'FailedResourcesMap': {}}
+
+        if Method == 'untag_resources':
+            for Arn in Params['ResourceARNList']:
+                self.__Remove(GetArnServiceName(ParseArn(Arn)['Service']), Region, Arn, Params['TagKeys'])
+            return {'FailedResourcesMap': {}}
+
+        if Method != 'get_resources':
+            raise GetError(Method, 'InvalidAction', Method + ' is not faked', 400)
+
+        Keys = [Filter['Key'] for Filter in Params.get('TagFilters', [])]
+        Mappings = [{'ResourceARN': Arn, 'Tags': ToTagList(Tags)} for (Service, Where, Id), (Tags, Arn) \
+                    in sorted(self.__Resources.items()) if Arn and Where == Region and all(Key in Tags for Key in Keys)]
+
+        return GetPage({'ResourceTagMappingList': Mappings}, 'ResourceTagMappingList',
+                       Params.get('ResourcesPerPage', 100), Params.get('PaginationToken'), 'PaginationToken')
+
+
+class FakeClient:
+    """Client of FakeAws; any boto3 method name is served by the fake, with botocore's call events emitted"""
+
+    def __init__(self, Backend, Service, Region):
+        """Constructor"""
+
+        self.Service = Service
+        self.Backend = Backend
+        self.meta = FakeMeta(Region)
+
+    def __getattr__(self, Method):
+        """Return a boto3 style method taking keyword arguments"""
+
+        if Method.startswith('_'):
+            raise AttributeError(Method)
+
+        return lambda **Params: self.Call(Method, Params)
+
+    def get_paginator(self, Method):
+        """Return a boto3 style paginator"""
+
+        return FakePaginator(self, Method)
+
+    def Call(self, Method, Params):
+        """Serve a call, emitting before-call, needs-retry on failure, and after-call like botocore"""
+
+        Model = FakeOperation(Method)
+        Context = {}
+        Events = self.meta.events
+        Events.emit('before-call.' + self.Service + '.' + Model.name, model=Model, params=Params, context=Context)
+        try:
+            Response = self.Backend.Invoke(self.Service, self.meta.region_name, Method, Params)
+        except ClientError as c:
+            Events.emit('needs-retry.' + self.Service + '.' + Model.name, response=(None, c.response), attempts=1,
+                        operation=Model, caught_exception=None, request_dict={'context': Context})
+            Events.emit('after-call.' + self.Service + '.' + Model.name, http_response=None, parsed=c.response,
+                        model=Model, context=Context)
+            raise
+        Events.emit('after-call.' + self.Service + '.' + Model.name, http_response=None, parsed=Response,
+                    model=Model, context=Context)
+
+        return Response
+
+
+class FakePaginator:
+    """Paginator of a FakeClient method"""
+
+    def __init__(self, Client, Method):
+        """Constructor"""
+
+        self.Client = Client
+        self.Method = Method
+
+    def paginate(self, PaginationConfig=None, **Params):
+        """Yield every page, one call each"""
+
+        TokenParam = self.Client.Backend.GetTokenParam(self.Method)
+        PageSize = (PaginationConfig or {}).get('PageSize')
+        if PageSize:
+            Params['MaxResults'] = PageSize
+        while True:
+            Page = self.Client.Call(self.Method, Params)
+            yield Page
+            if not Page.get(TokenParam):
+                return
+            Params = dict(Params, **{TokenParam: Page[TokenParam]})
+
+
+class FakeMeta:
+    """The meta attribute of a client: region and event emitter"""
+
+    def __init__(self, Region):
+        """Constructor"""
+
+        self.region_name = Region
+        self.events = FakeEvents()
+
+
+class FakeEvents:
+    """Event emitter where a handler registered for a.b also gets a.b.c, like botocore's"""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.__Handlers = []
+
+    def register(self, EventName, Handler, unique_id=None):
+        """Add a handler"""
+
+        self.__Handlers.append((EventName.split('.'), Handler))
+
+    def emit(self, EventName, **kwargs):
+        """Call every handler of the event and return their (handler, result) list"""
+
+        Parts = EventName.split('.')
+
+        return [(Handler, Handler(event_name=EventName, **kwargs)) for Prefix, Handler in self.__Handlers \
+                if Parts[:len(Prefix)] == Prefix]
+
+
+class FakeOperation:
+    """Operation model with the api name of a boto3 method, i.e. CreateTags for create_tags"""
+
+    def __init__(self, Method):
+        """Constructor"""
+
+        self.name = ''.join(Part.capitalize() for Part in Method.split('_'))
+
+
+class LocalBody:
+    """Raw body of a response answered locally"""
+
+    def __init__(self, Body):
+        """Constructor"""
+
+        self.Body = Body
+
+    def stream(self, **kwargs):
+        """Yield the body, as urllib3 responses do"""
+
+        yield self.Body
+
+
+def AnswerLocally(Client, Service, Region=None):
+    """Client pool hook which answers every request of a real botocore client with an empty success response
+    instead of sending it, so a benchmark times botocore's own work: models, serializing, signing and parsing"""
+
+    from botocore.awsrequest import AWSResponse
+    Body = b'{}' if 'json' in Client.meta.service_model.protocol else b'<Response></Response>'
+
+    def OnSend(request, **kwargs):
+        return AWSResponse(request.url, 200, {}, LocalBody(Body))
+
+    Client.meta.events.register('before-send', OnSend)
+
+def GetError(Method, Code, Message, StatusCode):
+    """Return a ClientError as botocore raises it"""
+
+    return ClientError({'Error': {'Code': Code, 'Message': Message},
+                        'ResponseMetadata': {'HTTPStatusCode': StatusCode}}, FakeOperation(Method).name)
+
+def GetPage(Response, ListKey, PageSize, Token, TokenParam):
+    """Return one page of the list of a response, with the token of the next page if there is one"""
+
+    Start = int(Token or 0)
+    Items = Response[ListKey]
+    Page = {ListKey: Items[Start:Start + PageSize]}
+    if Start + PageSize < len(Items):
+        Page[TokenParam] = str(Start + PageSize)
+
+    return Page
+
+def InstallFake(**Options):
+    """Create a FakeAws with Options, route every client pool through it and return it"""
+
+    Fake = FakeAws(**Options)
+    SetClientFactory(Fake.CreateClient)
+
+    return Fake
+
+class QuietLog:
+    """Log which keeps the messages of TeeLog in memory instead of printing them, i.e. for self-tests"""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.Records = []
+
+    def TeeLog(self, Msg, Level=0, Row=None):
+        """Keep a record"""
+
+        self.Records.append(Msg)
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: write and read tags with the methods of the registry', end='')
+    Fake = FakeAws()
+    Fake.CreateClient('ec2').create_tags(**GetAdapter('ec2').GetWriteParams(['i-1', 'i-2'], {'Channel': 'web'}))
+    Response = Fake.CreateClient('ec2').describe_tags(**GetAdapter('ec2').GetReadParams(['i-2']))
+    assert GetAdapter('ec2').ParseTags(Response) == {'Channel': 'web'}
+    Arn = 'arn:aws:dynamodb:us-east-1:123456789012:table/t'
+    Fake.CreateClient('resourcegroupstaggingapi').tag_resources(ResourceARNList=[Arn], Tags={'Owner': 'ops'})
+    Response = Fake.CreateClient('dynamodb').list_tags_of_resource(**GetAdapter('dynamodb').GetReadParams([Arn]))
+    assert GetAdapter('dynamodb').ParseTags(Response) == {'Owner': 'ops'} and Fake.GetCallsCount() == 4
+    print('...OK')
+    print('TEST 2: remove tags with the untag methods of the registry', end='')
+    Fake.CreateClient('ec2').delete_tags(**GetAdapter('ec2').GetUntagParams(['i-1'], ['Channel']))
+    Fake.CreateClient('resourcegroupstaggingapi').untag_resources(ResourceARNList=[Arn], TagKeys=['Owner'])
+    assert Fake.GetTags('ec2', 'i-1') == {} and Fake.GetTags('ec2', 'i-2') == {'Channel': 'web'}
+    assert Fake.GetTags('dynamodb', Arn) == {}
+    print('...OK')
+    print('TEST 3: list resources with the list methods of the registry', end='')
+    Fake.Put('s3', 'bucket-1', {}, 'eu-west-1')
+    Lister = GetAdapter('dynamodb').Lists[0]
+    assert Lister.ParseResources(Fake.CreateClient('dynamodb').list_tables()) == [('t', None)]
+    Response = Fake.CreateClient('s3').list_buckets()
+    assert GetAdapter('s3').Lists[0].ParseResources(Response) == [('bucket-1', 'eu-west-1')]
+    Response = Fake.CreateClient('ec2').describe_instances()
+    assert sorted(Id for Id, Region in GetAdapter('ec2').Lists[0].ParseResources(Response)) == ['i-1', 'i-2']
+    print('...OK')
+    print('TEST 4: inject throttling', end='')
+    Client = FakeAws(ThrottleRate=1.0).CreateClient('kms')
+    try:
+        Client.tag_resource(**GetAdapter('kms').GetWriteParams(['k'], {'A': 'b'}))
+        Code = None
+    except ClientError as c:
+        Code = c.response['Error']['Code']
+    assert Code == 'Throttling'
+    print('...OK')
+    print('TEST 5: answer sts as the base account', end='')
+    Client = FakeAws(Account='111111111111').CreateClient('sts')
+    assert Client.get_caller_identity()['Account'] == '111111111111'
+    assert Client.assume_role(RoleArn='arn:aws:iam::222222222222:role/r', RoleSessionName='s')['Credentials'] \
+           ['AccessKeyId'] == 'ASIA222222222222'
+    print('...OK')
+    print('TEST 6: calls naming a deleted resource fail as a whole', end='')
+    Fake = FakeAws()
+    Fake.Delete('ec2', 'i-2')
+    Fake.Delete('ec2', 'i-3', Named=False)
+    Codes = []
+    for Ids in (['i-1', 'i-2'], ['i-1', 'i-3']):
+        try:
+            Fake.CreateClient('ec2').create_tags(**GetAdapter('ec2').GetWriteParams(Ids, {'Channel': 'web'}))
+        except ClientError as c:
+            Codes.append((c.response['Error']['Code'], "'i-2'" in c.response['Error']['Message']))
+    assert Codes == [('InvalidID.NotFound', True), ('InvalidParameterValue', False)]
+    assert Fake.GetTags('ec2', 'i-1') is None
+    print('...OK')
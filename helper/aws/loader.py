@@ -0,0 +1,70 @@
+"""This module provides a botocore loader which reads only the models of the services in use"""
+import threading
+from botocore.exceptions import DataNotFoundError
+from botocore.loaders import Loader
+
+
+class ServiceLoader(Loader):
+    """Loader which finds a service model in the folder of its service alone
+
+    botocore's Loader lists the folder of every service it knows, several hundred, before
+    it loads the first model, only to tell whether the service exists. While this loader
+    loads a model, the known services are the one being loaded if its folder holds the
+    model; only an unknown service lists them all, so it raises UnknownServiceError like
+    botocore does. Models are cached by the loader, so sessions sharing one loader read
+    each model and the endpoint data once per process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Constructor"""
+
+        super().__init__(*args, **kwargs)
+        self.__Loading = threading.local()
+
+    def load_service_model(self, service_name, type_name, api_version=None):
+        """Return a model, i.e. service-2 or paginators-1, of a service, loading its extras too"""
+
+        self.__Loading.Service = service_name
+        try:
+            return super().load_service_model(service_name, type_name, api_version)
+        finally:
+            self.__Loading.Service = None
+
+    def list_available_services(self, type_name):
+        """Return the service being loaded if it has a model of the type, otherwise every known service"""
+
+        Service = getattr(self.__Loading, 'Service', None)
+        if Service is not None:
+            try:
+                self.determine_latest_version(Service, type_name)
+                return [Service]
+            except DataNotFoundError:
+                pass
+
+        return super().list_available_services(type_name)
+
+if __name__ == '__main__':
+    import time
+    from botocore.exceptions import UnknownServiceError
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: models equal those of the botocore loader', end='')
+    assert ServiceLoader().load_service_model('ec2', 'service-2') == Loader().load_service_model('ec2', 'service-2')
+    print('...OK')
+    print('TEST 2: unknown services raise UnknownServiceError naming the known ones', end='')
+    try:
+        ServiceLoader().load_service_model('no-such-service', 'service-2')
+        assert False
+    except UnknownServiceError as e:
+        assert 'ec2' in str(e)
+    print('...OK')
+    print('TEST 3: a model is read once', end='')
+    Shared = ServiceLoader()
+    Shared.load_service_model('sqs', 'service-2')
+    Started = time.perf_counter()
+    assert Shared.load_service_model('sqs', 'service-2') and time.perf_counter() - Started < 0.001
+    print('...OK')
+    print('TEST 4: loading a model does not list every service', end='')
+    Listed = []
+    Loader.list_available_services = lambda self, type_name: Listed.append(type_name) or []
+    assert ServiceLoader().load_service_model('kms', 'service-2') and not Listed
+    print('...OK')
@@ -0,0 +1,322 @@
+"""This module provides per-call metrics of AWS API calls with JSON and Prometheus textfile export"""
+import json
+import os
+import sys
+import threading
+import time
+### run as a script, i.e. python3 helper/aws/metrics.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.client import RegisterClientHook
+from aws.ratelimit import ThrottlingCodes
+
+### upper bounds in seconds of the latency histogram buckets; the last bucket is +Inf
+LatencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, i.e. Prometheus style"""
+
+    def __init__(self, Buckets=LatencyBuckets):
+        """Constructor"""
+
+        self.Buckets = Buckets
+        self.Counts = [0] * (len(Buckets) + 1)
+        self.Sum = 0.0
+        self.Count = 0
+
+    def Observe(self, Value):
+        """Add one value"""
+
+        Index = 0
+        while Index < len(self.Buckets) and Value > self.Buckets[Index]:
+            Index += 1
+        self.Counts[Index] += 1
+        self.Sum += Value
+        self.Count += 1
+
+    def GetQuantile(self, Quantile):
+        """Return the upper bound of the bucket holding the quantile, or None if empty or in the +Inf bucket"""
+
+        if not self.Count:
+            return None
+
+        Rank = Quantile * self.Count
+        Total = 0
+        for Index, Count in enumerate(self.Counts):
+            Total += Count
+            if Total >= Rank:
+                return self.Buckets[Index] if Index < len(self.Buckets) else None
+
+        return None
+
+
+class CallMetrics:
+    """Counters and latency histograms of AWS calls keyed by (service, region, operation)
+
+    Every client of the client pool reports each call through botocore events: its latency
+    from before-call to after-call, including retries made inside botocore, the retries
+    and throttles seen on the way, and its outcome, i.e. ok, throttled or the error code.
+    Each attempt made by the rate limiter is a call of its own. Reports are written as
+    json and as a Prometheus textfile, periodically and on Stop(); both are replaced
+    atomically so a collector never reads half a file.
+    """
+
+    def __init__(self, JsonFileName=None, PromFileName=None, Interval=60.0, Limiters=None):
+        """Constructor"""
+
+        self.JsonFileName = JsonFileName
+        self.PromFileName = PromFileName
+        self.Interval = Interval
+        self.Limiters = Limiters
+        self.__Calls = {}
+        self.__Lock = threading.Lock()
+        self.__Stop = threading.Event()
+        self.__Thread = None
+        self.__Started = time.time()
+
+    def Record(self, Service, Region, Operation, Seconds, Outcome='ok', Retries=0, Throttles=0):
+        """Count one call"""
+
+        Key = (Service, Region or '', Operation)
+        with self.__Lock:
+            Entry = self.__Calls.get(Key)
+            if Entry is None:
+                Entry = {'Outcomes': {}, 'Retries': 0, 'Throttles': 0, 'Latency': Histogram()}
+                self.__Calls[Key] = Entry
+            Entry['Outcomes'][Outcome] = Entry['Outcomes'].get(Outcome, 0) + 1
+            Entry['Retries'] += Retries
+            Entry['Throttles'] += Throttles
+            Entry['Latency'].Observe(Seconds)
+
+    def Merge(self, Calls):
+        """Add the calls of a report of another process, i.e. of a worker process, to these metrics"""
+
+        with self.__Lock:
+            for Call in Calls:
+                Key = (Call['service'], Call['region'], Call['operation'])
+                Entry = self.__Calls.get(Key)
+                if Entry is None:
+                    Entry = {'Outcomes': {}, 'Retries': 0, 'Throttles': 0, 'Latency': Histogram()}
+                    self.__Calls[Key] = Entry
+                for Outcome, Count in Call['outcomes'].items():
+                    Entry['Outcomes'][Outcome] = Entry['Outcomes'].get(Outcome, 0) + Count
+                Entry['Retries'] += Call['retries']
+                Entry['Throttles'] += Call['throttles']
+                Latency = Entry['Latency']
+                Latency.Counts = [Count + Other for Count, Other in zip(Latency.Counts, Call['buckets'].values())]
+                Latency.Sum += Call['seconds']
+                Latency.Count += Call['calls']
+
+    def GetReport(self):
+        """Return the metrics as a json-friendly dictionary"""
+
+        Calls = []
+        with self.__Lock:
+            for (Service, Region, Operation), Entry in sorted(self.__Calls.items()):
+                Latency = Entry['Latency']
+                Calls.append({'service': Service, 'region': Region, 'operation': Operation,
+                              'calls': Latency.Count, 'outcomes': dict(Entry['Outcomes']),
+                              'retries': Entry['Retries'], 'throttles': Entry['Throttles'],
+                              'seconds': round(Latency.Sum, 6),
+                              'p50': Latency.GetQuantile(0.5), 'p90': Latency.GetQuantile(0.9),
+                              'p99': Latency.GetQuantile(0.99),
+                              'buckets': dict(zip([str(Bound) for Bound in Latency.Buckets] + ['+Inf'],
+                                                  Latency.Counts))})
+
+        Limiters = []
+        if self.Limiters:
+            Rates = sorted(self.Limiters.GetRates().items(), key=lambda x: str(x[0]))
+            for (Service, Region), (Rate, SafeRate, Count, Throttles, Wait) in Rates:
+                Limiters.append({'service': Service, 'region': Region or '', 'rate': round(Rate, 3),
+                                 'safe_rate': round(SafeRate, 3), 'calls': Count, 'throttles': Throttles,
+                                 'wait_seconds': round(Wait, 3)})
+
+        return {'started': self.__Started, 'updated': time.time(), 'calls': Calls, 'limiters': Limiters}
+
+    def GetPrometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+
+        Report = self.GetReport()
+        Lines = ['# HELP aws_tagging_calls_total AWS API calls by outcome',
+                 '# TYPE aws_tagging_calls_total counter']
+        for Call in Report['calls']:
+            for Outcome, Count in sorted(Call['outcomes'].items()):
+                Lines.append('aws_tagging_calls_total' + GetLabels(Call, outcome=Outcome) + ' ' + str(Count))
+        for Name, Help in (('retries', 'Retries made inside botocore'), ('throttles', 'Throttling responses')):
+            Lines += ['# HELP aws_tagging_' + Name + '_total ' + Help, '# TYPE aws_tagging_' + Name + '_total counter']
+            for Call in Report['calls']:
+                Lines.append('aws_tagging_' + Name + '_total' + GetLabels(Call) + ' ' + str(Call[Name]))
+        Lines += ['# HELP aws_tagging_call_seconds Latency of AWS API calls including retries',
+                  '# TYPE aws_tagging_call_seconds histogram']
+        for Call in Report['calls']:
+            Total = 0
+            for Bound, Count in Call['buckets'].items():
+                Total += Count
+                Lines.append('aws_tagging_call_seconds_bucket' + GetLabels(Call, le=Bound) + ' ' + str(Total))
+            Lines.append('aws_tagging_call_seconds_sum' + GetLabels(Call) + ' ' + repr(Call['seconds']))
+            Lines.append('aws_tagging_call_seconds_count' + GetLabels(Call) + ' ' + str(Call['calls']))
+        for Name, Type, Help in (('rate', 'gauge', 'Current calls per second allowed by the rate limiter'),
+                                 ('safe_rate', 'gauge', 'Rate in effect after the latest throttle'),
+                                 ('wait_seconds', 'counter', 'Seconds calls waited for the rate limiter')):
+            Metric = 'aws_tagging_limiter_' + Name + ('_total' if Type == 'counter' else '')
+            Lines += ['# HELP ' + Metric + ' ' + Help, '# TYPE ' + Metric + ' ' + Type]
+            for Limiter in Report['limiters']:
+                Lines.append(Metric + GetLabels(Limiter) + ' ' + repr(Limiter[Name]))
+
+        return '\n'.join(Lines) + '\n'
+
+    def Write(self):
+        """Write the json report and the Prometheus textfile, whichever are enabled"""
+
+        if self.JsonFileName:
+            WriteAtomic(self.JsonFileName, json.dumps(self.GetReport(), indent=1))
+        if self.PromFileName:
+            WriteAtomic(self.PromFileName, self.GetPrometheus())
+
+    def Start(self):
+        """Write the reports every Interval seconds until stopped"""
+
+        if self.Interval and self.Interval > 0:
+            self.__Thread = threading.Thread(target=self.__Run, name='metrics-export', daemon=True)
+            self.__Thread.start()
+
+    def Stop(self):
+        """Stop periodic export and write the final reports"""
+
+        self.__Stop.set()
+        if self.__Thread:
+            self.__Thread.join()
+            self.__Thread = None
+        self.Write()
+
+    def GetSummary(self, Top=5):
+        """Return summary lines of the operations which spent the most time in AWS calls"""
+
+        Calls = sorted(self.GetReport()['calls'], key=lambda x: -x['seconds'])[:Top]
+
+        return ['Calls: Service=' + Call['service'] + ' Region=' + Call['region'] + ' Operation=' + Call['operation'] \
+                + ' Calls=' + str(Call['calls']) + ' Errors=' + str(Call['calls'] - Call['outcomes'].get('ok', 0)) \
+                + ' Throttles=' + str(Call['throttles']) + ' Retries=' + str(Call['retries']) \
+                + ' Seconds=' + '%.1f' % Call['seconds'] + ' p50<=' + FormatBound(Call['p50']) \
+                + ' p99<=' + FormatBound(Call['p99']) for Call in Calls]
+
+    def __Run(self):
+        """Write until stopped; an export failure must not stop tagging"""
+
+        while not self.__Stop.wait(self.Interval):
+            try:
+                self.Write()
+            except Exception:
+                pass
+
+
+def GetLabels(Entry, **Extra):
+    """Return Prometheus labels of a report entry, i.e. {service="ec2",region="us-east-1"}"""
+
+    Labels = [(Name, Entry[Name]) for Name in ('service', 'region', 'operation') if Name in Entry]
+    Labels += sorted(Extra.items())
+
+    return '{' + ','.join(Name + '="' + str(Value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') \
+                          + '"' for Name, Value in Labels) + '}'
+
+def FormatBound(Seconds):
+    """Return a histogram bucket bound as milliseconds, or +Inf"""
+
+    return '+Inf' if Seconds is None else '%gms' % (Seconds * 1000)
+
+def WriteAtomic(FileName, Text):
+    """Write a file through a temporary file renamed over it"""
+
+    with open(FileName + '.tmp', 'w') as f:
+        f.write(Text)
+    os.replace(FileName + '.tmp', FileName)
+
+def GetOutcome(Parsed):
+    """Return outcome of a parsed botocore response: ok, throttled or the error code"""
+
+    Code = (Parsed or {}).get('Error', {}).get('Code')
+    if not Code:
+        return 'ok'
+
+    return 'throttled' if Code in ThrottlingCodes else Code
+
+
+_Metrics = None
+
+def ConfigureMetrics(JsonFileName=None, PromFileName=None, Interval=60.0, Limiters=None):
+    """Enable metrics of every AWS call made through pool clients in this process and start periodic export"""
+
+    global _Metrics
+    _Metrics = CallMetrics(JsonFileName, PromFileName, Interval, Limiters)
+    _Metrics.Start()
+
+    return _Metrics
+
+def GetMetrics():
+    """Return the process-wide metrics, or None if metrics are disabled"""
+
+    return _Metrics
+
+def InstrumentClient(Client, Service, Region=None):
+    """Client pool hook which times every call of the client and records it in the process-wide metrics"""
+
+    Region = Region or Client.meta.region_name
+
+    ### the state of a call is kept in its botocore request context: start time, throttles, operation
+    def OnBeforeCall(model=None, context=None, **kwargs):
+        if _Metrics is not None and context is not None:
+            context['metrics'] = [time.monotonic(), 0, model.name]
+
+    def OnNeedsRetry(response=None, request_dict=None, **kwargs):
+        State = ((request_dict or {}).get('context') or {}).get('metrics')
+        if State is not None and response and response[1].get('Error', {}).get('Code') in ThrottlingCodes:
+            State[1] += 1
+
+    def OnAfterCall(parsed=None, context=None, **kwargs):
+        State = (context or {}).pop('metrics', None)
+        Metrics = _Metrics
+        if State is not None and Metrics is not None:
+            Retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            Metrics.Record(Service, Region, State[2], time.monotonic() - State[0], GetOutcome(parsed), Retries,
+                           State[1])
+
+    def OnAfterCallError(exception=None, context=None, **kwargs):
+        State = (context or {}).pop('metrics', None)
+        Metrics = _Metrics
+        if State is not None and Metrics is not None:
+            Metrics.Record(Service, Region, State[2], time.monotonic() - State[0], type(exception).__name__, 0,
+                           State[1])
+
+    Client.meta.events.register('before-call', OnBeforeCall)
+    Client.meta.events.register('needs-retry', OnNeedsRetry)
+    Client.meta.events.register('after-call', OnAfterCall)
+    Client.meta.events.register('after-call-error', OnAfterCallError)
+
+RegisterClientHook(InstrumentClient)
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: histogram quantiles are bucket bounds', end='')
+    Latency = Histogram()
+    for Value in [0.001] * 50 + [0.2] * 49 + [60]:
+        Latency.Observe(Value)
+    assert Latency.GetQuantile(0.5) == 0.005 and Latency.GetQuantile(0.99) == 0.25 and Latency.GetQuantile(1) is None
+    print('...OK')
+    print('TEST 2: Prometheus histogram buckets are cumulative', end='')
+    Metrics = CallMetrics()
+    Metrics.Record('ec2', 'us-east-1', 'CreateTags', 0.02)
+    Metrics.Record('ec2', 'us-east-1', 'CreateTags', 0.3, 'throttled', 2, 3)
+    Text = Metrics.GetPrometheus()
+    Labels = 'service="ec2",region="us-east-1",operation="CreateTags"'
+    assert 'aws_tagging_calls_total{' + Labels + ',outcome="throttled"} 1' in Text
+    assert 'aws_tagging_call_seconds_bucket{' + Labels + ',le="+Inf"} 2' in Text
+    assert 'aws_tagging_throttles_total{' + Labels + '} 3' in Text
+    print('...OK')
+    print('TEST 3: reports of worker processes add up', end='')
+    Total = CallMetrics()
+    Total.Record('ec2', 'us-east-1', 'CreateTags', 0.02)
+    Total.Merge(Metrics.GetReport()['calls'])
+    Call = Total.GetReport()['calls'][0]
+    assert Call['calls'] == 3 and Call['outcomes'] == {'ok': 2, 'throttled': 1} and Call['p99'] == 0.5
+    print('...OK')
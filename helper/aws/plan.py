@@ -0,0 +1,217 @@
+"""This module provides plan files: the minimal tag changes computed from live tags, and the API calls they need"""
+import json
+import os
+import sys
+import time
+### run as a script, i.e. python3 helper/aws/plan.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.arn import IsArn, GetBucketName
+from aws.registry import GetAdapter, GetResourceRegion
+from aws.account import GetResourceAccount
+from aws.tag import GetTags
+from aws.bulk import BulkTagger
+
+
+class TagPlanner:
+    """Compare desired tags with live tags and write only the differences to a plan file
+
+    A plan file holds one json object per line: a header, one entry per resource with the
+    tags to write, and a summary with the expected number of write calls per (service,
+    region) given how apply will batch them. Live tags come from the prefetched TagIndex
+    when it can answer and from GetTags(), i.e. the tag cache or AWS, otherwise. When
+    Overwrite is False a tag which exists is left alone; when True it is only written if
+    its value differs.
+    """
+
+    def __init__(self, FileName, Overwrite=False, Index=None, Ec2BatchSize=0, S3Merge=False, Bulk=False,
+                 Header=None):
+        """Constructor"""
+
+        self.FileName = FileName
+        self.Overwrite = Overwrite
+        self.Index = Index
+        self.Ec2BatchSize = Ec2BatchSize
+        self.S3Merge = S3Merge
+        self.Bulk = Bulk
+        self.Resources = 0
+        self.Unchanged = 0
+        self.Unverified = 0
+        self.__Calls = {}
+        self.__Groups = {}
+        self.__Buckets = set()
+        self.__File = open(FileName, 'w')
+        self.__Write(dict({'plan': 1, 'overwrite': Overwrite, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                          **(Header or {})))
+
+    def GetLiveTags(self, Service, ResourceId, TagNames, Region=None, Account=None):
+        """Return dictionary of the live values of the tag names the resource has"""
+
+        Region = GetResourceRegion(Service, ResourceId, Region)
+        Account = GetResourceAccount(ResourceId, Account)
+        ### the index only holds resources of the base account
+        if self.Index and Account is None:
+            Tags = self.Index.GetTags(Service, ResourceId, Region)
+            if Tags is not None and all(TagName in Tags for TagName in TagNames):
+                return {TagName: Tags[TagName] for TagName in TagNames}
+            Exists = [self.Index.IsTagExists(Service, ResourceId, TagName, Region) for TagName in TagNames]
+            if None not in Exists:
+                return {TagName: Tags[TagName] for TagName, Found in zip(TagNames, Exists) if Found}
+
+        Tags = GetTags(Service, ResourceId, Region, Account=Account)
+
+        return {TagName: Tags[TagName] for TagName in TagNames if TagName in Tags}
+
+    def Add(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Plan a row; returns the tags to write, which is empty if nothing changes, or raises if live tags are
+        unknown"""
+
+        Region = GetResourceRegion(Service, ResourceId, Region)
+        Account = GetResourceAccount(ResourceId, Account)
+        try:
+            Live = self.GetLiveTags(Service, ResourceId, list(Tags), Region, Account)
+        except Exception:
+            self.Unverified += 1
+            raise
+
+        Changes = {TagName: TagValue for TagName, TagValue in Tags.items() \
+                   if TagName not in Live or self.Overwrite and Live[TagName] != TagValue}
+        if not Changes:
+            self.Unchanged += 1
+            return Changes
+
+        self.Resources += 1
+        Entry = {'row': Row, 'service': Service, 'resource': ResourceId, 'tags': Changes}
+        if Region:
+            Entry['region'] = Region
+        if Account:
+            Entry['account'] = Account
+        self.__Write(Entry)
+        self.__CountCalls(Service, ResourceId, Changes, Region, Account)
+
+        return Changes
+
+    def GetCounts(self):
+        """Return counters as dictionary, i.e. for a progress line"""
+
+        return {'Total': self.Resources + self.Unchanged + self.Unverified, 'Changed': self.Resources,
+                'Unchanged': self.Unchanged, 'Unverified': self.Unverified}
+
+    def GetCalls(self):
+        """Return dictionary of (service, region) to expected number of write calls"""
+
+        Calls = dict(self.__Calls)
+        for (Service, Region, Account, Tags), Count in self.__Groups.items():
+            ### apply caps batch sizes at what the apis take
+            if Service == 'resourcegroupstaggingapi':
+                BatchSize = BulkTagger.MaxBatchSize
+            else:
+                BatchSize = min(self.Ec2BatchSize, GetAdapter('ec2').MaxBatch)
+            Calls[(Service, Region)] = Calls.get((Service, Region), 0) + -(-Count // BatchSize)
+
+        return Calls
+
+    def Close(self):
+        """Write the summary and close the plan file"""
+
+        Calls = sorted([Service, Region, Count] for (Service, Region), Count in self.GetCalls().items())
+        self.__Write({'summary': {'resources': self.Resources, 'unchanged': self.Unchanged,
+                                  'unverified': self.Unverified, 'calls': Calls}})
+        self.__File.close()
+
+    def __CountCalls(self, Service, ResourceId, Changes, Region=None, Account=None):
+        """Add the write calls apply will make for a planned resource; batches do not span accounts"""
+
+        Region = Region or 'default'
+        if self.Bulk and IsArn(ResourceId):
+            Key = ('resourcegroupstaggingapi', Region, Account, tuple(sorted(Changes.items())))
+            self.__Groups[Key] = self.__Groups.get(Key, 0) + 1
+        elif Service == 'ec2' and self.Ec2BatchSize > 0:
+            Key = ('ec2', Region, Account, tuple(sorted(Changes.items())))
+            self.__Groups[Key] = self.__Groups.get(Key, 0) + 1
+        elif Service == 's3' and self.S3Merge:
+            ### one get_bucket_tagging and one put_bucket_tagging per bucket
+            if GetBucketName(ResourceId) not in self.__Buckets:
+                self.__Buckets.add(GetBucketName(ResourceId))
+                self.__Calls[('s3', Region)] = self.__Calls.get(('s3', Region), 0) + 2
+        else:
+            Calls = 2 if Service == 's3' else 1
+            self.__Calls[(Service, Region)] = self.__Calls.get((Service, Region), 0) + Calls
+
+    def __Write(self, Object):
+        """Append one json line"""
+
+        self.__File.write(json.dumps(Object, separators=(',', ':')) + '\n')
+
+
+class PlanReader:
+    """Read a plan file with the same ReadTagRows() interface as the report readers"""
+
+    def __init__(self, FileName):
+        """Constructor"""
+
+        self.FileName = FileName
+        self.Files = [FileName]
+        self.RowsCount = 0
+        self.Summary = None
+        with open(FileName, 'r') as f:
+            self.Header = json.loads(f.readline() or '{}')
+        if self.Header.get('plan') != 1:
+            raise Exception(FileName + ' is not a plan file')
+
+    def GetResourcesCount(self):
+        """Return number of planned resources from the summary line at the end of the file, or None"""
+
+        with open(self.FileName, 'rb') as f:
+            f.seek(max(0, os.path.getsize(self.FileName) - 65536))
+            Lines = f.read().splitlines()
+
+        try:
+            return json.loads(Lines[-1])['summary']['resources']
+        except Exception:
+            return None
+
+    def ReadTagRows(self, TagColumns=None, RegionColumn=None, AccountColumn=None):
+        """Yield (RowNumber, Service, ResourceId, Tags, Region, Account) of every planned resource; the plan
+        names tags, region and account itself, so the column arguments are ignored"""
+
+        with open(self.FileName, 'r') as f:
+            f.readline()
+            for Line in f:
+                Entry = json.loads(Line)
+                if 'summary' in Entry:
+                    self.Summary = Entry['summary']
+                    continue
+                self.RowsCount += 1
+                yield Entry['row'], Entry['service'], Entry['resource'], Entry['tags'], Entry.get('region'), \
+                      Entry.get('account')
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return 'Plan: Resources=' + str(self.RowsCount) + ' Created=' + str(self.Header.get('created')) \
+               + ' Complete=' + str(self.Summary is not None)
+
+if __name__ == '__main__':
+    import tempfile
+    from aws.fake import InstallFake
+    print('I prefer to be a module; however, I can run some tests')
+    InstallFake()
+    FileName = os.path.join(tempfile.mkdtemp(), 'tagging.plan')
+    print('TEST 1: estimate write calls with batches capped at what the apis take', end='')
+    Planner = TagPlanner(FileName, Ec2BatchSize=5000, S3Merge=True, Bulk=True)
+    for Number in range(2500):
+        Planner.Add(Number, 'ec2', 'i-%05d' % Number, {'Channel': 'web'})
+    for Number in range(45):
+        Arn = 'arn:aws:lambda:us-east-1:123456789012:function:fn-%d' % Number
+        Planner.Add(Number, 'lambda', Arn, {'Channel': 'web'})
+    Planner.Add(1, 's3', 'bucket', {'Channel': 'web'})
+    Planner.Add(2, 's3', 'bucket', {'Owner': 'ops'})
+    assert Planner.GetCalls() == {('ec2', 'default'): 3, ('resourcegroupstaggingapi', 'us-east-1'): 3,
+                                  ('s3', 'default'): 2}
+    Planner.Close()
+    print('...OK')
+    print('TEST 2: read the plan back', end='')
+    Reader = PlanReader(FileName)
+    assert len(list(Reader.ReadTagRows())) == 2547 and Reader.GetResourcesCount() == 2547
+    print('...OK')
@@ -0,0 +1,231 @@
+"""This module provides an in-memory index of existing tags built from bulk paginated scans"""
+import os
+import sys
+import threading
+### run as a script, i.e. python3 helper/aws/prefetch.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.client import GetPool
+from aws.arn import IsArn, ParseArn, GetArnRegion
+from aws.arn import GetEc2ResourceId
+from aws.registry import GetAdapter, GetArnServiceName
+
+
+class TagIndex:
+    """Answer IsTagExists from a few paginated scans instead of one describe/list call per row
+
+    Scans are filtered on the tag names being written, so once a (service, region) scope has
+    been scanned a resource missing from the index is known not to carry those tags, as
+    long as its id is an ARN or in the form its service's api names it, which is what the
+    scans index; any other form may be an alias the index does not know.
+    IsTagExists() returns None when the index cannot answer and the caller should ask AWS.
+    Ids without a region in them are looked up in the region the scans defaulted to.
+    """
+
+    def __init__(self, Profile=None, Pool=None):
+        """Constructor"""
+
+        self.Profile = Profile
+        self.Pool = Pool if Pool is not None else GetPool()
+        self.__Lock = threading.Lock()
+        self.__Tags = {}
+        self.__Scopes = {}
+        self.DefaultRegion = None
+        self.CallsCount = 0
+
+    def __getstate__(self):
+        """Return the index without its pool and lock, i.e. to hand it to worker processes"""
+
+        State = dict(self.__dict__)
+        del State['Pool'], State['_TagIndex__Lock']
+
+        return State
+
+    def __setstate__(self, State):
+        """Restore the index with the pool of this process"""
+
+        self.__dict__.update(State)
+        self.Pool = GetPool()
+        self.__Lock = threading.Lock()
+
+    @staticmethod
+    def GetAliases(ResourceId):
+        """Return the ids a resource may appear under, i.e. ARN, resource part, name or queue URL name"""
+
+        Aliases = [ResourceId]
+        Parsed = ParseArn(ResourceId)
+        if Parsed:
+            Aliases.append(Parsed['Resource'])
+            Aliases.append(Parsed['Resource'].split('/')[-1])
+            Aliases.append(Parsed['Resource'].split(':')[-1])
+        elif ResourceId.startswith('https://'):
+            Aliases.append(ResourceId.rstrip('/').split('/')[-1])
+
+        return list(dict.fromkeys(Alias for Alias in Aliases if Alias))
+
+    @staticmethod
+    def GetIndexId(Service, ResourceId):
+        """Return the id a resource is indexed under whatever form it is named in: its ARN, or the id its service's
+        api takes; None if neither can be told"""
+
+        if IsArn(ResourceId):
+            return ResourceId
+        Adapter = GetAdapter(Service)
+        if Adapter and Adapter.IdForm != 'arn':
+            return Adapter.GetId(ResourceId)
+
+        return None
+
+    def GetRegion(self, ResourceId, Region=None):
+        """Return region a resource is indexed under"""
+
+        return Region or GetArnRegion(ResourceId) or self.DefaultRegion
+
+    def Put(self, Service, ResourceId, Tags, Region=None):
+        """Record tags as dictionary of key to value for a resource"""
+
+        Region = self.GetRegion(ResourceId, Region)
+        Aliases = self.GetAliases(ResourceId)
+        Adapter = GetAdapter(Service)
+        if Adapter and Adapter.IdForm != 'arn':
+            Aliases.append(Adapter.GetId(ResourceId))
+        with self.__Lock:
+            for Alias in Aliases:
+                self.__Tags[(Service, Region, Alias)] = dict(Tags)
+
+    def GetTags(self, Service, ResourceId, Region=None):
+        """Return tags of a resource as dictionary, or None if it is not indexed"""
+
+        Region = self.GetRegion(ResourceId, Region)
+        if Service == 'ec2':
+            ResourceId = GetEc2ResourceId(ResourceId)
+
+        for Alias in self.GetAliases(ResourceId) + [self.GetIndexId(Service, ResourceId)]:
+            Tags = self.__Tags.get((Service, Region, Alias))
+            if Tags is not None:
+                return Tags
+
+        return None
+
+    def IsTagExists(self, Service, ResourceId, TagName, Region=None):
+        """Return True or False if the index knows whether the tag exists, otherwise None"""
+
+        Tags = self.GetTags(Service, ResourceId, Region)
+        if Tags is not None and TagName in Tags:
+            return True
+        ### a resource missing from the index under an alias may be indexed under another one
+        if Tags is None and self.GetIndexId(Service, ResourceId) is None:
+            return None
+
+        Region = self.GetRegion(ResourceId, Region)
+        ### global services are only listed by the tagging api in their home region; s3 buckets in their own region
+        Adapter = GetAdapter(Service)
+        if Adapter and Adapter.Global:
+            Region = Adapter.HomeRegion
+        for Scope in ((Service, Region), ('*', Region)):
+            if TagName in self.__Scopes.get(Scope, ()):
+                return False
+
+        return None
+
+    def PrefetchTaggingApi(self, TagNames, Region=None):
+        """Index every resource carrying any of the tag names with resourcegroupstaggingapi.get_resources()"""
+
+        for Service, Arn, Tags, Where in self.ScanTaggingApi(TagNames, Region):
+            self.Put(Service, Arn, Tags, Where)
+
+        self.__AddScope('*', Region or self.DefaultRegion, TagNames)
+
+    def PrefetchEc2(self, TagNames, Region=None):
+        """Index every ec2 resource carrying any of the tag names with ec2.describe_tags()"""
+
+        for Service, ResourceId, Tags, Where in self.ScanEc2(TagNames, Region):
+            Known = self.GetTags('ec2', ResourceId, Where) or {}
+            Known.update(Tags)
+            self.Put('ec2', ResourceId, Known, Where)
+
+        self.__AddScope('ec2', Region or self.DefaultRegion, TagNames)
+
+    def ScanTaggingApi(self, TagNames, Region=None, Account=None):
+        """Yield (Service, Arn, Tags, Region) of every resource carrying any of the tag names, with all its tags;
+        a resource carrying several of them is yielded once"""
+
+        Client = self.Pool.GetClient('resourcegroupstaggingapi', Region, self.Profile, Account=Account)
+        Paginator = Client.get_paginator('get_resources')
+        Region = self.__ResolveRegion(Client, Region)
+
+        ### separate tag filters are AND'ed, so scan once per tag name
+        for Number, TagName in enumerate(TagNames):
+            for Page in Paginator.paginate(TagFilters=[{'Key': TagName}], ResourcesPerPage=100):
+                self.CallsCount += 1
+                for Mapping in Page.get('ResourceTagMappingList', []):
+                    Arn = Mapping['ResourceARN']
+                    Parsed = ParseArn(Arn)
+                    Tags = {Tag['Key']: Tag['Value'] for Tag in Mapping.get('Tags', [])}
+                    ### resources carrying a tag name scanned before were yielded by that scan
+                    if any(Earlier in Tags for Earlier in TagNames[:Number]):
+                        continue
+                    yield GetArnServiceName(Parsed['Service']), Arn, Tags, Parsed['Region'] or Region
+
+    def ScanEc2(self, TagNames, Region=None, Account=None):
+        """Yield ('ec2', ResourceId, Tags, Region) of every ec2 resource carrying any of the tag names, with the
+        values of those tag names only"""
+
+        Client = self.Pool.GetClient('ec2', Region, self.Profile, Account=Account)
+        Paginator = Client.get_paginator('describe_tags')
+        Region = self.__ResolveRegion(Client, Region)
+        Found = {}
+
+        ### tags of one resource may span pages, so every page is read before anything is yielded
+        for Page in Paginator.paginate(Filters=[{'Name': 'key', 'Values': list(TagNames)}],
+                                       PaginationConfig={'PageSize': 1000}):
+            self.CallsCount += 1
+            for Tag in Page.get('Tags', []):
+                Found.setdefault(Tag['ResourceId'], {})[Tag['Key']] = Tag['Value']
+
+        for ResourceId, Tags in Found.items():
+            yield 'ec2', ResourceId, Tags, Region
+
+    def GetResourcesCount(self):
+        """Return number of indexed (service, region, id) entries"""
+
+        return len(self.__Tags)
+
+    def __ResolveRegion(self, Client, Region):
+        """Return the region a client talks to, remembering the default region"""
+
+        if Region is None:
+            Region = Client.meta.region_name
+            if self.DefaultRegion is None:
+                self.DefaultRegion = Region
+
+        return Region
+
+    def __AddScope(self, Service, Region, TagNames):
+        """Mark tag names as fully scanned for service ('*' for all) and region"""
+
+        with self.__Lock:
+            self.__Scopes.setdefault((Service, Region), set()).update(TagNames)
+
+if __name__ == '__main__':
+    from aws.fake import InstallFake
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    Fake.Put('dynamodb', 'arn:aws:dynamodb:us-east-1:123456789012:table/tagged', {'Channel': 'web'})
+    Fake.Put('s3', 'arn:aws:s3:::tagged-bucket', {'Channel': 'web'})
+    Fake.Put('lambda', 'arn:aws:lambda:us-east-1:123456789012:function:untagged', {'Owner': 'ops'})
+    Index = TagIndex()
+    Index.PrefetchTaggingApi(['Channel'], 'us-east-1')
+    print('TEST 1: a scanned tag is found under the ARN, resource part or api id of its resource', end='')
+    assert Index.IsTagExists('dynamodb', 'arn:aws:dynamodb:us-east-1:123456789012:table/tagged', 'Channel')
+    assert Index.IsTagExists('dynamodb', 'tagged', 'Channel', 'us-east-1')
+    assert Index.IsTagExists('s3', 'tagged-bucket', 'Channel', 'us-east-1')
+    print('...OK')
+    print('TEST 2: a resource named by its ARN or api id and missing from the index lacks the tag', end='')
+    assert Index.IsTagExists('lambda', 'arn:aws:lambda:us-east-1:123456789012:function:untagged', 'Channel') is False
+    assert Index.IsTagExists('kinesis', 'other-stream', 'Channel', 'us-east-1') is False
+    print('...OK')
+    print('TEST 3: a resource named in another form and missing from the index is unknown', end='')
+    assert Index.IsTagExists('lambda', 'untagged', 'Channel', 'us-east-1') is None
+    assert Index.IsTagExists('dynamodb', 'other-table', 'Channel', 'us-east-1') is None
+    print('...OK')
@@ -0,0 +1,297 @@
+"""This module provides adaptive per-service rate limiting with throttling feedback"""
+import os
+import random
+import sys
+import threading
+import time
+### run as a script, i.e. python3 helper/aws/ratelimit.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from botocore.exceptions import ClientError
+from aws.client import RegisterClientHook
+from aws.registry import GetRates
+
+
+### error codes AWS services use when a caller exceeds a request rate
+ThrottlingCodes = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                   'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException',
+                   'ProvisionedThroughputExceededException', 'SlowDown', 'PriorRequestNotComplete',
+                   'BandwidthLimitExceeded', 'EC2ThrottledException'}
+
+### error codes for transient faults which are retried without slowing down
+TransientCodes = {'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure',
+                  'InternalServiceException', 'ServiceUnavailable'}
+
+def GetErrorCode(Error):
+    """Return the AWS error code of a ClientError, or None"""
+
+    if isinstance(Error, ClientError):
+        return Error.response.get('Error', {}).get('Code')
+
+    return None
+
+def IsThrottlingError(Error):
+    """Return True if exception is a throttling ClientError"""
+
+    return GetErrorCode(Error) in ThrottlingCodes
+
+
+class RateLimiter:
+    """Token bucket whose rate adapts with AIMD
+
+    Each success adds Increase / Rate to the rate, so it grows by about Increase calls/s
+    every second; each throttle multiplies it by Decrease, at most once per second so a
+    burst of throttled in-flight calls counts once. GetSafeRate() returns the learned rate,
+    i.e. the rate in effect just after the most recent throttle.
+    """
+
+    def __init__(self, Rate=10.0, MinRate=0.5, MaxRate=100.0, Increase=1.0, Decrease=0.5):
+        """Constructor"""
+
+        self.Rate = float(Rate)
+        self.MinRate = float(MinRate)
+        self.MaxRate = float(MaxRate)
+        self.Increase = float(Increase)
+        self.Decrease = float(Decrease)
+        self.SafeRate = None
+        self.ThrottleCount = 0
+        self.CallsCount = 0
+        self.WaitSeconds = 0.0
+        self.__Tokens = 1.0
+        self.__Last = time.monotonic()
+        self.__LastDecrease = 0.0
+        self.__Lock = threading.Lock()
+
+    def Acquire(self):
+        """Block until a call may be made"""
+
+        while True:
+            with self.__Lock:
+                Now = time.monotonic()
+                self.__Tokens = min(max(1.0, self.Rate), self.__Tokens + (Now - self.__Last) * self.Rate)
+                self.__Last = Now
+                if self.__Tokens >= 1.0:
+                    self.__Tokens -= 1.0
+                    self.CallsCount += 1
+                    return
+                Wait = (1.0 - self.__Tokens) / self.Rate
+                self.WaitSeconds += Wait
+            time.sleep(Wait)
+
+    def OnSuccess(self):
+        """Additive increase"""
+
+        with self.__Lock:
+            self.Rate = min(self.MaxRate, self.Rate + self.Increase / self.Rate)
+
+    def OnThrottle(self):
+        """Multiplicative decrease"""
+
+        with self.__Lock:
+            self.ThrottleCount += 1
+            Now = time.monotonic()
+            if Now - self.__LastDecrease < 1.0:
+                return
+            self.__LastDecrease = Now
+            self.Rate = max(self.MinRate, self.Rate * self.Decrease)
+            self.SafeRate = self.Rate
+            self.__Tokens = 0.0
+
+    def GetSafeRate(self):
+        """Return the learned safe rate in calls per second"""
+
+        return self.SafeRate if self.SafeRate is not None else self.Rate
+
+
+class RateLimiters:
+    """Registry of RateLimiter keyed by (service, region)"""
+
+    ### initial and maximum calls per second of apis which are not in the service registry
+    __Rates = {'resourcegroupstaggingapi': (5, 20)}
+
+    def __init__(self, Rate=10.0, MaxRate=100.0, Rates=None, MaxRetries=8, MaxBackoff=20.0):
+        """Constructor"""
+
+        self.Rate = Rate
+        self.MaxRate = MaxRate
+        self.Rates = GetRates()
+        self.Rates.update(RateLimiters.__Rates)
+        self.Rates.update(Rates or {})
+        self.MaxRetries = MaxRetries
+        self.MaxBackoff = MaxBackoff
+        self.__Limiters = {}
+        self.__Merged = {}
+        self.__Lock = threading.Lock()
+
+    def GetLimiter(self, Service, Region=None):
+        """Return the limiter of service and region, created on first use"""
+
+        Key = (Service, Region)
+        Limiter = self.__Limiters.get(Key)
+        if Limiter is None:
+            with self.__Lock:
+                Limiter = self.__Limiters.get(Key)
+                if Limiter is None:
+                    Rate, MaxRate = self.Rates.get(Service, (self.Rate, self.MaxRate))
+                    Limiter = RateLimiter(Rate, MaxRate=MaxRate)
+                    self.__Limiters[Key] = Limiter
+
+        return Limiter
+
+    def Call(self, Service, Region, Fn, *args, **kwargs):
+        """Call Fn at the rate allowed for service and region, retrying throttling and transient errors until the
+        retries of botocore and of its own reach MaxRetries"""
+
+        Limiter = self.GetLimiter(Service, Region)
+        Attempt = 0
+        while True:
+            Limiter.Acquire()
+            Observed = getattr(_Observed, 'Throttles', 0)
+            try:
+                Result = Fn(*args, **kwargs)
+            except ClientError as c:
+                Code = GetErrorCode(c)
+                Attempt += c.response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+                if Attempt >= self.MaxRetries or Code not in ThrottlingCodes and Code not in TransientCodes:
+                    raise
+                ### a throttle the client hook has seen is already counted
+                if Code in ThrottlingCodes and getattr(_Observed, 'Throttles', 0) == Observed:
+                    Limiter.OnThrottle()
+                time.sleep(random.uniform(0, min(self.MaxBackoff, 0.1 * 2 ** Attempt)))
+                Attempt += 1
+                continue
+            Limiter.OnSuccess()
+            return Result
+
+    def GetRates(self):
+        """Return dictionary of (service, region) to (current rate, safe rate, calls, throttles, seconds waited)"""
+
+        Rates = {Key: (Limiter.Rate, Limiter.GetSafeRate(), Limiter.CallsCount, Limiter.ThrottleCount,
+                       Limiter.WaitSeconds) \
+                 for Key, Limiter in list(self.__Limiters.items())}
+        for Key, Merged in list(self.__Merged.items()):
+            Rates[Key] = tuple(Value + Other for Value, Other in zip(Rates.get(Key, (0, 0, 0, 0, 0)), Merged))
+
+        return Rates
+
+    def Merge(self, Rates):
+        """Add rates as returned by GetRates() of another process, i.e. of a worker process, to GetRates(); rates
+        of several processes add up since they share the limits of AWS"""
+
+        with self.__Lock:
+            for Key, Values in Rates.items():
+                Merged = self.__Merged.get(Key, (0, 0, 0, 0, 0))
+                self.__Merged[Key] = tuple(Value + Other for Value, Other in zip(Merged, Values))
+
+
+_Limiters = None
+
+### throttles counted by ObserveClient() in the calling thread, which botocore runs its event hooks in
+_Observed = threading.local()
+
+def ConfigureLimiters(Rate=10.0, MaxRate=100.0, Rates=None, MaxRetries=8):
+    """Enable rate limiting for every AwsTag call in this process"""
+
+    global _Limiters
+    _Limiters = RateLimiters(Rate, MaxRate, Rates, MaxRetries)
+
+    return _Limiters
+
+def GetLimiters():
+    """Return the process-wide limiters, or None if rate limiting is disabled"""
+
+    return _Limiters
+
+def ObserveClient(Client, Service, Region=None):
+    """Client pool hook which feeds throttles retried inside botocore to the process-wide limiters"""
+
+    def OnNeedsRetry(response=None, **kwargs):
+        Limiters = _Limiters
+        if Limiters is not None and response and response[1].get('Error', {}).get('Code') in ThrottlingCodes:
+            Limiters.GetLimiter(Service, Region).OnThrottle()
+            _Observed.Throttles = getattr(_Observed, 'Throttles', 0) + 1
+
+    Client.meta.events.register('needs-retry', OnNeedsRetry)
+
+RegisterClientHook(ObserveClient)
+
+def Call(Service, Region, Fn, *args, **kwargs):
+    """Call Fn through the process-wide limiters, or directly if rate limiting is disabled"""
+
+    if _Limiters is None:
+        return Fn(*args, **kwargs)
+
+    return _Limiters.Call(Service, Region, Fn, *args, **kwargs)
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+
+    def GetThrottle(RetryAttempts=0):
+        """Return a throttling ClientError after RetryAttempts retries of botocore"""
+
+        return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                            'ResponseMetadata': {'RetryAttempts': RetryAttempts}}, 'describe_tags')
+
+    def Fails(Errors):
+        """Return a function raising Errors one per call, then returning 'ok', and the list of its calls"""
+
+        Calls = []
+
+        def Fn():
+            Calls.append(1)
+            if len(Calls) <= len(Errors):
+                raise Errors[len(Calls) - 1]
+            return 'ok'
+
+        return Fn, Calls
+
+    print('TEST 1: successes add to the rate and a burst of throttles halves it once', end='')
+    Limiter = RateLimiter(Rate=10.0)
+    Limiter.OnSuccess()
+    assert abs(Limiter.Rate - 10.1) < 1e-9
+    Limiter.OnThrottle()
+    Limiter.OnThrottle()
+    assert abs(Limiter.Rate - 5.05) < 1e-9 and Limiter.GetSafeRate() == Limiter.Rate and Limiter.ThrottleCount == 2
+    print('...OK')
+
+    print('TEST 2: calls wait for the rate', end='')
+    Limiter = RateLimiter(Rate=20.0)
+    Started = time.monotonic()
+    for _ in range(5):
+        Limiter.Acquire()
+    assert time.monotonic() - Started >= 0.15 and Limiter.CallsCount == 5
+    print('...OK')
+
+    print('TEST 3: retry throttles and transient errors, raise other errors at once', end='')
+    Limiters = RateLimiters(Rate=100.0, MaxRetries=3)
+    Fn, Calls = Fails([GetThrottle(), ClientError({'Error': {'Code': 'InternalError'}}, 'describe_tags')])
+    assert Limiters.Call('ec2', 'us-east-1', Fn) == 'ok' and len(Calls) == 3
+    assert Limiters.GetLimiter('ec2', 'us-east-1').ThrottleCount == 1
+    Fn, Calls = Fails([ClientError({'Error': {'Code': 'AccessDenied'}}, 'describe_tags')])
+    try:
+        Limiters.Call('ec2', 'us-east-1', Fn)
+        assert False
+    except ClientError:
+        assert len(Calls) == 1
+    print('...OK')
+
+    print('TEST 4: retries of botocore count towards MaxRetries', end='')
+    Fn, Calls = Fails([GetThrottle(2)] * 5)
+    try:
+        Limiters.Call('ec2', 'eu-west-1', Fn)
+        assert False
+    except ClientError:
+        assert len(Calls) == 2
+    print('...OK')
+
+    print('TEST 5: a throttle seen by the client hook is counted once', end='')
+    from aws.fake import FakeAws
+    Limiters = ConfigureLimiters(Rate=100.0, MaxRetries=1)
+    Client = FakeAws(ThrottleRate=1.0).CreateClient('ec2', 'us-east-1')
+    ObserveClient(Client, 'ec2', 'us-east-1')
+    try:
+        Call('ec2', 'us-east-1', Client.describe_tags, Filters=[])
+        assert False
+    except ClientError:
+        assert Limiters.GetLimiter('ec2', 'us-east-1').ThrottleCount == 2
+    print('...OK')
@@ -0,0 +1,488 @@
+"""This module provides the registry of services which support tagging and how each one reads and writes tags"""
+import os
+import sys
+### run as a script, i.e. python3 helper/aws/registry.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.arn import GetEc2ResourceId, GetLogGroupName, GetBucketName, GetResourceName, GetQueueUrl, GetArnRegion, \
+    GetUrlRegion
+
+
+def ToTagList(Tags, Key='Key', Value='Value'):
+    """Return tags dictionary as list, i.e. {'Channel': 'web'} as [{'Key': 'Channel', 'Value': 'web'}]"""
+
+    return [{Key: TagName, Value: TagValue} for TagName, TagValue in Tags.items()]
+
+def ToTagDict(TagList, Key='Key', Value='Value'):
+    """Return list of tags as dictionary, i.e. [{'Key': 'Channel', 'Value': 'web'}] as {'Channel': 'web'}"""
+
+    return {Tag[Key]: Tag.get(Value, '') for Tag in TagList or []}
+
+
+class ServiceAdapter:
+    """Declarative description of the tagging api of one service
+
+    Write and Read name the boto3 methods; IdParam and ReadIdParam the parameter taking the
+    resource id, converted by GetId to the IdForm the api wants (arn, id, name or url), or a
+    list of ids if IdList/ReadIdList is set, or an ec2 style filter if ReadFilter is set.
+    Tags are written to TagsParam as a dictionary if TagKeys is None, otherwise as a list
+    of {TagKeys[0]: name, TagKeys[1]: value}, wrapped in {TagWrap: list} if TagWrap is set.
+    Reads find the tags at ReadPath in the response; with ReadEach, ReadPath is a list of
+    one entry per resource with its tags under ReadEach and its id under ReadIdKey.
+    Untag names the method removing tags, which takes the tag names in UntagParam as a
+    list, of {UntagKey: name} if UntagKey is set, wrapped in {UntagWrap: list} if UntagWrap
+    is set; a service which replaces the whole tag set removes tags by writing the rest,
+    or with UntagAll when none is left. Lists are the ResourceList calls which enumerate the
+    resources of the service.
+    MaxBatch and MaxReadBatch are the ids one call accepts, Rate the initial and maximum
+    calls per second and Workers the concurrency cap of services with tight limits.
+    """
+
+    def __init__(self, Name, Write, IdParam, Read, ReadIdParam=None, IdForm='arn', GetId=None, IdList=False,
+                 TagsParam='Tags', TagKeys=('Key', 'Value'), TagWrap=None, WriteExtra=None, ReplacesTagSet=False,
+                 ReadIdList=False, ReadFilter=None, ReadExtra=None, ReadPath=('Tags',), ReadKeys=None,
+                 ReadEach=None, ReadIdKey=None, EmptyCodes=(), MaxBatch=1, MaxReadBatch=1, Rate=None,
+                 Workers=None, CsvNames=(), ArnService=None, Global=False, HomeRegion=None, Untag=None,
+                 UntagParam='TagKeys', UntagKey=None, UntagWrap=None, UntagAll=None, Lists=()):
+        """Constructor"""
+
+        self.Name = Name
+        self.Write = Write
+        self.IdParam = IdParam
+        self.Read = Read
+        self.ReadIdParam = ReadIdParam if ReadIdParam else IdParam
+        self.IdForm = IdForm
+        self.GetId = GetId if GetId else (lambda ResourceId: ResourceId)
+        self.IdList = IdList
+        self.TagsParam = TagsParam
+        self.TagKeys = TagKeys
+        self.TagWrap = TagWrap
+        self.WriteExtra = WriteExtra or {}
+        self.ReplacesTagSet = ReplacesTagSet
+        self.ReadIdList = ReadIdList
+        self.ReadFilter = ReadFilter
+        self.ReadExtra = ReadExtra or {}
+        self.ReadPath = ReadPath
+        self.ReadKeys = ReadKeys if ReadKeys else TagKeys
+        self.ReadEach = ReadEach
+        self.ReadIdKey = ReadIdKey
+        self.EmptyCodes = EmptyCodes
+        self.MaxBatch = MaxBatch
+        self.MaxReadBatch = MaxReadBatch
+        self.Rate = Rate
+        self.Workers = Workers
+        self.CsvNames = CsvNames
+        self.ArnService = ArnService if ArnService else Name
+        self.Global = Global
+        self.HomeRegion = HomeRegion
+        self.Untag = Untag
+        self.UntagParam = UntagParam
+        self.UntagKey = UntagKey
+        self.UntagWrap = UntagWrap
+        self.UntagAll = UntagAll
+        self.Lists = Lists
+
+    def FormatTags(self, Tags):
+        """Return tags dictionary in the shape the write method takes"""
+
+        if self.TagKeys is None:
+            return dict(Tags)
+
+        TagList = ToTagList(Tags, *self.TagKeys)
+
+        return {self.TagWrap: TagList} if self.TagWrap else TagList
+
+    def GetWriteParams(self, ResourceIds, Tags):
+        """Return keyword arguments of the write method for a list of resource ids"""
+
+        Ids = [self.GetId(ResourceId) for ResourceId in ResourceIds]
+        if len(Ids) > (self.MaxBatch if self.IdList else 1):
+            raise ValueError(self.Name + ' accepts at most ' + str(self.MaxBatch) + ' ids per write')
+
+        Params = dict(self.WriteExtra)
+        Params[self.IdParam] = Ids if self.IdList else Ids[0]
+        Params[self.TagsParam] = self.FormatTags(Tags)
+
+        return Params
+
+    def GetUntagParams(self, ResourceIds, TagNames):
+        """Return keyword arguments of the untag method for a list of resource ids and tag names"""
+
+        Ids = [self.GetId(ResourceId) for ResourceId in ResourceIds]
+        if len(Ids) > (self.MaxBatch if self.IdList else 1):
+            raise ValueError(self.Name + ' accepts at most ' + str(self.MaxBatch) + ' ids per untag')
+
+        Keys = [{self.UntagKey: TagName} for TagName in TagNames] if self.UntagKey else list(TagNames)
+        Params = dict(self.WriteExtra)
+        Params[self.IdParam] = Ids if self.IdList else Ids[0]
+        Params[self.UntagParam] = {self.UntagWrap: Keys} if self.UntagWrap else Keys
+
+        return Params
+
+    def GetReadParams(self, ResourceIds):
+        """Return keyword arguments of the read method for a list of resource ids"""
+
+        Ids = [self.GetId(ResourceId) for ResourceId in ResourceIds]
+        if len(Ids) > (self.MaxReadBatch if self.ReadIdList or self.ReadFilter else 1):
+            raise ValueError(self.Name + ' accepts at most ' + str(self.MaxReadBatch) + ' ids per read')
+
+        Params = dict(self.ReadExtra)
+        if self.ReadFilter:
+            Params['Filters'] = [{'Name': self.ReadFilter, 'Values': Ids}]
+        else:
+            Params[self.ReadIdParam] = Ids if self.ReadIdList else Ids[0]
+
+        return Params
+
+    def ParseTags(self, Response):
+        """Return the tags found in a read response as one dictionary"""
+
+        Found = Response
+        for Key in self.ReadPath:
+            Found = (Found or {}).get(Key)
+
+        if self.ReadEach is None:
+            return self.__ToDict(Found)
+
+        Tags = {}
+        for Entry in Found or []:
+            Tags.update(self.__ToDict(Entry.get(self.ReadEach)))
+
+        return Tags
+
+    def IsReadBatched(self):
+        """Return True if one read call takes several resource ids"""
+
+        return self.MaxReadBatch > 1 and bool(self.ReadIdList or self.ReadFilter) and self.ReadIdKey is not None
+
+    def ParseTagsEach(self, Response):
+        """Return the tags found in a read response of several resources as dictionary of id to tags; ids are in
+        the form GetId returns and resources without tags may be missing"""
+
+        Found = Response
+        for Key in self.ReadPath:
+            Found = (Found or {}).get(Key)
+
+        Tags = {}
+        for Entry in Found or []:
+            ### ec2 style reads return one entry per tag, each naming its resource
+            if self.ReadEach is None:
+                Tags.setdefault(Entry[self.ReadIdKey], {}).update(self.__ToDict([Entry]))
+            else:
+                Tags.setdefault(Entry[self.ReadIdKey], {}).update(self.__ToDict(Entry.get(self.ReadEach)))
+
+        return Tags
+
+    def __ToDict(self, Found):
+        """Return tags in the shape the read method returns as dictionary"""
+
+        if self.ReadKeys is None:
+            return dict(Found or {})
+
+        ### a single tag, i.e. redshift's {'Tag': {'Key': ..., 'Value': ...}}
+        if isinstance(Found, dict):
+            Found = [Found]
+
+        return ToTagDict(Found, *self.ReadKeys)
+
+
+class ResourceList:
+    """Declarative description of one list or describe call enumerating resources of a service
+
+    Method is called with Extra, page by page if Paginated, and finds the resources at Path
+    in the response, where a list on the way is walked through; a resource is a dictionary
+    holding its id under IdKey, or the id itself if IdKey is None. GetId turns the listed
+    id into the id a report shows, and Arn, formatted with Partition, Region, Account and
+    Id, builds an ARN from it for services which list names but tag ARNs. A list which
+    covers every region, i.e. s3's list_buckets, names the region of each resource under
+    RegionKey.
+    """
+
+    def __init__(self, Method, Path, IdKey=None, Extra=None, Paginated=True, GetId=None, Arn=None, RegionKey=None):
+        """Constructor"""
+
+        self.Method = Method
+        self.Path = Path
+        self.IdKey = IdKey
+        self.Extra = Extra or {}
+        self.Paginated = Paginated
+        self.GetId = GetId if GetId else (lambda Id: Id)
+        self.Arn = Arn
+        self.RegionKey = RegionKey
+
+    def ParseResources(self, Response):
+        """Return list of (Id, Region) of the resources in a list response; Region is None unless RegionKey is set"""
+
+        Found = [Response]
+        for Key in self.Path:
+            Next = []
+            for Entry in Found:
+                Value = (Entry or {}).get(Key)
+                if isinstance(Value, list):
+                    Next.extend(Value)
+                elif Value is not None:
+                    Next.append(Value)
+            Found = Next
+
+        return [(self.GetId(Entry[self.IdKey] if self.IdKey else Entry),
+                 Entry.get(self.RegionKey) if self.RegionKey else None) for Entry in Found]
+
+    def GetResourceId(self, Id, Region, Account, Partition='aws'):
+        """Return the resource id of a listed id, i.e. the ARN of a dynamodb table name"""
+
+        return self.Arn.format(Partition=Partition, Region=Region, Account=Account, Id=Id) if self.Arn else Id
+
+
+_Adapters = {}
+
+def Register(Adapter):
+    """Add or replace the adapter of a service"""
+
+    _Adapters[Adapter.Name] = Adapter
+
+    return Adapter
+
+def GetAdapter(Service):
+    """Return the adapter of a boto3 service name, or None if it's not supported"""
+
+    return _Adapters.get(Service)
+
+def GetServiceNames():
+    """Return boto3 names of the supported services"""
+
+    return list(_Adapters)
+
+def GetCsvNames():
+    """Return services as dictionary of CsvServiceName to B3ServiceName, i.e. AmazonApiGateway: apigateway"""
+
+    return {CsvName: Adapter.Name for Adapter in _Adapters.values() for CsvName in Adapter.CsvNames}
+
+def GetArnServiceName(ArnService):
+    """Return boto3 service name of the service part of an ARN, i.e. emr for elasticmapreduce"""
+
+    for Adapter in _Adapters.values():
+        if Adapter.ArnService == ArnService:
+            return Adapter.Name
+
+    return ArnService
+
+def GetResourceRegion(Service, ResourceId, Region=None):
+    """Return region whose api serves a resource: the home region of a global service, the region of its ARN
+    or queue URL, else Region, i.e. from the report; None means the default region"""
+
+    Adapter = _Adapters.get(Service)
+    if Adapter and Adapter.HomeRegion:
+        return Adapter.HomeRegion
+
+    return GetArnRegion(ResourceId) or GetUrlRegion(ResourceId) or Region
+
+def GetRates():
+    """Return dictionary of service to (initial, maximum) calls per second for services with tight limits"""
+
+    return {Adapter.Name: Adapter.Rate for Adapter in _Adapters.values() if Adapter.Rate}
+
+def GetServiceWorkers():
+    """Return dictionary of service to concurrency cap for services with tight limits"""
+
+    return {Adapter.Name: Adapter.Workers for Adapter in _Adapters.values() if Adapter.Workers}
+
+
+### ec2 and vpc resources
+Register(ServiceAdapter('ec2', 'create_tags', 'Resources', 'describe_tags', IdForm='id', GetId=GetEc2ResourceId,
+                        IdList=True, ReadFilter='resource-id', ReadIdKey='ResourceId', MaxBatch=1000,
+                        MaxReadBatch=200, CsvNames=('AmazonEC2', 'AmazonVPC'), Untag='delete_tags', UntagParam='Tags',
+                        UntagKey='Key',
+                        Lists=(ResourceList('describe_instances', ('Reservations', 'Instances'), 'InstanceId'),
+                               ResourceList('describe_volumes', ('Volumes',), 'VolumeId'),
+                               ResourceList('describe_snapshots', ('Snapshots',), 'SnapshotId', {'OwnerIds': ['self']}),
+                               ResourceList('describe_images', ('Images',), 'ImageId', {'Owners': ['self']}),
+                               ResourceList('describe_nat_gateways', ('NatGateways',), 'NatGatewayId'))))
+
+### put_bucket_tagging replaces the whole tag set and a bucket without tags has no tag set
+Register(ServiceAdapter('s3', 'put_bucket_tagging', 'Bucket', 'get_bucket_tagging', IdForm='name',
+                        GetId=GetBucketName, TagsParam='Tagging', TagWrap='TagSet', ReplacesTagSet=True,
+                        ReadPath=('TagSet',), EmptyCodes=('NoSuchTagSet',), CsvNames=('AmazonS3',), Global=True,
+                        UntagAll='delete_bucket_tagging',
+                        Lists=(ResourceList('list_buckets', ('Buckets',), 'Name', RegionKey='BucketRegion'),)))
+
+Register(ServiceAdapter('lambda', 'tag_resource', 'Resource', 'list_tags', TagKeys=None,
+                        CsvNames=('AWSLambda',), Untag='untag_resource',
+                        Lists=(ResourceList('list_functions', ('Functions',), 'FunctionArn'),)))
+
+Register(ServiceAdapter('logs', 'tag_log_group', 'logGroupName', 'list_tags_log_group', IdForm='name',
+                        GetId=GetLogGroupName, TagsParam='tags', TagKeys=None, ReadPath=('tags',),
+                        CsvNames=('AmazonCloudWatch',), Untag='untag_log_group', UntagParam='tags',
+                        Lists=(ResourceList('describe_log_groups', ('logGroups',), 'logGroupName'),)))
+
+Register(ServiceAdapter('rds', 'add_tags_to_resource', 'ResourceName', 'list_tags_for_resource',
+                        ReadPath=('TagList',), CsvNames=('AmazonRDS',), Untag='remove_tags_from_resource',
+                        Lists=(ResourceList('describe_db_instances', ('DBInstances',), 'DBInstanceArn'),
+                               ResourceList('describe_db_clusters', ('DBClusters',), 'DBClusterArn'))))
+
+Register(ServiceAdapter('es', 'add_tags', 'ARN', 'list_tags', TagsParam='TagList', ReadPath=('TagList',),
+                        CsvNames=('AmazonES',), Untag='remove_tags',
+                        Lists=(ResourceList('list_domain_names', ('DomainNames',), 'DomainName', Paginated=False,
+                                            Arn='arn:{Partition}:es:{Region}:{Account}:domain/{Id}'),)))
+
+Register(ServiceAdapter('emr', 'add_tags', 'ResourceId', 'describe_cluster', 'ClusterId', IdForm='id',
+                        GetId=GetResourceName, ReadPath=('Cluster', 'Tags'), CsvNames=('ElasticMapReduce',),
+                        ArnService='elasticmapreduce', Untag='remove_tags',
+                        Lists=(ResourceList('list_clusters', ('Clusters',), 'Id',
+                                            {'ClusterStates': ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING']}),)))
+
+Register(ServiceAdapter('dynamodb', 'tag_resource', 'ResourceArn', 'list_tags_of_resource',
+                        CsvNames=('AmazonDynamoDB',), Untag='untag_resource',
+                        Lists=(ResourceList('list_tables', ('TableNames',),
+                                            Arn='arn:{Partition}:dynamodb:{Region}:{Account}:table/{Id}'),)))
+
+Register(ServiceAdapter('firehose', 'tag_delivery_stream', 'DeliveryStreamName', 'list_tags_for_delivery_stream',
+                        IdForm='name', GetId=GetResourceName, CsvNames=('AmazonKinesisFirehose',),
+                        Untag='untag_delivery_stream',
+                        Lists=(ResourceList('list_delivery_streams', ('DeliveryStreamNames',), Extra={'Limit': 10000},
+                                            Paginated=False),)))
+
+Register(ServiceAdapter('glacier', 'add_tags_to_vault', 'vaultName', 'list_tags_for_vault', IdForm='name',
+                        GetId=GetResourceName, TagKeys=None, Rate=(2, 10), Workers=2,
+                        CsvNames=('AmazonGlacier',), Untag='remove_tags_from_vault',
+                        Lists=(ResourceList('list_vaults', ('VaultList',), 'VaultARN'),)))
+
+Register(ServiceAdapter('kms', 'tag_resource', 'KeyId', 'list_resource_tags', IdForm='id',
+                        TagKeys=('TagKey', 'TagValue'), CsvNames=('awskms',), Untag='untag_resource',
+                        Lists=(ResourceList('list_keys', ('Keys',), 'KeyArn'),)))
+
+Register(ServiceAdapter('apigateway', 'tag_resource', 'resourceArn', 'get_tags', TagsParam='tags', TagKeys=None,
+                        ReadPath=('tags',), CsvNames=('AmazonApiGateway',), Untag='untag_resource',
+                        UntagParam='tagKeys',
+                        Lists=(ResourceList('get_rest_apis', ('items',), 'id',
+                                            Arn='arn:{Partition}:apigateway:{Region}::/restapis/{Id}'),)))
+
+Register(ServiceAdapter('kinesis', 'add_tags_to_stream', 'StreamName', 'list_tags_for_stream', IdForm='name',
+                        GetId=GetResourceName, TagKeys=None, ReadKeys=('Key', 'Value'),
+                        CsvNames=('AmazonKinesis',), Untag='remove_tags_from_stream',
+                        Lists=(ResourceList('list_streams', ('StreamSummaries',), 'StreamARN'),)))
+
+Register(ServiceAdapter('cloudtrail', 'add_tags', 'ResourceId', 'list_tags', 'ResourceIdList',
+                        TagsParam='TagsList', ReadIdList=True, ReadPath=('ResourceTagList',), ReadEach='TagsList',
+                        ReadIdKey='ResourceId', MaxReadBatch=20, CsvNames=('AWSCloudTrail',), Untag='remove_tags',
+                        UntagParam='TagsList', UntagKey='Key',
+                        Lists=(ResourceList('list_trails', ('Trails',), 'TrailARN', RegionKey='HomeRegion'),)))
+
+Register(ServiceAdapter('sqs', 'tag_queue', 'QueueUrl', 'list_queue_tags', IdForm='url',
+                        GetId=GetQueueUrl, TagKeys=None, CsvNames=('AWSQueueService',), Untag='untag_queue',
+                        Lists=(ResourceList('list_queues', ('QueueUrls',)),)))
+
+Register(ServiceAdapter('secretsmanager', 'tag_resource', 'SecretId', 'describe_secret', Rate=(5, 50), Workers=2,
+                        CsvNames=('AWSSecretsManager',), Untag='untag_resource',
+                        Lists=(ResourceList('list_secrets', ('SecretList',), 'ARN'),)))
+
+### cloudfront and route53 are global services whose api lives in us-east-1
+Register(ServiceAdapter('cloudfront', 'tag_resource', 'Resource', 'list_tags_for_resource', TagWrap='Items',
+                        ReadPath=('Tags', 'Items'), Rate=(2, 10), Workers=2, CsvNames=('AmazonCloudFront',),
+                        Global=True, HomeRegion='us-east-1', Untag='untag_resource', UntagWrap='Items',
+                        Lists=(ResourceList('list_distributions', ('DistributionList', 'Items'), 'ARN'),)))
+
+Register(ServiceAdapter('efs', 'create_tags', 'FileSystemId', 'describe_tags', IdForm='id',
+                        GetId=GetResourceName, CsvNames=('AmazonEFS',), ArnService='elasticfilesystem',
+                        Untag='delete_tags',
+                        Lists=(ResourceList('describe_file_systems', ('FileSystems',), 'FileSystemId'),)))
+
+Register(ServiceAdapter('sagemaker', 'add_tags', 'ResourceArn', 'list_tags', CsvNames=('AmazonSageMaker',),
+                        Untag='delete_tags',
+                        Lists=(ResourceList('list_notebook_instances', ('NotebookInstances',), 'NotebookInstanceArn'),
+                               ResourceList('list_endpoints', ('Endpoints',), 'EndpointArn'),
+                               ResourceList('list_models', ('Models',), 'ModelArn'))))
+
+Register(ServiceAdapter('redshift', 'create_tags', 'ResourceName', 'describe_tags', ReadPath=('TaggedResources',),
+                        ReadEach='Tag', ReadIdKey='ResourceName', CsvNames=('AmazonRedshift',), Untag='delete_tags',
+                        Lists=(ResourceList('describe_clusters', ('Clusters',), 'ClusterIdentifier',
+                                            Arn='arn:{Partition}:redshift:{Region}:{Account}:cluster:{Id}'),)))
+
+Register(ServiceAdapter('elasticache', 'add_tags_to_resource', 'ResourceName', 'list_tags_for_resource',
+                        ReadPath=('TagList',), CsvNames=('AmazonElastiCache',), Untag='remove_tags_from_resource',
+                        Lists=(ResourceList('describe_cache_clusters', ('CacheClusters',), 'ARN'),)))
+
+Register(ServiceAdapter('workspaces', 'create_tags', 'ResourceId', 'describe_tags', IdForm='id', GetId=GetResourceName,
+                        ReadPath=('TagList',), Rate=(2, 10), Workers=2, CsvNames=('AmazonWorkSpaces',),
+                        Untag='delete_tags',
+                        Lists=(ResourceList('describe_workspaces', ('Workspaces',), 'WorkspaceId'),)))
+
+Register(ServiceAdapter('ds', 'add_tags_to_resource', 'ResourceId', 'list_tags_for_resource', IdForm='id',
+                        GetId=GetResourceName, Rate=(2, 10), Workers=2, CsvNames=('AWSDirectoryService',),
+                        Untag='remove_tags_from_resource',
+                        Lists=(ResourceList('describe_directories', ('DirectoryDescriptions',), 'DirectoryId'),)))
+
+Register(ServiceAdapter('dax', 'tag_resource', 'ResourceName', 'list_tags', CsvNames=('AmazonDAX',),
+                        Untag='untag_resource',
+                        Lists=(ResourceList('describe_clusters', ('Clusters',), 'ClusterArn'),)))
+
+Register(ServiceAdapter('route53', 'change_tags_for_resource', 'ResourceId', 'list_tags_for_resource', IdForm='id',
+                        GetId=GetResourceName, TagsParam='AddTags', WriteExtra={'ResourceType': 'hostedzone'},
+                        ReadExtra={'ResourceType': 'hostedzone'}, ReadPath=('ResourceTagSet', 'Tags'),
+                        Rate=(2, 5), Workers=1, CsvNames=('AmazonRoute53',), Global=True, HomeRegion='us-east-1',
+                        Untag='change_tags_for_resource', UntagParam='RemoveTagKeys',
+                        Lists=(ResourceList('list_hosted_zones', ('HostedZones',), 'Id', GetId=GetResourceName),)))
+
+Register(ServiceAdapter('directconnect', 'tag_resource', 'resourceArn', 'describe_tags', 'resourceArns',
+                        TagsParam='tags', TagKeys=('key', 'value'), ReadIdList=True, ReadPath=('resourceTags',),
+                        ReadEach='tags', ReadIdKey='resourceArn', MaxReadBatch=20, Rate=(2, 10), Workers=2,
+                        CsvNames=('AWSDirecttConnect', 'AWSDirectConnect'), Untag='untag_resource',
+                        UntagParam='tagKeys',
+                        Lists=(ResourceList('describe_connections', ('connections',), 'connectionId', Paginated=False,
+                                            Arn='arn:{Partition}:directconnect:{Region}:{Account}:dxcon/{Id}'),)))
+
+Register(ServiceAdapter('datapipeline', 'add_tags', 'pipelineId', 'describe_pipelines', 'pipelineIds', IdForm='id',
+                        GetId=GetResourceName, TagsParam='tags', TagKeys=('key', 'value'), ReadIdList=True,
+                        ReadPath=('pipelineDescriptionList',), ReadEach='tags', ReadIdKey='pipelineId',
+                        MaxReadBatch=25, CsvNames=('datapipeline',), Untag='remove_tags', UntagParam='tagKeys',
+                        Lists=(ResourceList('list_pipelines', ('pipelineIdList',), 'id'),)))
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: every csv service name maps to a registered service', end='')
+    assert all(GetAdapter(Service) for Service in GetCsvNames().values())
+    print('...OK')
+    print('TEST 2: build write parameters', end='')
+    Params = GetAdapter('route53').GetWriteParams(['Z1'], {'Channel': 'web'})
+    assert Params == {'ResourceType': 'hostedzone', 'ResourceId': 'Z1', 'AddTags': [{'Key': 'Channel', 'Value': 'web'}]}
+    assert GetAdapter('ec2').GetReadParams(['i-1', 'i-2'])['Filters'][0]['Values'] == ['i-1', 'i-2']
+    print('...OK')
+    print('TEST 3: every service can remove tags', end='')
+    assert all(GetAdapter(Service).Untag or GetAdapter(Service).UntagAll for Service in GetServiceNames())
+    Params = GetAdapter('cloudfront').GetUntagParams(['arn:aws:cloudfront::123456789012:distribution/E1'], ['A'])
+    assert Params['TagKeys'] == {'Items': ['A']}
+    assert GetAdapter('ec2').GetUntagParams(['i-1', 'i-2'], ['A'])['Tags'] == [{'Key': 'A'}]
+    print('...OK')
+    print('TEST 4: parse read responses', end='')
+    Response = {'resourceTags': [{'resourceArn': 'a', 'tags': [{'key': 'Channel', 'value': 'web'}]}]}
+    assert GetAdapter('directconnect').ParseTags(Response) == {'Channel': 'web'}
+    assert GetAdapter('redshift').ParseTags({'TaggedResources': [{'Tag': {'Key': 'A', 'Value': 'b'}}]}) == {'A': 'b'}
+    print('...OK')
+    print('TEST 5: parse read responses of several resources', end='')
+    Response = {'Tags': [{'ResourceId': 'i-1', 'Key': 'A', 'Value': 'b'},
+                         {'ResourceId': 'i-2', 'Key': 'A', 'Value': 'e'},
+                         {'ResourceId': 'i-1', 'Key': 'C', 'Value': 'd'}]}
+    assert GetAdapter('ec2').ParseTagsEach(Response) == {'i-1': {'A': 'b', 'C': 'd'}, 'i-2': {'A': 'e'}}
+    Response = {'pipelineDescriptionList': [{'pipelineId': 'df-1', 'tags': [{'key': 'A', 'value': 'b'}]},
+                                            {'pipelineId': 'df-2', 'tags': []}]}
+    assert GetAdapter('datapipeline').ParseTagsEach(Response) == {'df-1': {'A': 'b'}, 'df-2': {}}
+    assert sorted(Service for Service in GetServiceNames() if GetAdapter(Service).IsReadBatched()) == \
+           ['cloudtrail', 'datapipeline', 'directconnect', 'ec2']
+    print('...OK')
+    print('TEST 6: route resources to regions', end='')
+    assert GetResourceRegion('lambda', 'arn:aws:lambda:eu-west-1:123456789012:function:f', 'us-east-1') == 'eu-west-1'
+    assert GetResourceRegion('route53', 'Z1', 'eu-west-1') == 'us-east-1'
+    assert GetResourceRegion('ec2', 'i-1', 'ap-south-1') == 'ap-south-1' and GetResourceRegion('ec2', 'i-1') is None
+    print('...OK')
+    print('TEST 7: parse list responses into resource ids', end='')
+    assert all(GetAdapter(Service).Lists for Service in GetServiceNames())
+    Response = {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]},
+                                 {'Instances': [{'InstanceId': 'i-3'}]}]}
+    assert GetAdapter('ec2').Lists[0].ParseResources(Response) == [('i-1', None), ('i-2', None), ('i-3', None)]
+    Response = {'DistributionList': {'Items': [{'ARN': 'arn:aws:cloudfront::123456789012:distribution/E1'}]}}
+    assert GetAdapter('cloudfront').Lists[0].ParseResources(Response)[0][0].endswith('/E1')
+    assert GetAdapter('s3').Lists[0].ParseResources({'Buckets': [{'Name': 'b', 'BucketRegion': 'eu-west-1'}]}) == \
+           [('b', 'eu-west-1')]
+    assert GetAdapter('route53').Lists[0].ParseResources({'HostedZones': [{'Id': '/hostedzone/Z1'}]}) == [('Z1', None)]
+    assert GetAdapter('dynamodb').Lists[0].GetResourceId('t', 'us-east-1', '123456789012') == \
+           'arn:aws:dynamodb:us-east-1:123456789012:table/t'
+    print('...OK')
@@ -0,0 +1,280 @@
+"""This module provides fleet-wide renaming and removal of tag keys with batched writes and removals"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+### run as a script, i.e. python3 helper/aws/rekey.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.tag import UpdateTags, RemoveTags
+from aws.arn import IsArn
+from aws.batch import Ec2TagBatcher
+from aws.bulk import BulkTagger
+from aws.prefetch import TagIndex
+from aws.registry import GetServiceWorkers
+
+
+def ParseKeyChanges(Renames, Removals):
+    """Return dictionary of old tag name to new name, or None to remove it, from values formatted as Old=New and
+    a list of tag names to remove"""
+
+    Changes = {}
+    for Value in Renames:
+        if Value.count('=') != 1:
+            raise Exception('rename ' + Value + ' is not formatted as Old=New')
+        Old, New = Value.split('=')
+        if not Old or not New or Old == New:
+            raise Exception('rename ' + Value + ' needs two different tag names')
+        Changes[Old] = New
+    for Old in Removals:
+        Changes[Old] = None
+
+    if not Changes:
+        raise Exception('nothing to rename or remove')
+
+    return Changes
+
+
+class TagKeyMigrator:
+    """Rename or remove tag keys on every resource carrying them, found by bulk tag scans
+
+    Changes maps each old tag name to its new name, or to None to remove it. Resources
+    carrying an old name are found with ec2.describe_tags() and resourcegroupstaggingapi
+    .get_resources() scans of each account and region, so no input file is needed; each
+    scan is read to the end before anything is migrated, since a migrated resource drops
+    out of the pages of a scan filtered on its old name. A
+    renamed tag is first written under its new name with its old value, and the old name
+    is only removed from resources whose write succeeded, so a failure never loses a
+    value. If the new name already exists it keeps its value unless Overwrite is True;
+    the old name is removed either way. Resources are handled ChunkSize at a time to
+    bound the calls in flight: ec2 writes and removals are sent up to Ec2BatchSize ids per
+    create_tags() and delete_tags() call, with Bulk ARNs up to 20 per tag_resources() and
+    untag_resources() call, and everything else through the per-service methods on Workers
+    threads, capped per service like TagRunner. Every call is paced by aws.ratelimit. With
+    DryRun the changes are logged and counted but not made.
+    """
+
+    def __init__(self, L, Changes, Overwrite=False, Workers=16, Bulk=False, Ec2BatchSize=1000, ChunkSize=10000,
+                 ServiceWorkers=None, DryRun=False, Profile=None):
+        """Constructor"""
+
+        self.L = L
+        self.Changes = dict(Changes)
+        self.Overwrite = Overwrite
+        self.Workers = max(1, Workers)
+        self.Bulk = Bulk
+        self.Ec2BatchSize = Ec2BatchSize
+        self.ChunkSize = max(1, ChunkSize)
+        self.DryRun = DryRun
+        self.Profile = Profile
+        self.Scanner = TagIndex(Profile)
+
+        self.Total = 0
+        self.Succeeded = 0
+        self.Failed = 0
+        self.Written = 0
+        self.Removed = 0
+
+        ServiceCaps = GetServiceWorkers()
+        ServiceCaps.update(ServiceWorkers or {})
+        self.__Caps = {Service: threading.BoundedSemaphore(max(1, min(self.Workers, Cap))) \
+                       for Service, Cap in ServiceCaps.items()}
+        self.__Lock = threading.Lock()
+
+    def Log(self, Number, Msg, Level=0):
+        """Log a message tagged with its resource number"""
+
+        self.L.TeeLog('Rekey #' + str(Number) + ': ' + Msg, Level, Number)
+
+    def Run(self, Regions=None, Accounts=None):
+        """Scan every account and region, None being the base account and default region, and migrate the
+        resources found"""
+
+        Names = list(self.Changes) + [New for New in self.Changes.values() if New and New not in self.Changes]
+        for Account in Accounts or [None]:
+            for Region in Regions or [None]:
+                self.L.TeeLog('Rekey: scanning Region=' + str(Region or 'default') + ' Account=' \
+                              + str(Account or 'base'))
+                Chunk = []
+                for Resource in self.Scan(Names, Region, Account):
+                    Chunk.append(Resource)
+                    if len(Chunk) >= self.ChunkSize:
+                        self.Migrate(Chunk)
+                        Chunk = []
+                self.Migrate(Chunk)
+
+    def Scan(self, Names, Region=None, Account=None):
+        """Yield (Service, ResourceId, Tags, Region, Account) of resources carrying an old tag name; Names also
+        holds the new names so an ec2 scan tells whether they exist"""
+
+        for Service, ResourceId, Tags, Where in self.Scanner.ScanEc2(Names, Region, Account):
+            if any(Old in Tags for Old in self.Changes):
+                yield Service, ResourceId, Tags, Where, Account
+        ### the scan filters on the old names, so it is read to the end before a migration shifts its pages;
+        ### ec2 resources the tagging api lists as well were found by the ec2 scan
+        Found = list(self.Scanner.ScanTaggingApi(list(self.Changes), Region, Account))
+        for Service, ResourceId, Tags, Where in Found:
+            if Service != 'ec2':
+                yield Service, ResourceId, Tags, Where, Account
+
+    def GetChanges(self, Tags):
+        """Return (tags to write, tag names to remove, new names kept) for the tags a resource carries"""
+
+        Write = {}
+        Remove = []
+        Kept = []
+        for Old, New in self.Changes.items():
+            if Old not in Tags:
+                continue
+            if New is not None:
+                if New in Write or New in Tags and not self.Overwrite:
+                    Kept.append(New)
+                elif Tags.get(New) != Tags[Old]:
+                    Write[New] = Tags[Old]
+            Remove.append(Old)
+
+        return Write, Remove, Kept
+
+    def Migrate(self, Resources):
+        """Write the new tag names of a chunk of resources, then remove the old ones where the write succeeded"""
+
+        Writes = []
+        Removes = []
+        for Service, ResourceId, Tags, Region, Account in Resources:
+            with self.__Lock:
+                self.Total += 1
+                Number = self.Total
+            Write, Remove, Kept = self.GetChanges(Tags)
+            self.Log(Number, 'ResourceId=' + ResourceId + ' Service=' + Service \
+                     + (' Region=' + Region if Region else '') + (' Account=' + Account if Account else '') \
+                     + (' Write=' + ','.join(TagName + '=' + TagValue for TagName, TagValue in Write.items()) \
+                        if Write else '') + ' Remove=' + ','.join(Remove) \
+                     + (' Keep=' + ','.join(Kept) if Kept else ''))
+            if Write:
+                Writes.append((Number, Service, ResourceId, Write, Region, Account))
+            Removes.append((Number, Service, ResourceId, Remove, Region, Account))
+
+        if self.DryRun:
+            with self.__Lock:
+                self.Succeeded += len(Removes)
+            return
+
+        Failed = self.Send(Writes)
+        with self.__Lock:
+            self.Written += len(Writes) - len(Failed)
+        for Number, Error in Failed.items():
+            self.Log(Number, 'Failed to write new tag names, keeping the old ones: ' + Error, 1)
+
+        Removes = [Remove for Remove in Removes if Remove[0] not in Failed]
+        Errors = self.Send(Removes, True)
+        for Number, Error in Errors.items():
+            self.Log(Number, 'Failed to remove old tag names: ' + Error, 1)
+        with self.__Lock:
+            self.Removed += len(Removes) - len(Errors)
+            self.Succeeded += len(Removes) - len(Errors)
+            self.Failed += len(Failed) + len(Errors)
+
+    def Send(self, Items, Remove=False):
+        """Write tags, or remove tag names, of (Number, Service, ResourceId, Tags, Region, Account) items with the
+        fewest calls; returns dictionary of Number to error message of the items that failed"""
+
+        Batcher = Ec2TagBatcher(self.Ec2BatchSize, Profile=self.Profile, Remove=Remove) \
+                  if self.Ec2BatchSize > 0 else None
+        Bulk = BulkTagger(Profile=self.Profile, Remove=Remove) if self.Bulk else None
+        Failed = {}
+
+        def Report(Results):
+            """Record failures of (Number, ResourceId, Error) batch results"""
+
+            for Number, ResourceId, Error in Results:
+                if Error is not None:
+                    Failed[Number] = Error
+
+        def SendOne(Number, Service, ResourceId, Tags, Region, Account):
+            """Queue an item on a batch, or send it alone with the per-service method"""
+
+            if Batcher and Service == 'ec2':
+                Report(Batcher.Add(ResourceId, Tags, Number, Region, Account))
+            elif Bulk and IsArn(ResourceId):
+                Report(Bulk.Add(Service, ResourceId, Tags, Number, Region, Account))
+            else:
+                Cap = self.__Caps.get(Service)
+                try:
+                    if Cap:
+                        Cap.acquire()
+                    if Remove:
+                        RemoveTags(Service, ResourceId, Tags, Region, self.Profile, Account)
+                    else:
+                        UpdateTags(Service, ResourceId, Tags, Region, self.Profile, Account)
+                except Exception as e:
+                    Failed[Number] = str(e)
+                finally:
+                    if Cap:
+                        Cap.release()
+
+        with ThreadPoolExecutor(max_workers=self.Workers, thread_name_prefix='rekey') as Executor:
+            for Future in [Executor.submit(SendOne, *Item) for Item in Items]:
+                Future.result()
+            if Bulk:
+                Report(Bulk.Flush())
+            if Batcher:
+                Report(Batcher.Flush())
+
+        return Failed
+
+    def GetCounts(self):
+        """Return counters as dictionary, i.e. for a progress line"""
+
+        return {'Total': self.Total, 'Successful': self.Succeeded, 'Failed': self.Failed}
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return 'Rekey: Resources=' + str(self.Total) + ' Successful=' + str(self.Succeeded) + ' Failed=' \
+               + str(self.Failed) + ' Written=' + str(self.Written) + ' Removed=' + str(self.Removed) \
+               + ' ScanCalls=' + str(self.Scanner.CallsCount) + (' DryRun' if self.DryRun else '')
+
+if __name__ == '__main__':
+    from aws.fake import InstallFake, QuietLog
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    for Number in range(2500):
+        Fake.Put('ec2', 'i-%017x' % Number, {'channel': 'web' if Number % 2 else 'api', 'Owner': 'ops'})
+    Arns = ['arn:aws:lambda:us-east-1:123456789012:function:fn-%d' % Number for Number in range(50)]
+    for Arn in Arns:
+        Fake.Put('lambda', Arn, {'channel': 'web', 'Legacy': 'yes'})
+    Fake.Put('lambda', Arns[0], {'Channel': 'mobile'})
+    print('TEST 1: parse renames and removals', end='')
+    assert ParseKeyChanges(['channel=Channel'], ['Legacy']) == {'channel': 'Channel', 'Legacy': None}
+    try:
+        ParseKeyChanges(['channel=channel'], [])
+        assert False
+    except Exception as e:
+        assert 'two different' in str(e)
+    print('...OK')
+    print('TEST 2: a dry run changes nothing', end='')
+    Migrator = TagKeyMigrator(QuietLog(), {'channel': 'Channel'}, DryRun=True)
+    Migrator.Run()
+    assert Migrator.Total == 2550 and Fake.GetTags('ec2', 'i-%017x' % 1) == {'channel': 'web', 'Owner': 'ops'}
+    print('...OK')
+    print('TEST 3: rename and remove keys with batched calls', end='')
+    Calls = Fake.GetCalls()
+    Migrator = TagKeyMigrator(QuietLog(), {'channel': 'Channel', 'Legacy': None}, Bulk=True, ChunkSize=1000)
+    Migrator.Run()
+    Calls = {Key: Count - Calls.get(Key, 0) for Key, Count in Fake.GetCalls().items() if Count > Calls.get(Key, 0)}
+    assert Migrator.GetCounts() == {'Total': 2550, 'Successful': 2550, 'Failed': 0}
+    assert Fake.GetTags('ec2', 'i-%017x' % 1) == {'Channel': 'web', 'Owner': 'ops'}
+    assert Fake.GetTags('lambda', Arns[1]) == {'Channel': 'web'}
+    assert Fake.GetTags('lambda', Arns[0]) == {'Channel': 'mobile'}
+    assert Calls[('ec2', 'create_tags')] <= 6 and Calls[('ec2', 'delete_tags')] <= 3
+    assert Calls[('resourcegroupstaggingapi', 'untag_resources')] == 3
+    print('...OK')
+    print('TEST 4: resources of every page of the scan are migrated, not only those left on later pages', end='')
+    Arns = ['arn:aws:lambda:us-east-1:123456789012:function:old-%d' % Number for Number in range(300)]
+    for Arn in Arns:
+        Fake.Put('lambda', Arn, {'Old': 'yes'})
+    Migrator = TagKeyMigrator(QuietLog(), {'Old': 'New'}, ChunkSize=100)
+    Migrator.Run()
+    assert Migrator.GetCounts() == {'Total': 300, 'Successful': 300, 'Failed': 0}
+    assert all(Fake.GetTags('lambda', Arn) == {'New': 'yes'} for Arn in Arns)
+    print('...OK')
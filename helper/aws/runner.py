@@ -0,0 +1,397 @@
+"""This module provides the per-row tagging pipeline used by update-tags.py, sequential or on threads"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aws.tag import UpdateTags, GetTags
+from aws.arn import IsArn
+from aws.registry import GetServiceWorkers, GetResourceRegion
+from aws.account import GetResourceAccount
+
+
+def FormatTags(Tags):
+    """Return tags dictionary as text, i.e. Channel=web,Owner=ops"""
+
+    return ','.join(str(TagName) + '=' + str(TagValue) for TagName, TagValue in Tags.items())
+
+
+def FormatSummary(Counts, Regions, Accounts):
+    """Return the summary line of counters as returned by GetCounts() and rows per region and account"""
+
+    Summary = 'Summary: Total=' + str(Counts['Total']) + ' Successful=' + str(Counts['Successful']) + ' Skip=' \
+              + str(Counts['Skip']) + ' Failed=' + str(Counts['Failed'])
+    if len(Regions) > 1:
+        Summary += ' Regions=' + ','.join(str(Region or 'default') + ':' + str(Rows) \
+                                         for Region, Rows in sorted(Regions.items(), key=str))
+    if len(Accounts) > 1:
+        Summary += ' Accounts=' + ','.join(str(Account or 'base') + ':' + str(Rows) \
+                                          for Account, Rows in sorted(Accounts.items(), key=str))
+
+    return Summary
+
+
+class TagRunner:
+    """Check and update the tags of each submitted row and keep Total/Successful/Skip/Failed counters
+
+    Each row carries a dictionary of tag name to value. Tags valued Unknown or None are
+    dropped, and when Overwrite is False so are tags the resource already has; whatever
+    remains is written in one call, and a row with nothing left counts as skipped.
+
+    Each row is routed to the region of its ARN or queue URL, the home region of a global
+    service, or the region the report gives, and every AWS call for it goes there; calls
+    for resources of a linked account are made through its assumed role, see aws.account.
+    With Workers of 1 rows are processed in the calling thread in input order. With more,
+    each account and region is a shard with a budget of its own, since AWS limits apply
+    per account and region: at most Workers rows of a shard run at once and at most
+    Workers * 4 wait in memory, and each service of the shard gets its own thread pool
+    capped by ServiceWorkers so a slow or tightly throttled service cannot occupy every
+    worker. With a Reader, rows whose service reads many ids per call wait for the
+    existing tags of a whole batch of resources, see TagReadBatcher, and the writes left
+    once a batch is read go back on the pool of their service. Every log line is prefixed
+    with its row number so interleaved output can be followed.
+    """
+
+    ### default per-service concurrency caps for services with tight tagging api limits
+    ServiceWorkers = GetServiceWorkers()
+
+    def __init__(self, L, Overwrite=False, Workers=1, ServiceWorkers=None, Index=None, Batcher=None, Bulk=None,
+                 S3Merger=None, Journal=None, Reader=None):
+        """Constructor"""
+
+        self.L = L
+        self.Overwrite = Overwrite
+        self.Workers = max(1, Workers)
+        self.ServiceWorkers = dict(TagRunner.ServiceWorkers)
+        self.ServiceWorkers.update(ServiceWorkers or {})
+        self.Index = Index
+        self.Batcher = Batcher
+        self.Bulk = Bulk
+        self.S3Merger = S3Merger
+        self.Journal = Journal
+        self.Reader = Reader
+
+        self.Total = 0
+        self.Succeeded = 0
+        self.Skipped = 0
+        self.Failed = 0
+        self.Regions = {}
+        self.Accounts = {}
+
+        self.__Lock = threading.Lock()
+        self.__Shards = {}
+
+    def Log(self, Row, Msg, Level=0):
+        """Log a message tagged with its row number"""
+
+        self.L.TeeLog('Tag #' + str(Row) + ': ' + Msg, Level, Row)
+
+    def Count(self, Row, ResourceId, Succeeded=0, Skipped=0, Failed=0, Outcome=None):
+        """Add a finished row to counters and to the journal; Outcome defaults to ok, skip or fail"""
+
+        with self.__Lock:
+            self.Succeeded += Succeeded
+            self.Skipped += Skipped
+            self.Failed += Failed
+
+        if self.Journal:
+            self.Journal.Record(Row, ResourceId, Outcome if Outcome else 'ok' if Succeeded else 'skip' \
+                                if Skipped else 'fail')
+
+    def Submit(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Process a row now, or queue it on the thread pool of its account, region and service"""
+
+        Region = GetResourceRegion(Service, ResourceId, Region)
+        Account = GetResourceAccount(ResourceId, Account)
+        with self.__Lock:
+            self.Total += 1
+            self.Regions[Region] = self.Regions.get(Region, 0) + 1
+            self.Accounts[Account] = self.Accounts.get(Account, 0) + 1
+
+        self.Log(Row, 'ResourceId=' + str(ResourceId) + ' Tags=' + FormatTags(Tags) + ' Service=' + str(Service) \
+                 + (' Region=' + Region if Region else '') + (' Account=' + Account if Account else ''))
+
+        ### skip tags whose value is Unknown or None
+        Skipped = [TagName for TagName, TagValue in Tags.items() if TagValue.lower() in ('unknown', 'none')]
+        if len(Skipped) == len(Tags):
+            self.Log(Row, 'Skip update since tag equals None or Unknown')
+            self.Count(Row, ResourceId, Skipped=1)
+            return
+        if Skipped:
+            self.Log(Row, 'Skip tag ' + ', '.join(Skipped) + ' since it equals None or Unknown')
+            Tags = {TagName: TagValue for TagName, TagValue in Tags.items() if TagName not in Skipped}
+
+        if self.Workers == 1:
+            self.ProcessRow(Row, Service, ResourceId, Tags, Region, Account)
+            return
+
+        Shard = self.__GetShard(Region, Account)
+        Shard.Queued.acquire()
+        try:
+            Future = Shard.GetExecutor(Service).submit(self.__RunRow, Shard, Row, Service, ResourceId, Tags)
+        except Exception:
+            Shard.Queued.release()
+            raise
+        Future.add_done_callback(lambda F: Shard.Queued.release())
+
+    def ProcessRow(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Drop tags which exist when Overwrite is False, then update or queue the rest"""
+
+        ### queue s3 tags for one read and one write per bucket, which also decides what exists
+        if self.S3Merger and Service == 's3':
+            self.ReportMergeResults(self.S3Merger.Add(ResourceId, Tags, Row, Region, Account))
+            return
+
+        ### skip tags which already exist if Overwrite is False
+        if not self.Overwrite:
+            Existing = self.GetIndexedTagNames(Service, ResourceId, Tags, Region, Account)
+            ### queue the read for one call with the other resources of its service if the index cannot tell
+            if Existing is None and self.Reader and self.Reader.IsBatched(Service):
+                self.ReportReadResults(self.Reader.Add(Service, ResourceId, (Row, Service, Tags, Region, Account),
+                                                       Region, Account))
+                return
+            try:
+                if Existing is None:
+                    Existing = self.GetExistingTagNames(Service, ResourceId, Tags, Region, Account)
+            except Exception as e:
+                self.SkipUnverified(Row, ResourceId, Tags, str(e))
+                return
+            Tags = self.DropExistingTags(Row, ResourceId, Tags, Existing)
+            if not Tags:
+                return
+
+        self.WriteRow(Row, Service, ResourceId, Tags, Region, Account)
+
+    def WriteRow(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Update the tags of a row, or queue them for a bulk or batched update"""
+
+        ### queue ARN for a bulk update
+        if self.Bulk and IsArn(ResourceId):
+            self.ReportResults(self.Bulk.Add(Service, ResourceId, Tags, Row, Region, Account))
+            return
+
+        ### queue ec2 tags for a batched update
+        if self.Batcher and Service == 'ec2':
+            self.ReportResults(self.Batcher.Add(ResourceId, Tags, Row, Region, Account))
+            return
+
+        ### update tags
+        try:
+            if UpdateTags(Service, ResourceId, Tags, Region, Account=Account):
+                self.Log(Row, 'Successfully updated resourceid=' + ResourceId)
+                self.Count(Row, ResourceId, Succeeded=1)
+            else:
+                self.Log(Row, 'Failed to update resourceid=' + ResourceId)
+                self.Count(Row, ResourceId, Failed=1)
+        except Exception as e:
+            self.Log(Row, 'Failed to update resourceid=' + ResourceId + ': ' + str(e))
+            self.Count(Row, ResourceId, Failed=1)
+
+    def GetExistingTagNames(self, Service, ResourceId, Tags, Region=None, Account=None):
+        """Return names of tags the resource already has, asking AWS only if the index cannot tell"""
+
+        Existing = self.GetIndexedTagNames(Service, ResourceId, Tags, Region, Account)
+        if Existing is None:
+            Current = GetTags(Service, ResourceId, Region, Account=Account)
+            Existing = [TagName for TagName in Tags if TagName in Current]
+
+        return Existing
+
+    def GetIndexedTagNames(self, Service, ResourceId, Tags, Region=None, Account=None):
+        """Return names of tags the resource already has according to the index, or None if it cannot tell for
+        every tag; the index only holds resources of the base account"""
+
+        Index = self.Index if Account is None else None
+        if Index is None:
+            return None
+        Exists = {TagName: Index.IsTagExists(Service, ResourceId, TagName, Region) for TagName in Tags}
+        if None in Exists.values():
+            return None
+
+        return [TagName for TagName in Tags if Exists[TagName]]
+
+    def DropExistingTags(self, Row, ResourceId, Tags, Existing):
+        """Return the tags left to write once the Existing tag names are dropped, counting the row as skipped if
+        none is left"""
+
+        if len(Existing) == len(Tags):
+            self.Log(Row, 'Skip update for ' + ResourceId + ' since tag ' + ', '.join(Existing) \
+                     + ' exists and Overwrite is ' + str(self.Overwrite))
+            self.Count(Row, ResourceId, Skipped=1)
+            return {}
+        if Existing:
+            self.Log(Row, 'Skip tag ' + ', '.join(Existing) + ' since it exists and Overwrite is ' \
+                     + str(self.Overwrite))
+
+        return {TagName: TagValue for TagName, TagValue in Tags.items() if TagName not in Existing}
+
+    def SkipUnverified(self, Row, ResourceId, Tags, Error):
+        """Count a row as skipped since its existing tags could not be read"""
+
+        self.Log(Row, 'Skip update since we cannot verify whether tag name ' + ', '.join(Tags) + ' exists: ' \
+                 + Error, 1)
+        self.Count(Row, ResourceId, Skipped=1, Outcome='unverified')
+
+    def ReportReadResults(self, Results):
+        """Drop existing tags of (Ref, ResourceId, Tags, Error) results of TagReadBatcher, then update the rest"""
+
+        ### rows of one resource share a read, so a later row must also see the tags an earlier one writes
+        Written = {}
+        for (Row, Service, Tags, Region, Account), ResourceId, Current, Error in Results:
+            if Error is not None:
+                self.SkipUnverified(Row, ResourceId, Tags, Error)
+                continue
+            Existing = [TagName for TagName in Tags if TagName in Current or TagName in Written.get(ResourceId, ())]
+            Tags = self.DropExistingTags(Row, ResourceId, Tags, Existing)
+            if Tags:
+                Written.setdefault(ResourceId, set()).update(Tags)
+                self.SubmitWrite(Row, Service, ResourceId, Tags, Region, Account)
+
+    def SubmitWrite(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Write the tags of a row now, or queue the write on the thread pool of its account, region and service"""
+
+        if self.Workers == 1:
+            self.WriteRow(Row, Service, ResourceId, Tags, Region, Account)
+            return
+
+        ### a worker may queue writes, so waiting for a Queued slot here could wait on itself
+        Shard = self.__GetShard(Region, Account)
+        try:
+            Shard.GetExecutor(Service).submit(self.__RunWrite, Shard, Row, Service, ResourceId, Tags)
+        except RuntimeError:
+            ### the pool of the service is shutting down in Finish()
+            self.WriteRow(Row, Service, ResourceId, Tags, Region, Account)
+
+    def ReportResults(self, Results):
+        """Log and count (Row, ResourceId, Error) results of Ec2TagBatcher or BulkTagger"""
+
+        for Row, ResourceId, Error in Results:
+            if Error is None:
+                self.Log(Row, 'Successfully updated resourceid=' + ResourceId)
+                self.Count(Row, ResourceId, Succeeded=1)
+            else:
+                self.Log(Row, 'Failed to update resourceid=' + ResourceId + ': ' + Error)
+                self.Count(Row, ResourceId, Failed=1)
+
+    def ReportMergeResults(self, Results):
+        """Log and count (Row, ResourceId, WrittenTags, SkippedTagNames, Error) results of S3TagMerger"""
+
+        for Row, ResourceId, Written, Skipped, Error in Results:
+            if not Written:
+                self.Log(Row, 'Skip update for ' + ResourceId + ' since tag ' + ', '.join(Skipped) \
+                         + ' exists and Overwrite is ' + str(self.Overwrite))
+                self.Count(Row, ResourceId, Skipped=1)
+                continue
+            if Skipped:
+                self.Log(Row, 'Skip tag ' + ', '.join(Skipped) + ' since it exists and Overwrite is ' \
+                         + str(self.Overwrite))
+            if Error is None:
+                self.Log(Row, 'Successfully updated resourceid=' + ResourceId)
+                self.Count(Row, ResourceId, Succeeded=1)
+            else:
+                self.Log(Row, 'Failed to update resourceid=' + ResourceId + ': ' + Error)
+                self.Count(Row, ResourceId, Failed=1)
+
+    def Finish(self):
+        """Wait for queued rows, then read the remaining coalesced tags and update the remaining batched tags"""
+
+        for Shard in list(self.__Shards.values()):
+            Shard.Shutdown()
+        self.__Shards.clear()
+
+        if self.Reader:
+            with ThreadPoolExecutor(max_workers=self.Workers, thread_name_prefix='tag-read') as Executor:
+                for Results in Executor.map(lambda Group: self.Reader.FlushGroup(*Group), self.Reader.PopAll()):
+                    self.ReportReadResults(Results)
+            ### wait for the writes the last reads queued
+            for Shard in list(self.__Shards.values()):
+                Shard.Shutdown()
+            self.__Shards.clear()
+
+        if self.S3Merger:
+            Buckets = self.S3Merger.PopAll()
+            Workers = min(self.Workers, self.ServiceWorkers.get('s3', self.Workers))
+            with ThreadPoolExecutor(max_workers=Workers, thread_name_prefix='tag-s3') as Executor:
+                for Results in Executor.map(lambda Bucket: self.S3Merger.FlushBucket(*Bucket), Buckets):
+                    self.ReportMergeResults(Results)
+
+        if self.Bulk:
+            self.ReportResults(self.Bulk.Flush())
+        if self.Batcher:
+            self.ReportResults(self.Batcher.Flush())
+
+    def GetCounts(self):
+        """Return counters as dictionary, i.e. for a progress line"""
+
+        return {'Total': self.Total, 'Successful': self.Succeeded, 'Skip': self.Skipped, 'Failed': self.Failed}
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return FormatSummary(self.GetCounts(), self.Regions, self.Accounts)
+
+    def __RunRow(self, Shard, Row, Service, ResourceId, Tags):
+        """ProcessRow() on a worker thread, holding one of the Workers slots of its region"""
+
+        with Shard.Running:
+            try:
+                self.ProcessRow(Row, Service, ResourceId, Tags, Shard.Region, Shard.Account)
+            except Exception as e:
+                self.Log(Row, 'Failed to process resourceid=' + str(ResourceId) + ': ' + str(e), 1)
+                self.Count(Row, ResourceId, Failed=1)
+
+    def __RunWrite(self, Shard, Row, Service, ResourceId, Tags):
+        """WriteRow() on a worker thread, holding one of the Workers slots of its region"""
+
+        with Shard.Running:
+            try:
+                self.WriteRow(Row, Service, ResourceId, Tags, Shard.Region, Shard.Account)
+            except Exception as e:
+                self.Log(Row, 'Failed to update resourceid=' + str(ResourceId) + ': ' + str(e), 1)
+                self.Count(Row, ResourceId, Failed=1)
+
+    def __GetShard(self, Region, Account=None):
+        """Return the shard of an account and region, created on first use"""
+
+        with self.__Lock:
+            Shard = self.__Shards.get((Account, Region))
+            if Shard is None:
+                Shard = RegionShard(Region, self.Workers, self.ServiceWorkers, Account)
+                self.__Shards[(Account, Region)] = Shard
+
+        return Shard
+
+
+class RegionShard:
+    """Concurrency budget of one region of an account: Workers running rows, Workers * 4 queued rows and a pool
+    per service"""
+
+    def __init__(self, Region, Workers, ServiceWorkers, Account=None):
+        """Constructor"""
+
+        self.Region = Region
+        self.Account = Account
+        self.Workers = Workers
+        self.ServiceWorkers = ServiceWorkers
+        self.Running = threading.BoundedSemaphore(Workers)
+        self.Queued = threading.BoundedSemaphore(Workers * 4)
+        self.__Executors = {}
+        self.__Lock = threading.Lock()
+
+    def GetExecutor(self, Service):
+        """Return the thread pool of a service, created on first use"""
+
+        with self.__Lock:
+            Executor = self.__Executors.get(Service)
+            if Executor is None:
+                Workers = min(self.Workers, self.ServiceWorkers.get(Service, self.Workers))
+                Executor = ThreadPoolExecutor(max_workers=max(1, Workers),
+                                              thread_name_prefix='tag-' + str(self.Account or 'base') + '-' \
+                                                                 + str(self.Region) + '-' + str(Service))
+                self.__Executors[Service] = Executor
+
+        return Executor
+
+    def Shutdown(self):
+        """Wait for every queued row of the shard"""
+
+        for Executor in list(self.__Executors.values()):
+            Executor.shutdown(wait=True)
+        self.__Executors.clear()
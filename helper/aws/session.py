@@ -0,0 +1,279 @@
+"""This module provides a session to update or read the tags of many resources from Python, streaming results"""
+import itertools
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+### run as a script, i.e. python3 helper/aws/session.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.tag import AwsTag
+from aws.batch import Ec2TagBatcher, S3TagMerger, TagReadBatcher
+from aws.bulk import BulkTagger
+from aws.runner import TagRunner
+from aws.ratelimit import ConfigureLimiters, GetLimiters
+
+
+class RowResults:
+    """Log and journal of the runner of a TagSession: keeps the latest message of each row in flight and
+    resolves the row's future with (Outcome, Message) once the runner records its outcome"""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.__Futures = {}
+        self.__Messages = {}
+        self.__Lock = threading.Lock()
+
+    def Add(self, Row, Future):
+        """Register the future of a row before it is submitted"""
+
+        with self.__Lock:
+            self.__Futures[Row] = Future
+
+    def TeeLog(self, Msg, Level=0, Row=None):
+        """Keep the latest message of a row, i.e. why it failed or was skipped"""
+
+        if Row is not None:
+            self.__Messages[Row] = Msg.split(': ', 1)[1] if Msg.startswith('Tag #') else Msg
+
+    def Record(self, Row, ResourceId, Outcome):
+        """Resolve the future of a row with its outcome: ok, skip, fail or unverified"""
+
+        with self.__Lock:
+            Future = self.__Futures.pop(Row, None)
+            Message = self.__Messages.pop(Row, None)
+        if Future is not None:
+            Future.set_result((Outcome, Message))
+
+    def GetPendingCount(self):
+        """Return number of rows whose outcome is not known yet"""
+
+        return len(self.__Futures)
+
+
+class TagSession:
+    """Update or read the tags of any number of resources, batching, parallelizing and rate limiting internally
+
+    An item is (Service, ResourceId, Tags), optionally followed by Region and Account as
+    rows of a report are; GetTags() ignores Tags, so (Service, ResourceId) is enough there.
+    UpdateTags() and GetTags() consume an iterable lazily and yield one result per item in
+    completion order, holding at most a bounded number of items in memory, so millions of
+    items stream through. Writes go through the TagRunner of update-tags.py with its ec2
+    batches, s3 merges and optional tagging api bulk writes, and, when Overwrite is False,
+    existence checks read many ids per call with ReadBatch, each account and region
+    running up to Workers calls at once; reads run on Workers threads. Every call is
+    paced by the rate limiters of aws.ratelimit, configured with Rate when RateLimit is
+    True and none exist yet. SubmitUpdate() and SubmitGet() are the futures-based
+    variant; batched writes resolve when their batch is sent, so call Flush() after the
+    last submit. A session is driven by one thread at a time; Close() flushes it.
+    """
+
+    def __init__(self, Workers=16, Overwrite=True, ServiceWorkers=None, Ec2BatchSize=1000, Bulk=False,
+                 S3Merge=True, ReadBatch=True, RateLimit=True, Rate=10.0, Profile=None):
+        """Constructor"""
+
+        if RateLimit and GetLimiters() is None:
+            ConfigureLimiters(Rate=Rate)
+
+        self.Workers = max(1, Workers)
+        self.Overwrite = Overwrite
+        self.Profile = Profile
+        self.__Results = RowResults()
+        self.__Runner = TagRunner(self.__Results, Overwrite, self.Workers, ServiceWorkers, None,
+                                  Ec2TagBatcher(Ec2BatchSize, Profile=Profile) if Ec2BatchSize > 0 else None,
+                                  BulkTagger(Profile=Profile) if Bulk else None,
+                                  S3TagMerger(Overwrite, Profile=Profile) if S3Merge else None, self.__Results,
+                                  TagReadBatcher(Profile) if ReadBatch and not Overwrite else None)
+        self.__Rows = itertools.count(1)
+        self.__Tags = {}
+        self.__Readers = None
+        self.__Lock = threading.Lock()
+
+    def __enter__(self):
+        """Return the session for a with statement"""
+
+        return self
+
+    def __exit__(self, *args):
+        """Flush and close the session at the end of a with statement"""
+
+        self.Close()
+
+    def SubmitUpdate(self, Service, ResourceId, Tags, Region=None, Account=None):
+        """Queue a tags update and return a future of (Outcome, Message), where Outcome is ok, skip, fail or
+        unverified and Message tells why a row failed or was skipped"""
+
+        Row = next(self.__Rows)
+        Result = Future()
+        self.__Results.Add(Row, Result)
+        try:
+            self.__Runner.Submit(Row, Service, ResourceId, Tags, Region, Account)
+        except Exception as e:
+            self.__Results.TeeLog(str(e), 1, Row)
+            self.__Results.Record(Row, ResourceId, 'fail')
+
+        return Result
+
+    def SubmitGet(self, Service, ResourceId, Region=None, Account=None):
+        """Queue a tags read and return a future of the tags dictionary"""
+
+        with self.__Lock:
+            if self.__Readers is None:
+                self.__Readers = ThreadPoolExecutor(max_workers=self.Workers, thread_name_prefix='session-read')
+
+        return self.__Readers.submit(self.GetTag(Service, Region, Account).GetTags, ResourceId)
+
+    def UpdateTags(self, Items):
+        """Update tags of every item and yield (Item, Outcome, Message) as each one finishes"""
+
+        Results = queue.Queue(self.Workers * 4)
+        Cancelled = threading.Event()
+        Done = object()
+
+        def Put(Result):
+            """Hand a result to the generator, giving up once it was closed"""
+
+            while not Cancelled.is_set():
+                try:
+                    Results.put(Result, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def Produce():
+            """Submit every item, then flush the batches and tell the generator it has seen every result"""
+
+            try:
+                for Item in Items:
+                    if Cancelled.is_set():
+                        break
+                    Result = self.SubmitUpdate(*Item)
+                    Result.add_done_callback(lambda F, Item=Item: Put((Item,) + F.result()))
+                self.Flush()
+            except Exception as e:
+                Put(e)
+            Put(Done)
+
+        Producer = threading.Thread(target=Produce, name='session-submit', daemon=True)
+        Producer.start()
+        try:
+            while True:
+                Result = Results.get()
+                if Result is Done:
+                    break
+                if isinstance(Result, Exception):
+                    raise Result
+                yield Result
+        finally:
+            Cancelled.set()
+            Producer.join()
+
+    def GetTags(self, Items):
+        """Read tags of every item and yield (Item, Tags, Error) as each one finishes; Error is None on success"""
+
+        Window = self.Workers * 4
+        Pending = {}
+        for Item in Items:
+            Pending[self.SubmitGet(Item[0], Item[1], *Item[3:5])] = Item
+            if len(Pending) >= Window:
+                Done, NotDone = wait(Pending, return_when=FIRST_COMPLETED)
+                for Result in Done:
+                    yield TagSession.__GetReadResult(Pending.pop(Result), Result)
+        for Result in list(Pending):
+            yield TagSession.__GetReadResult(Pending.pop(Result), Result)
+
+    def GetTag(self, Service, Region=None, Account=None):
+        """Return the AwsTag of a service, region and account, created on first use"""
+
+        Key = (Service, Region, Account)
+        Tag = self.__Tags.get(Key)
+        if Tag is None:
+            Tag = AwsTag(Service, Region, self.Profile, Account=Account)
+            self.__Tags[Key] = Tag
+
+        return Tag
+
+    def Flush(self):
+        """Wait for queued updates and send the remaining batches, resolving every submitted future"""
+
+        self.__Runner.Finish()
+
+    def Close(self):
+        """Flush updates and wait for queued reads"""
+
+        self.Flush()
+        with self.__Lock:
+            if self.__Readers is not None:
+                self.__Readers.shutdown(wait=True)
+                self.__Readers = None
+
+    def GetCounts(self):
+        """Return Total/Successful/Skip/Failed counters of updates"""
+
+        return self.__Runner.GetCounts()
+
+    def GetPendingCount(self):
+        """Return number of submitted updates whose outcome is not known yet"""
+
+        return self.__Results.GetPendingCount()
+
+    @staticmethod
+    def __GetReadResult(Item, Result):
+        """Return (Item, Tags, Error) of a finished read"""
+
+        try:
+            return (Item, Result.result(), None)
+        except Exception as e:
+            return (Item, None, str(e))
+
+if __name__ == '__main__':
+    from aws.fake import InstallFake
+    print('I prefer to be a module; however, I can run some tests')
+    Fake = InstallFake()
+    print('TEST 1: stream updates of a generator with one result per item', end='')
+    Items = (('ec2', 'i-%017x' % Number, {'Channel': 'web'}) for Number in range(3000))
+    with TagSession(Workers=8, RateLimit=False) as Session:
+        Outcomes = [Outcome for Item, Outcome, Message in Session.UpdateTags(Items)]
+        assert len(Outcomes) == 3000 and set(Outcomes) == {'ok'} and Session.GetPendingCount() == 0
+    assert Fake.GetTags('ec2', 'i-%017x' % 2999) == {'Channel': 'web'} and Fake.GetCallsCount() == 3
+    print('...OK')
+    print('TEST 2: skipped and failed items carry their reason', end='')
+    Items = [('sqs', 'https://sqs.us-east-1.amazonaws.com/123456789012/q', {'Channel': 'Unknown'}),
+             ('nosuchservice', 'r-1', {'Channel': 'web'})]
+    Results = {Item[0]: (Outcome, Message) for Item, Outcome, Message in TagSession(RateLimit=False).UpdateTags(Items)}
+    assert Results['sqs'][0] == 'skip' and 'Unknown' in Results['sqs'][1]
+    assert Results['nosuchservice'][0] == 'fail' and Results['nosuchservice'][1]
+    print('...OK')
+    print('TEST 3: read tags as a generator and through futures', end='')
+    Arn = 'arn:aws:lambda:us-east-1:123456789012:function:fn'
+    with TagSession(Workers=4, RateLimit=False) as Session:
+        Update = Session.SubmitUpdate('lambda', Arn, {'Owner': 'ops'})
+        Session.Flush()
+        assert Update.result() == ('ok', 'Successfully updated resourceid=' + Arn)
+        assert Session.SubmitGet('lambda', Arn).result() == {'Owner': 'ops'}
+        Reads = list(Session.GetTags(('ec2', 'i-%017x' % Number) for Number in range(100)))
+        assert len(Reads) == 100 and all(Tags == {'Channel': 'web'} and Error is None for Item, Tags, Error in Reads)
+    print('...OK')
+    print('TEST 4: closing a generator early stops consuming items', end='')
+    Consumed = []
+    Items = (Consumed.append(Number) or ('sqs', 'queue-%d' % Number, {'Channel': 'web'}) for Number in range(10 ** 6))
+    Session = TagSession(Workers=2, RateLimit=False)
+    Stream = Session.UpdateTags(Items)
+    next(Stream)
+    Stream.close()
+    assert len(Consumed) < 1000
+    print('...OK')
+    print('TEST 5: existing tags are read for many resources per call', end='')
+    Fake.Put('datapipeline', 'df-7', {'Channel': 'api'})
+    Items = [('ec2', 'i-%017x' % Number, {'Channel': 'web', 'Owner': 'ops'}) for Number in range(2900, 3300)]
+    Items += [('datapipeline', 'df-%d' % Number, {'Channel': 'web'}) for Number in range(50)]
+    Calls = Fake.GetCalls()
+    with TagSession(Workers=4, Overwrite=False, RateLimit=False) as Session:
+        Outcomes = [Outcome for Item, Outcome, Message in Session.UpdateTags(Items)]
+    Calls = {Key: Count - Calls.get(Key, 0) for Key, Count in Fake.GetCalls().items()}
+    assert Outcomes.count('ok') == 449 and Outcomes.count('skip') == 1
+    assert Calls[('ec2', 'describe_tags')] <= 4 and Calls[('datapipeline', 'describe_pipelines')] <= 4
+    assert Fake.GetTags('ec2', 'i-%017x' % 2999) == {'Channel': 'web', 'Owner': 'ops'}
+    print('...OK')
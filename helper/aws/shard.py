@@ -0,0 +1,332 @@
+"""This module provides multi-process execution of the tagging pipeline, with rows partitioned by resource id"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import zlib
+### run as a script, i.e. python3 helper/aws/shard.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aws.client import ConfigurePool
+from aws.batch import Ec2TagBatcher, S3TagMerger, TagReadBatcher
+from aws.bulk import BulkTagger
+from aws.runner import TagRunner, FormatSummary
+from aws.ratelimit import ConfigureLimiters, GetLimiters
+from aws.cache import ConfigureCache, GetCache
+from aws.account import ConfigureAccounts
+from aws.metrics import ConfigureMetrics, GetMetrics
+from services.journal import Journal
+
+
+def GetPartFileName(FileName, Number):
+    """Return the file a worker process writes instead of FileName, i.e. tagging-1.prom for tagging.prom"""
+
+    Root, Extension = os.path.splitext(FileName)
+
+    return Root + '-' + str(Number) + Extension
+
+def GetShard(ResourceId, Processes):
+    """Return the worker process of a resource id; the same id always goes to the same process"""
+
+    return zlib.crc32(str(ResourceId).encode()) % Processes
+
+
+class ShardedRunner:
+    """Run TagRunner in Processes worker processes, each with its own client pool, limiters and cache connection
+
+    Rows are partitioned by a hash of their resource id, so every row of a resource is
+    handled by the same process in input order, and sent in batches of BatchSize rows
+    over bounded queues, so a slow process holds back reading instead of filling memory.
+    Each process paces its calls at 1/Processes of the rates, since AWS limits apply per
+    account and region whichever process calls. Workers send their log records and
+    counters back in batches; a collector thread writes the records through L and keeps
+    the counters, so GetCounts() and GetSummary() cover every process. Finish() adds the
+    cache hits, call metrics and limiter rates of every process to those of this one, so
+    their summaries and metrics files cover every process as well. Each process journals
+    to a part of Journal, i.e. tagging.journal.1, merged into Journal by Finish() or,
+    after an interrupted run, by Journal.MergeParts(). Rows of a process which exits
+    early count as failed. Workers are never forked from this threaded process: they come
+    from a fork server, or are spawned, and are handed a pickled copy of the Index.
+
+    Options are the settings of each worker: Overwrite, Workers, ServiceWorkers,
+    Ec2BatchSize, Bulk, S3Merge, ReadBatch, MaxConnections and TcpKeepAlive, plus Rate, Metrics as
+    (json file, prom file, interval), Cache as (file, ttl, ttls) and AssumeRole as
+    (role, duration, external id), which are None when disabled.
+    """
+
+    def __init__(self, L, Processes, Options, Index=None, Journal=None, BatchSize=500):
+        """Constructor"""
+
+        self.L = L
+        self.Processes = max(1, Processes)
+        self.Options = dict(Options)
+        self.Journal = Journal
+        self.BatchSize = max(1, BatchSize)
+
+        self.Total = 0
+        self.Failed = 0
+        self.Regions = {}
+        self.Accounts = {}
+
+        self.__Lock = threading.Lock()
+        self.__Batches = [[] for Number in range(self.Processes)]
+        self.__Sent = [0] * self.Processes
+        self.__Counts = [None] * self.Processes
+        self.__Stats = [None] * self.Processes
+        self.__Done = set()
+        self.__Dead = set()
+
+        ### by now this process runs the log, metrics and collector threads and holds pooled connections, whose
+        ### locks a forked child could inherit held; the fork server is started clean and forks each worker with
+        ### this module already imported, and spawn is used where there is no fork server
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            Context = multiprocessing.get_context('forkserver')
+            Context.set_forkserver_preload(['aws.runner', 'aws.batch', 'aws.bulk', 'aws.metrics'])
+        else:
+            Context = multiprocessing.get_context('spawn')
+        Fingerprint = Journal.Fingerprint if Journal else None
+        self.__Results = Context.Queue()
+        self.__Queues = [Context.Queue(maxsize=8) for Number in range(self.Processes)]
+        self.__Workers = [Context.Process(target=RunShard, name='tag-shard-' + str(Number), daemon=True,
+                                          args=(Number, self.Processes, self.Options, Index,
+                                                Journal.GetPartName(Number) if Journal else None, Fingerprint,
+                                                self.__Queues[Number], self.__Results)) \
+                          for Number in range(self.Processes)]
+        for Worker in self.__Workers:
+            Worker.start()
+        self.__Collector = threading.Thread(target=self.__Collect, name='tag-shard-collector', daemon=True)
+        self.__Collector.start()
+
+    def Submit(self, Row, Service, ResourceId, Tags, Region=None, Account=None):
+        """Queue a row for the worker process of its resource id"""
+
+        Number = GetShard(ResourceId, self.Processes)
+        with self.__Lock:
+            self.Total += 1
+        self.__Batches[Number].append((Row, Service, ResourceId, Tags, Region, Account))
+        if len(self.__Batches[Number]) >= self.BatchSize:
+            self.__Send(Number)
+
+    def Finish(self):
+        """Send the remaining rows, wait for every process, then merge their journals and statistics"""
+
+        for Number in range(self.Processes):
+            if self.__Batches[Number]:
+                self.__Send(Number)
+            self.__Put(Number, None)
+        for Worker in self.__Workers:
+            Worker.join()
+
+        ### workers flushed everything before exiting, so the collector reads this last
+        self.__Results.put(None)
+        self.__Collector.join()
+
+        for Number, Worker in enumerate(self.__Workers):
+            Counts = self.__Counts[Number] or {'Successful': 0, 'Skip': 0, 'Failed': 0}
+            Missing = self.__Sent[Number] - Counts['Successful'] - Counts['Skip'] - Counts['Failed']
+            if Missing > 0 or Number not in self.__Done:
+                self.L.TeeLog('Shard #' + str(Number) + ': Exited with code ' + str(Worker.exitcode) + '; ' \
+                              + str(max(0, Missing)) + ' rows count as failed', 1)
+                with self.__Lock:
+                    self.Failed += max(0, Missing)
+            if self.Journal:
+                self.Journal.Merge(self.Journal.GetPartName(Number))
+            if self.__Stats[Number]:
+                self.MergeStats(Number, self.__Stats[Number])
+
+    def MergeStats(self, Number, Stats):
+        """Add the cache hits, call metrics and limiter rates of a process to those of this process"""
+
+        Cache, Metrics, Limiters = GetCache(), GetMetrics(), GetLimiters()
+        if Cache and 'Cache' in Stats:
+            Cache.Hits += Stats['Cache'][0]
+            Cache.Misses += Stats['Cache'][1]
+        if Metrics and 'Calls' in Stats:
+            Metrics.Merge(Stats['Calls'])
+        if Limiters and 'Rates' in Stats:
+            Limiters.Merge(Stats['Rates'])
+        if 'Accounts' in Stats:
+            self.L.TeeLog('Shard #' + str(Number) + ': Accounts: Assumed=' + str(Stats['Accounts'][0]) \
+                          + ' AssumeCalls=' + str(Stats['Accounts'][1]))
+
+    def GetCounts(self):
+        """Return counters of every process as dictionary, i.e. for a progress line"""
+
+        Counts = {'Total': self.Total, 'Successful': 0, 'Skip': 0, 'Failed': self.Failed}
+        for Shard in list(self.__Counts):
+            for Name in ('Successful', 'Skip', 'Failed'):
+                Counts[Name] += Shard[Name] if Shard else 0
+
+        return Counts
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return FormatSummary(self.GetCounts(), self.Regions, self.Accounts) + ' Processes=' + str(self.Processes)
+
+    def __Send(self, Number):
+        """Send the pending rows of a process; rows of a process which exited count as failed"""
+
+        Batch = self.__Batches[Number]
+        self.__Batches[Number] = []
+        if self.__Put(Number, Batch):
+            self.__Sent[Number] += len(Batch)
+            return
+
+        for Row, Service, ResourceId, Tags, Region, Account in Batch:
+            self.L.TeeLog('Tag #' + str(Row) + ': Failed to update resourceid=' + str(ResourceId) + ' since shard #' \
+                          + str(Number) + ' exited', 1, Row)
+        with self.__Lock:
+            self.Failed += len(Batch)
+
+    def __Put(self, Number, Batch):
+        """Put a batch on the queue of a process, waiting while it is full; return False if the process exited"""
+
+        while Number not in self.__Dead:
+            try:
+                self.__Queues[Number].put(Batch, timeout=1.0)
+                return True
+            except queue.Full:
+                if not self.__Workers[Number].is_alive():
+                    self.__Dead.add(Number)
+
+        return False
+
+    def __Collect(self):
+        """Write log records and keep counters sent by the workers until Finish() sends None"""
+
+        for Message in iter(self.__Results.get, None):
+            if Message[0] == 'log':
+                Kind, Number, Records, Counts = Message
+                for Msg, Level, Row in Records:
+                    self.L.TeeLog(Msg, Level, Row)
+                if Counts:
+                    self.__Counts[Number] = Counts
+            elif Message[0] == 'done':
+                Kind, Number, Counts, Regions, Accounts, Stats = Message
+                with self.__Lock:
+                    for Region, Rows in Regions.items():
+                        self.Regions[Region] = self.Regions.get(Region, 0) + Rows
+                    for Account, Rows in Accounts.items():
+                        self.Accounts[Account] = self.Accounts.get(Account, 0) + Rows
+                self.__Counts[Number] = Counts
+                self.__Stats[Number] = Stats
+                self.__Done.add(Number)
+
+
+class QueueLog:
+    """Log of a worker process which sends its records with the counters of the worker to the coordinator"""
+
+    def __init__(self, Number, Queue, FlushEvery=256):
+        """Constructor"""
+
+        self.Number = Number
+        self.Queue = Queue
+        self.FlushEvery = FlushEvery
+        self.GetCounts = None
+        self.__Records = []
+        self.__Lock = threading.Lock()
+
+    def TeeLog(self, msg=None, level=0, Row=None):
+        """Queue a record, sending the queue once FlushEvery records are pending"""
+
+        if msg is None:
+            return
+        with self.__Lock:
+            self.__Records.append((msg, level, Row))
+            if len(self.__Records) < self.FlushEvery:
+                return
+        self.Flush()
+
+    def Flush(self):
+        """Send the queued records and the current counters"""
+
+        with self.__Lock:
+            Records = self.__Records
+            self.__Records = []
+        self.Queue.put(('log', self.Number, Records, self.GetCounts() if self.GetCounts else None))
+
+
+def RunShard(Number, Processes, Options, Index, JournalFileName, Fingerprint, InQueue, OutQueue):
+    """Process the row batches of InQueue until None, then send the counters and statistics of this process"""
+
+    L = QueueLog(Number, OutQueue)
+    Runner = RunJournal = Cache = Metrics = Accounts = Limiters = None
+    Stats = {}
+    try:
+        ConfigurePool(MaxPoolConnections=Options['MaxConnections'], TcpKeepAlive=Options['TcpKeepAlive'])
+        if Options['Rate']:
+            Limiters = ConfigureLimiters(Rate=Options['Rate'] / Processes)
+            Limiters.MaxRate /= Processes
+            Limiters.Rates = {Service: (Rate / Processes, MaxRate / Processes) \
+                              for Service, (Rate, MaxRate) in Limiters.Rates.items()}
+        if Options['Metrics']:
+            JsonFileName, PromFileName, Interval = Options['Metrics']
+            Metrics = ConfigureMetrics(GetPartFileName(JsonFileName, Number) if JsonFileName else None,
+                                       GetPartFileName(PromFileName, Number) if PromFileName else None, Interval,
+                                       Limiters)
+        if Options['Cache']:
+            Cache = ConfigureCache(*Options['Cache'])
+        if Options['AssumeRole']:
+            RoleName, Duration, ExternalId = Options['AssumeRole']
+            Accounts = ConfigureAccounts(RoleName, Duration=Duration, ExternalId=ExternalId)
+        if JournalFileName:
+            RunJournal = Journal(JournalFileName, Fingerprint)
+
+        Runner = TagRunner(L, Options['Overwrite'], Options['Workers'], Options['ServiceWorkers'], Index,
+                           Ec2TagBatcher(Options['Ec2BatchSize']) if Options['Ec2BatchSize'] > 0 else None,
+                           BulkTagger() if Options['Bulk'] else None,
+                           S3TagMerger(Options['Overwrite']) if Options['S3Merge'] else None, RunJournal,
+                           TagReadBatcher() if Options.get('ReadBatch') else None)
+        L.GetCounts = Runner.GetCounts
+        for Batch in iter(InQueue.get, None):
+            for Row in Batch:
+                Runner.Submit(*Row)
+            L.Flush()
+        Runner.Finish()
+    except Exception as e:
+        L.TeeLog('Shard #' + str(Number) + ': Failed: ' + str(e), 1)
+    finally:
+        if RunJournal:
+            RunJournal.Close()
+        if Cache:
+            Cache.Close()
+            Stats['Cache'] = (Cache.Hits, Cache.Misses)
+        if Metrics:
+            try:
+                Metrics.Stop()
+            except Exception as e:
+                L.TeeLog('Shard #' + str(Number) + ': Failed to write metrics: ' + str(e), 1)
+            Stats['Calls'] = Metrics.GetReport()['calls']
+        if Limiters:
+            Stats['Rates'] = Limiters.GetRates()
+        if Accounts:
+            Stats['Accounts'] = (Accounts.GetAccountsCount(), Accounts.AssumeCount)
+
+    L.Flush()
+    OutQueue.put(('done', Number, Runner.GetCounts() if Runner else None, Runner.Regions if Runner else {},
+                  Runner.Accounts if Runner else {}, Stats))
+
+if __name__ == '__main__':
+    from aws.fake import QuietLog
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: every row of a resource goes to the same process', end='')
+    assert len(set(GetShard('i-0123456789abcdef0', 4) for Number in range(8))) == 1
+    assert len(set(GetShard('i-%017x' % Number, 4) for Number in range(400))) == 4
+    print('...OK')
+    print('TEST 2: worker processes write files of their own', end='')
+    assert GetPartFileName('tagging.prom', 1) == 'tagging-1.prom'
+    assert GetPartFileName('out/tagging.metrics.json', 2) == 'out/tagging.metrics-2.json'
+    print('...OK')
+    print('TEST 3: rows go through worker processes and their counters come back', end='')
+    Options = {'Overwrite': False, 'Workers': 2, 'ServiceWorkers': None, 'Ec2BatchSize': 0, 'Bulk': False,
+               'S3Merge': False, 'ReadBatch': False, 'MaxConnections': 10, 'TcpKeepAlive': True, 'Rate': None,
+               'Metrics': None, 'Cache': None, 'AssumeRole': None}
+    ### tags valued Unknown are skipped without calling AWS
+    Runner = ShardedRunner(QuietLog(), 2, Options, BatchSize=3)
+    for Number in range(10):
+        Runner.Submit(Number, 'ec2', 'i-%017x' % Number, {'Channel': 'Unknown'}, 'us-east-1')
+    Runner.Finish()
+    assert Runner.GetCounts() == {'Total': 10, 'Successful': 0, 'Skip': 10, 'Failed': 0}
+    print('...OK')
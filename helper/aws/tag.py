@@ -1,6 +1,16 @@
 """This module provides classes and functions to update tags for AWS services"""
-import boto3
+import os
+import sys
+### run as a script, i.e. python3 helper/aws/tag.py, the folder of the aws package is not on the path
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from botocore.exceptions import ClientError
+from aws.client import GetPool
+from aws.ratelimit import Call, GetErrorCode, IsThrottlingError
+from aws.arn import GetEc2ResourceId, GetLogGroupName, GetBucketName, GetResourceName
+from aws.cache import GetCache
+from aws.account import GetLinkedAccount, GetResourceAccount, GetCallerAccount
+from aws.registry import GetAdapter, GetServiceNames, GetResourceRegion, ToTagList, ToTagDict
 
 class TagNotSupportedError(Exception):
     """An exception class which can be raised when tagging not supported"""
@@ -10,862 +20,528 @@ class TagNotSupportedError(Exception):
 
 
 
-class AwsTag:
-    """Update tags for supported AWS services"""
+def IsEc2IdError(Code):
+    """Return True if an ec2 error code blames one or more resource ids"""
+
+    return Code.endswith('.NotFound') or Code.endswith('.Malformed') or \
+           Code in ('InvalidID', 'InvalidParameterValue')
+
+def GetQuotedIds(Message):
+    """Return ids quoted in an ec2 error message, i.e. The instance IDs 'i-1, i-2' do not exist"""
+
+    Ids = set()
+    for Quoted in Message.split("'")[1::2]:
+        Ids.update(Id.strip() for Id in Quoted.split(','))
 
-    __Services__ = ['ec2', 's3', 'lambda', 'logs', 'rds', 'es', 'emr', 'dynamodb', 'firehose', \
-                     'glacier', 'kms', 'apigateway', 'kinesis', 'cloudtrail', 'sqs', 'secretsmanager', \
-		     'cloudfront', 'efs', 'sagemaker', 'redshift', 'elasticache', 'workspaces', \
-		     'ds', 'dax', 'route53', 'directconnect' \
-                    ]
+    return Ids
 
-    def __init__(self, Service=None):
+
+
+class AwsTag:
+    """Update tags for supported AWS services
+
+    How each service reads and writes tags is looked up in aws.registry, so every
+    service shares one write path and one read path. Calls for a resource go to the
+    region of its ARN or queue URL, or the home region of a global service, and to
+    Region otherwise; they are made in the linked account of its ARN or queue URL, or
+    Account, through an assumed role when accounts are configured in aws.account and
+    with the base credentials otherwise. The named methods below are kept
+    for callers which want a specific boto3 method; they raise TagNotSupportedError if
+    the service does not use it.
+    """
+
+    def __init__(self, Service=None, Region=None, Profile=None, Pool=None, Account=None):
         """Constructor"""
 
         self.Service = Service
-        if self.Service not in AwsTag.__Services__:
+        self.Adapter = GetAdapter(Service)
+        if self.Adapter is None:
             raise TagNotSupportedError(str(self.Service))
 
+        self.Region = Region
+        self.Profile = Profile
+        self.Pool = Pool if Pool is not None else GetPool()
+        self.Account = Account
+
     def GetServicesCount(self):
         """Return number of supported services"""
 
-        return len(AwsTag.__Services__)
+        return len(GetServiceNames())
 
-    def TagResource(self, ResourceId, TagName, TagValue):
-        """Update tags using boto3 method tag_resource()"""
+    def GetClient(self, Service=None, Region=None, Account=None):
+        """Return a shared boto3 client from the client pool"""
 
-        Client = boto3.client(self.Service)
-
-        if self.Service == 'lambda':
-            response = Client.tag_resource (
-                Resource = ResourceId,
-		Tags =  {
-                    TagName: TagValue
-                }
-	    )
-        elif self.Service == 'dax':
-            response = Client.tag_resource (
-                ResourceName = ResourceId,
-		Tags = [
-		    {
-                        'Key': TagName,
-			'Value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'directconnect':
-            response = Client.tag_resource (
-                resourceArn = ResourceId,
-		Tags = [
-		    {
-                        'key': TagName,
-			'value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'dynamodb':
-            response = Client.tag_resource (
-                ResourceArn = ResourceId,
-		Tags = [
-		    {
-                        'Key': TagName,
-			'Value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'kms':
-            response = Client.tag_resource (
-                KeyId = ResourceId,
-		Tags = [
-		    {
-                        'TagKey': TagName,
-			'TagValue': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'apigateway':
-            response = Client.tag_resource (
-                resourceArn = ResourceId,
-		tags = [
-		    {
-			TagName: TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'secretsmanager':
-            response = Client.tag_resource (
-                SecretId = ResourceId,
-		Tags = [
-		    {
-			'Key': TagName,
-			'Value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'cloudfront':
-            response = Client.tag_resource (
-                Resource = ResourceId,
-		Tags = {
-                    'Items': [
-		        {
-			    'Key': TagName,
-			    'Value': TagValue
-		        }
-                    ]
-		}
-	    )
-        else:
-            raise TagNotSupportedError(str(self.Service))
+        return self.Pool.GetClient(Service if Service else self.Service, Region if Region else self.Region,
+                                   self.Profile, Account=Account if Account else GetLinkedAccount(self.Account))
 
-        return True
+    def GetRegion(self, ResourceId):
+        """Return region to call for a resource"""
 
-    def AddTagsToResource(self, ResourceId, TagName, TagValue):
-        """Update tags using boto3 method add_tags_to_resource()"""
+        return GetResourceRegion(self.Service, ResourceId, self.Region)
 
-        Client = boto3.client(self.Service)
-
-        if self.Service == 'rds':
-            response = Client.add_tags_to_resource (
-                ResourceName = ResourceId,
-                Tags = [
-                    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'elasticache':
-            response = Client.add_tags_to_resource (
-                ResourceName = ResourceId,
-                Tags = [
-                    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-		]
-	    )
-        elif self.Service == 'ds':
-            response = Client.add_tags_to_resource (
-                ResourceId = ResourceId,
-                Tags = [
-                    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-		]
-	    )
-        else:
-            raise TagNotSupportedError(str(self.Service))
+    def GetAccount(self, ResourceId):
+        """Return linked account to call for a resource, or None for the base credentials"""
 
-        return True
+        return GetResourceAccount(ResourceId, self.Account)
+
+    def TagResource(self, ResourceId, Tags):
+        """Update tags using boto3 method tag_resource()"""
 
-    def AddTags(self, ResourceId, TagName, TagValue):
+        return self.__Write('tag_resource', ResourceId, Tags)
+
+    def AddTagsToResource(self, ResourceId, Tags):
+        """Update tags using boto3 method add_tags_to_resource()"""
+
+        return self.__Write('add_tags_to_resource', ResourceId, Tags)
+
+    def AddTags(self, ResourceId, Tags):
         """Update tags using boto3 method add_tags()"""
 
-        Client = boto3.client(self.Service)
-
-        if self.Service == 'es':
-            response = Client.add_tags (
-                ARN = ResourceId,
-                TagList = [
-		    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-                ]
-	    )
-        elif self.Service == 'emr':
-            response = Client.add_tags (
-                ResourceId = ResourceId,
-                Tags = [
-		    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-                ]
-	    )
-        elif self.Service == 'cloudtrail':
-            response = Client.add_tags (
-                ResourceId = ResourceId,
-                TagsList = [
-		    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-                ]
-	    )
-        elif self.Service == 'sagemaker':
-            response = Client.add_tags (
-                ResourceArn = ResourceId,
-                Tags = [
-		    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-                ]
-	    )
-        elif self.Service == 'datapipeline':
-            response = Client.add_tags (
-                pipelineId = ResourceId,
-                tags = [
-		    {
-                        'Key': TagName,
-                        'Value': TagValue
-		    }
-                ]
-	    )
-        else:
+        return self.__Write('add_tags', ResourceId, Tags)
+
+    def CreateTags(self, ResourceId, Tags):
+        """Update tags using boto3 method create_tags()"""
+
+        return self.__Write('create_tags', ResourceId, Tags)
+
+    def CreateTagsBatch(self, ResourceIds, Tags):
+        """Update the same tags on many ec2 resources per create_tags() call
+
+        Returns a dictionary of ResourceId to error message for the resources that failed.
+        create_tags() fails as a whole, so ids named in an id-related error are dropped and
+        the rest retried; if no id can be identified the batch is split in half.
+        """
+
+        if self.Service != 'ec2':
             raise TagNotSupportedError(str(self.Service))
 
-        return True
+        return self.__SendBatches(ResourceIds, 'create_tags', lambda Batch: self.Adapter.GetWriteParams(Batch, Tags),
+                                  lambda ResourceId: self.CacheTags(ResourceId, Tags))
 
-    def CreateTags(self, ResourceId, TagName, TagValue):
-        """Update tags using boto3 method create_tags()"""
+    def DeleteTagsBatch(self, ResourceIds, TagNames):
+        """Remove the same tag names from many ec2 resources per delete_tags() call; returns a dictionary of
+        ResourceId to error message for the resources that failed, like CreateTagsBatch()"""
 
-        Client = boto3.client(self.Service)
-
-        if self.Service == 'ec2':
-            response = Client.create_tags(
-                Resources = [
-		    ResourceId
-		],
-		Tags = [
-                    {
-		        'Key': TagName,
-		        'Value': TagValue
-                    }
-		]
-	    )
-        elif self.Service == 'efs':
-            response = Client.create_tags(
-                FileSystemId = ResourceId,
-		Tags = [
-                    {
-		        'Key': TagName,
-		        'Value': TagValue
-                    }
-		]
-	    )
-        elif self.Service == 'redshift':
-            response = Client.create_tags(
-                ResourceName = ResourceId,
-		Tags = [
-                    {
-		        'Key': TagName,
-		        'Value': TagValue
-                    }
-		]
-	    )
-        elif self.Service == 'workspaces':
-            response = Client.create_tags(
-                ResourceId = ResourceId,
-		Tags = [
-                    {
-		        'Key': TagName,
-		        'Value': TagValue
-                    }
-		]
-	    )
-        else:
+        if self.Service != 'ec2':
             raise TagNotSupportedError(str(self.Service))
 
-        return True
+        return self.__SendBatches(ResourceIds, 'delete_tags',
+                                  lambda Batch: self.Adapter.GetUntagParams(Batch, TagNames),
+                                  lambda ResourceId: self.CacheTags(ResourceId, {}, Removed=TagNames))
 
-    def UpdateS3Tag(self, ResourceId, TagName, TagValue):
-        """Update s3 service tag"""
-        Client = boto3.client('s3')
+    def __SendBatches(self, ResourceIds, Method, GetParams, OnSuccess):
+        """Call an ec2 method taking many ids, dropping or splitting ids until each batch succeeds or fails alone"""
 
-        response = Client.get_bucket_tagging (
-            Bucket = ResourceId
-	)
-        Tags = response['TagSet']
+        Client = self.GetClient()
+        Failed = {}
+        Pending = [list(dict.fromkeys(ResourceIds))]
 
-        ### if tag exists, replace tag value; otherwise, append tag
-        if self.IsTagExists(ResourceId, TagName):
-            for Tag in Tags:
-                if Tag['Key'] == TagName:
-                    Tag['Value'] = TagValue
-        else:
-            Tags.append (
-                {
-                    'Key': TagName,
-                    'Value': TagValue
-                }
-            )
-           
-
-        response = Client.put_bucket_tagging (
-            Bucket = ResourceId,
-            Tagging = {
-                'TagSet': Tags
-	    }
-        )
+        while Pending:
+            Batch = Pending.pop()
+            if not Batch:
+                continue
+            if len(Batch) > self.Adapter.MaxBatch:
+                Pending.append(Batch[:self.Adapter.MaxBatch])
+                Pending.append(Batch[self.Adapter.MaxBatch:])
+                continue
+            try:
+                response = Call(self.Service, self.Region, getattr(Client, Method), **GetParams(Batch))
+                for ResourceId in Batch:
+                    OnSuccess(ResourceId)
+            except ClientError as c:
+                Code = c.response.get('Error', {}).get('Code', '')
+                Message = c.response.get('Error', {}).get('Message', str(c))
+                if not IsEc2IdError(Code):
+                    for ResourceId in Batch:
+                        Failed[ResourceId] = Code + ': ' + Message
+                    continue
 
-        return True
+                BadIds = [ResourceId for ResourceId in Batch if ResourceId in GetQuotedIds(Message)]
+                if BadIds:
+                    for ResourceId in BadIds:
+                        Failed[ResourceId] = Code + ': ' + Message
+                    Pending.append([ResourceId for ResourceId in Batch if ResourceId not in BadIds])
+                elif len(Batch) == 1:
+                    Failed[Batch[0]] = Code + ': ' + Message
+                else:
+                    Pending.append(Batch[:len(Batch) // 2])
+                    Pending.append(Batch[len(Batch) // 2:])
 
-    def UpdateLogsTag(self, ResourceId, TagName, TagValue):
-        """Update cloudwatch logs service tag"""
-        Client = boto3.client('logs')
+        return Failed
 
-        ### get LogGroupName from ResourceId
-        LogGroupName = ResourceId.split(':')[-1]
-	    
-        response = Client.tag_log_group(
-            logGroupName = LogGroupName,
-            tags = {
-	        TagName: TagValue
-            }
-	)
+    def UpdateS3Tag(self, ResourceId, Tags):
+        """Update s3 service tags, keeping the bucket's other tags"""
 
-        return True
+        self.__Require('put_bucket_tagging')
 
-    def UpdateGlacierTag(self, ResourceId, TagName, TagValue):
-        """Update glacier service tag"""
-        Client = boto3.client('glacier')
+        return self.__UpdateTags(ResourceId, Tags)
 
-        Vault = ResourceId.split(':')[-1].split('/')[-1]
+    def PutBucketTags(self, ResourceId, Tags):
+        """Replace the whole tag set of a bucket using boto3 method put_bucket_tagging()"""
 
-        response = Client.add_tags_to_vault(
-            vaultName = Vault,
-            Tags = {
-	            TagName: TagValue
-            }
-	)
+        return self.__Write('put_bucket_tagging', ResourceId, Tags)
 
-        return True
+    def UpdateLogsTag(self, ResourceId, Tags):
+        """Update cloudwatch logs service tags"""
 
-    def UpdateKinesisTag(self, ResourceId, TagName, TagValue):
-        """Update kinesis service tag"""
-        Client = boto3.client('kinesis')
+        return self.__Write('tag_log_group', ResourceId, Tags)
 
-        StreamName = ResourceId.split(':')[-1].split('/')[-1]
+    def UpdateGlacierTag(self, ResourceId, Tags):
+        """Update glacier service tags"""
 
-        response = Client.add_tags_to_stream(
-            StreamName = StreamName,
-            Tags = {
-	            TagName: TagValue
-            }
-	)
+        return self.__Write('add_tags_to_vault', ResourceId, Tags)
 
-        return True
+    def UpdateKinesisTag(self, ResourceId, Tags):
+        """Update kinesis service tags"""
 
-    def UpdateSqsTag(self, ResourceId, TagName, TagValue):
-        """Update sqs service tag"""
-        Client = boto3.client('sqs')
+        return self.__Write('add_tags_to_stream', ResourceId, Tags)
 
-        response = Client.tag_queue(
-            QueueUrl = ResourceId,
-            Tags = [
-                {
-	            TagName: TagValue
-                }
-	    ]
-	)
+    def UpdateSqsTag(self, ResourceId, Tags):
+        """Update sqs service tags"""
 
-        return True
+        return self.__Write('tag_queue', ResourceId, Tags)
 
-    def UpdateRoute53Tag(self, ResourceId, TagName, TagValue):
-        """Update route53 service tag"""
+    def UpdateRoute53Tag(self, ResourceId, Tags):
+        """Update route53 service tags"""
 
-        Client = boto3.client('route53')
+        return self.__Write('change_tags_for_resource', ResourceId, Tags)
 
-        response = Client.change_tags_for_resource ( 
-            ResourceType = 'hostedzone',
-            ResourceId = ResourceId,
-            AddTags = [
-	        {
-		    'Key': TagName,
-		    'Value': TagValue
-		}
-	    ]
-	)
+    def UpdateFirehoseTag(self, ResourceId, Tags):
+        """Update firehose service tags"""
 
-        return True
+        return self.__Write('tag_delivery_stream', ResourceId, Tags)
+
+    def UpdateTag(self, ResourceId, TagName, TagValue):
+        """Update one tag"""
+
+        return self.UpdateTags(ResourceId, {TagName: TagValue})
+
+    def UpdateTags(self, ResourceId, Tags):
+        """Update tags given as dictionary of name to value in one call, retrying when throttled"""
 
-    def UpdateFirehoseTag(self, ResourceId, TagName, TagValue):
-        """Update firehose service tag"""
+        return Call(self.Service, self.GetRegion(ResourceId), self.__UpdateTags, ResourceId, Tags)
 
-        Client = boto3.client('firehose')
+    def __UpdateTags(self, ResourceId, Tags):
+        """Write tags with the service's write method, merging into the existing tags if it replaces them all"""
 
-        StreamName = ResourceId.split(':')[-1].split('/')[-1]
+        if self.Adapter.ReplacesTagSet:
+            Merged = self.__GetTags(ResourceId)
+            Merged.update(Tags)
+            Tags = Merged
 
-        response = Client.tag_delivery_stream(
-	    DeliveryStreamName = StreamName,
-	    Tags = [
-	        {
-		    'Key': TagName,
-		    'Value': TagValue
-		}
-	    ]
-	)
+        response = self.__Write(self.Adapter.Write, ResourceId, Tags)
+        self.CacheTags(ResourceId, Tags, self.Adapter.ReplacesTagSet)
+
+        return response
+
+    def RemoveTags(self, ResourceId, TagNames):
+        """Remove tags given as list of names in one call, retrying when throttled"""
+
+        return Call(self.Service, self.GetRegion(ResourceId), self.__RemoveTags, ResourceId, TagNames)
+
+    def __RemoveTags(self, ResourceId, TagNames):
+        """Remove tags with the service's untag method, or write back the rest if it replaces the whole tag set"""
+
+        if not self.Adapter.ReplacesTagSet:
+            self.__Require(self.Adapter.Untag, Untag=True)
+            Client = self.GetClient(Region=self.GetRegion(ResourceId), Account=self.GetAccount(ResourceId))
+            response = getattr(Client, self.Adapter.Untag)(**self.Adapter.GetUntagParams([ResourceId], TagNames))
+            self.CacheTags(ResourceId, {}, Removed=TagNames)
+            return True
+
+        Current = self.__GetTags(ResourceId)
+        Remaining = {TagName: TagValue for TagName, TagValue in Current.items() if TagName not in TagNames}
+        if Remaining == Current:
+            return True
+        if Remaining:
+            response = self.__Write(self.Adapter.Write, ResourceId, Remaining)
+        else:
+            Client = self.GetClient(Region=self.GetRegion(ResourceId), Account=self.GetAccount(ResourceId))
+            response = getattr(Client, self.Adapter.UntagAll)(**{self.Adapter.IdParam: self.Adapter.GetId(ResourceId)})
+        self.CacheTags(ResourceId, Remaining, True)
 
         return True
 
-    def UpdateTag(self, ResourceId, TagName, TagValue):
-        """Calls other methods to update tags"""
+    def CacheTags(self, ResourceId, Tags, Complete=False, Removed=()):
+        """Record tags read or written in the tag cache, if enabled; Complete tags replace the cached ones and
+        Removed tag names are dropped from them"""
 
+        Cache = GetCache()
+        Key = self.GetCacheKey(ResourceId) if Cache is not None else None
+        if Key is None:
+            return
+
+        if Complete:
+            Cache.Put(*Key, Tags)
+        else:
+            Cache.Update(*Key, Tags, Removed)
+
+    def GetCachedTags(self, ResourceId):
+        """Return tags of a resource from the tag cache, or None if it is disabled or does not know them"""
+
+        Cache = GetCache()
+        Key = self.GetCacheKey(ResourceId) if Cache is not None else None
+
+        return Cache.Get(*Key) if Key is not None else None
+
+    def GetCacheKey(self, ResourceId):
+        """Return (service, region, profile, id) tag cache key of a resource, or None if the account of the base
+        credentials is unknown; the cache outlives a run, so the key holds the region the client resolved and the
+        account called, since names such as log groups repeat across regions and accounts"""
+
+        Account = self.GetAccount(ResourceId)
         try:
-            if self.Service == 'ec2':
-                response = self.CreateTags(ResourceId, TagName, TagValue)
-            elif self.Service == 's3':
-                response = self.UpdateS3Tag(ResourceId, TagName, TagValue)
-            elif self.Service == 'lambda':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'logs':
-                response = self.UpdateLogsTag(ResourceId, TagName, TagValue)
-            elif self.Service == 'rds':
-                response = self.AddTagsToResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'es':
-                response = self.AddTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'emr':
-                response = self.AddTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'dynamodb':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'firehose':
-                response = self.UpdateFirehoseTag(ResourceId, TagName, TagValue)
-            elif self.Service == 'glacier':
-                response = self.UpdateGlacierTag(ResourceId, TagName, TagValue)
-            elif self.Service == 'kms':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'apigateway':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'kinesis':
-                response = self.UpdateKinesisTag(ResourceId, TagName, TagValue)
-            elif self.Service == 'cloudtrail':
-                response = self.AddTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'sqs':
-                response = self.UpdateSqsTag(ResourceId, TagName, TagValue)
-            elif self.Service == 'secretsmanager':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'cloudfront':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'efs':
-                response = self.CreateTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'sagemaker':
-                response = self.AddTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'redshift':
-                response = self.CreateTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'elasticache':
-                response = self.AddTagsToResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'workspaces':
-                response = self.CreateTags(ResourceId, TagName, TagValue)
-            elif self.Service == 'ds':
-                response = self.AddTagsToResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'dax':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'route53':
-                response = self.UpdateRoute53Tag(ResourceId, TagName, TagValue)
-            elif self.Service == 'directconnect':
-                response = self.TagResource(ResourceId, TagName, TagValue)
-            elif self.Service == 'datapipeline':
-                response = self.AddTags(ResourceId, TagName, TagValue)
-            else:
-                raise TagNotSupportedError(self.Service)
-        except Exception as e:
-            raise e
+            Region = self.GetClient(Region=self.GetRegion(ResourceId), Account=Account).meta.region_name
+            Profile = str(self.Profile or '') + '@' + (Account or GetCallerAccount(self.Profile, self.Pool))
+        except Exception:
+            return None
+
+        return (self.Service, Region, Profile, self.Adapter.GetId(ResourceId))
+
+    def __Write(self, Method, ResourceId, Tags):
+        """Call the service's write method for one resource"""
+
+        self.__Require(Method)
+        Client = self.GetClient(Region=self.GetRegion(ResourceId), Account=self.GetAccount(ResourceId))
+        response = getattr(Client, Method)(**self.Adapter.GetWriteParams([ResourceId], Tags))
 
         return True
 
-    def DescribeTags(self, ResourceId):
-        """Get tags using boto3 method describe_tags()"""
+    def __Read(self, Method, ResourceId):
+        """Call the service's read method for one resource and return the response"""
 
-        Client = boto3.client(self.Service) 
-        
-        if self.Service == 'ec2':
-            response = Client.describe_tags (
-                Filters = [
-	            {
-                        'Name': 'resource-id',
-	                'Values': [
-	                    ResourceId
-		        ]
-		    }
-	        ]
-	    )
-        elif self.Service == 'efs':
-            response = Client.describe_tags (
-                FileSystemId = ResourceId
-	    )
-        elif self.Service == 'redshift':
-            response = Client.describe_tags (
-                ResourceName = ResourceId
-            )
-        elif self.Service == 'workspaces':
-            response = Client.describe_tags (
-                ResourceId = ResourceId
-            )
-        elif self.Service == 'directconnect':
-            response = Client.describe_tags (
-                ResourceArn = [
-                    ResourceId
-		]
-            )
-        else:
-            raise TagNotSupportedError(self.Service)
+        self.__Require(Method, True)
 
-        return response
+        Client = self.GetClient(Region=self.GetRegion(ResourceId), Account=self.GetAccount(ResourceId))
+
+        return getattr(Client, Method)(**self.Adapter.GetReadParams([ResourceId]))
+
+    def __Require(self, Method, Read=False, Untag=False):
+        """Raise TagNotSupportedError unless the service reads, writes or removes tags with the boto3 method"""
+
+        if Method is None or Method != (self.Adapter.Read if Read else self.Adapter.Untag if Untag \
+                                        else self.Adapter.Write):
+            raise TagNotSupportedError(str(self.Service))
 
+    def DescribeTags(self, ResourceId):
+        """Get tags using boto3 method describe_tags()"""
+
+        return self.__Read('describe_tags', ResourceId)
 
     def GetBucketTagging(self, ResourceId):
         """Get tags using boto3 method get_bucket_tagging()"""
-   
-        Client = boto3.client('s3') 
 
-        response = Client.get_bucket_tagging (
-            Bucket = ResourceId
-	)
+        return self.__Read('get_bucket_tagging', ResourceId)
 
-        return response
+    def GetBucketTags(self, ResourceId):
+        """Get tags of a bucket as dictionary; a bucket without tags has no tag set rather than an empty one"""
 
+        self.__Require('get_bucket_tagging', True)
+
+        return self.__GetTags(ResourceId)
+
+    def GetApiTags(self, ResourceId):
+        """Get tags using boto3 method get_tags()"""
+
+        return self.__Read('get_tags', ResourceId)
 
     def ListTags(self, ResourceId):
         """Get tags using boto3 method list_tags()"""
-   
-        Client = boto3.client(self.Service) 
-
-        if self.Service == 's3':
-            response = Client.list_tags (
-                Bucket = ResourceId
-	    )
-        elif self.Service == 'es':
-            response = Client.list_tags (
-                ARN = ResourceId
-	    )
-        elif self.Service == 'cloudtrail':
-            response = Client.list_tags (
-                ResourceIdList = [
-                    ResourceId
-		]
-	    )
-        elif self.Service == 'sagemaker':
-            response = Client.list_tags (
-                ResourceArn = ResourceId
-	    )
-        elif self.Service == 'dax':
-            response = Client.list_tags (
-                ResourceName = ResourceId
-	    )
-        elif self.Service == 'lambda':
-            response = Client.list_tags (
-                Resource = ResourceId
-	    )
-        else:
-            raise TagNotSupportedError(self.Service)
-       
-        return response
+
+        return self.__Read('list_tags', ResourceId)
 
     def ListTagsLogGroup(self, ResourceId):
         """Get tags using boto3 method list_tags_log_group()"""
-   
-        Client = boto3.client('logs') 
-
-        response = Client.list_tags_log_group (
-            logGroupName = ResourceId
-	)
-
-        return response
 
+        return self.__Read('list_tags_log_group', ResourceId)
 
     def ListTagsForResource(self, ResourceId):
         """Get tags using boto3 method list_tags_for_resource()"""
 
-        Client = boto3.client(self.Service) 
-        
-        if self.Service == 's3':
-            response = Client.list_tags_for_resource (
-                ResourceName = ResourceId
-	    )
-        elif self.Service == 'cloudfront':
-            response = Client.list_tags_for_resource (
-                Resource = ResourceId
-	    )
-        elif self.Service == 'elasticache':
-            response = Client.list_tags_for_resource (
-                ResourceName = ResourceId
-            )
-        elif self.Service == 'ds':
-            response = Client.list_tags_for_resource (
-                ResourceId = ResourceId
-            )
-        elif self.Service == 'route53':
-            response = Client.list_tags_for_resource (
-                ResourceType = 'hostedzone',
-                ResourceId = ResourceId
-            )
-        elif self.Service == 'rds':
-            response = Client.list_tags_for_resource (
-                ResourceName = ResourceId
-            )
-        else:
-            raise TagNotSupportedError(self.Service)
-
-        return response
-
+        return self.__Read('list_tags_for_resource', ResourceId)
 
     def ListTagsOfResource(self, ResourceId):
         """Get tags using boto3 method list_tags_of_resource()"""
 
-        Client = boto3.client('dynamodb')
-        
-        response = Client.list_tags_of_resource (
-            ResourceArn = ResourceId
-	)
-
-        return response
-
+        return self.__Read('list_tags_of_resource', ResourceId)
 
     def ListTagsForVault(self, ResourceId):
         """Get tags using boto3 method list_tags_for_vault()"""
 
-        Client = boto3.client('glacier')
-
-        Vault = ResourceId.split(':')[-1].split('/')[-1]
-        
-        response = Client.list_tags_for_vault (
-            vaultName = Vault
-	)
-
-        return response
-
+        return self.__Read('list_tags_for_vault', ResourceId)
 
     def ListResourceTags(self, ResourceId):
         """Get tags using boto3 method list_resource_tags()"""
 
-        Client = boto3.client('kms')
-        
-        response = Client.list_resource_tags (
-            KeyId = ResourceId
-	)
-
-        return response
-
+        return self.__Read('list_resource_tags', ResourceId)
 
     def ListTagsForStream(self, ResourceId):
         """Get tags using boto3 method list_tags_for_stream()"""
 
-        Client = boto3.client('kinesis')
-
-        StreamName = ResourceId.split(':')[-1].split('/')[-1]
-        
-        response = Client.list_tags_for_stream (
-            StreamName = StreamName
-	)
-
-        return response
-
+        return self.__Read('list_tags_for_stream', ResourceId)
 
     def ListQueueTags(self, ResourceId):
         """Get tags using boto3 method list_queue_tags()"""
 
-        Client = boto3.client('sqs')
-        
-        response = Client.list_queue_tags (
-            QueueUrl = ResourceId
-	)
-
-        return response
+        return self.__Read('list_queue_tags', ResourceId)
 
     def ListTagsForDeliveryStream(self, ResourceId):
         """Get tags using boto3 method list_tags_for_delivery_stream()"""
 
-        Client = boto3.client('firehose')
-
-        StreamName = ResourceId.split(':')[-1].split('/')[-1]
-        
-        response = Client.list_tags_for_delivery_stream (
-            DeliveryStreamName = StreamName
-	)
-
-        return response
-
+        return self.__Read('list_tags_for_delivery_stream', ResourceId)
 
     def DescribeSecret(self, ResourceId):
         """Get tags using boto3 method describe_secret()"""
 
-        Client = boto3.client('secretsmanager')
-        
-        response = Client.describe_secret (
-            SecretId = ResourceId
-	)
-
-        return response
-
+        return self.__Read('describe_secret', ResourceId)
 
     def DescribeCluster(self, ResourceId):
         """Get tags using boto3 method describe_cluster()"""
 
-        Client = boto3.client('emr')
-        
-        response = Client.describe_cluster (
-            ClusterId = ResourceId
-	)
-
-        return response
-
+        return self.__Read('describe_cluster', ResourceId)
 
     def DescribePipelines(self, ResourceId):
         """Get tags using boto3 method describe_pipelines()"""
 
-        Client = boto3.client('datapipeline')
-        
-        response = Client.describe_cluster (
-            pipelineIds = [
-                ResourceId
-            ]
-	)
-
-        return response
+        return self.__Read('describe_pipelines', ResourceId)
 
     def IsTagExists(self, ResourceId, TagName):
-        """Calls other methods to check if tag exists"""
+        """Check if tag exists"""
+
+        return TagName in self.GetTags(ResourceId)
+
+    def GetTags(self, ResourceId):
+        """Get all tags of a resource as dictionary from the tag cache, or from AWS retrying when throttled"""
+
+        Tags = self.GetCachedTags(ResourceId)
+        if Tags is None:
+            Tags = Call(self.Service, self.GetRegion(ResourceId), self.__GetTags, ResourceId)
+            self.CacheTags(ResourceId, Tags, True)
+
+        return Tags
+
+    def __GetTags(self, ResourceId):
+        """Read tags with the service's read method; error codes meaning no tags give an empty dictionary"""
 
         try:
-            if self.Service == 'ec2':
-                response = self.DescribeTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 's3':
-                response = self.GetBucketTagging(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['TagSet']])):
-                    return True
-            elif self.Service == 'lambda':
-                response = self.ListTags(ResourceId)
-                if TagName in [x for x in response['Tags']]:
-                    return True
-            elif self.Service == 'logs':
-                response = self.ListTagsLogGroup(ResourceId)
-                if TagName in [x for x in response['tags']]:
-                    return True
-            elif self.Service == 'rds':
-                response = self.ListTagsForResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['TagList']])):
-                    return True
-            elif self.Service == 'es':
-                response = self.ListTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['TagList']])):
-                    return True
-            elif self.Service == 'emr':
-                response = self.DescribeCluster(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [Tag for Tag in response['Cluster']['Tags']])):
-                    return True
-            elif self.Service == 'dynamodb':
-                response = self.ListTagsOfResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'firehose':
-                response = self.ListTagsForDeliveryStream(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'glacier':
-                response = self.ListTagsForVault(ResourceId)
-                if TagName in [x for x in response['Tags']]:
-                    return True
-            elif self.Service == 'kms':
-                response = self.ListResourceTags(ResourceId)
-                if TagName in list(map(lambda x: x['TagKey'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'apigateway':
-                print('No api to list tags')
-                return False
-            elif self.Service == 'kinesis':
-                response = self.ListTagsForStream(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'cloudtrail':
-                response = self.ListTags(ResourceId)
-                TagsList = map(lambda RTL: RTL['TagsList'], [RTL for RTL in response['ResourceTagList']])
-                for Tags in TagsList:
-                    for Tag in Tags:
-                        if Tag['Key'] == 'Channel':
-                            return True
-            elif self.Service == 'sqs':
-                response = self.ListTags(ResourceId)
-                if TagName in [x for x in response['Tags']]:
-                    return True
-            elif self.Service == 'secretsmanager':
-                response = self.DescribeSecret(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'cloudfront':
-                response = self.ListTagsForResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'efs':
-                response = self.DescribeTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'sagemaker':
-                response = self.ListTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'redshift':
-                response = self.DescribeTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'elasticache':
-                response = self.ListTagsForResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['TagList']])):
-                    return True
-            elif self.Service == 'workspaces':
-                response = self.DescribeTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'ds':
-                response = self.ListTagsForResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'dax':
-                response = self.ListTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'route53':
-                response = self.ListTagsForResource(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'directconnect':
-                response = self.DescribeTags(ResourceId)
-                if TagName in list(map(lambda x: x['Key'], [x for x in response['Tags']])):
-                    return True
-            elif self.Service == 'datapipeline':
-                response = self.DescribePipelines(ResourceId)
-                Tags = list(map(lambda x: x['tags'], [tags for tags in response['pipelineDescriptionList']]))
-                for i in Tags:
-                    for j in i:
-                        if j['key'] == 'Channel':
-                            return True
+            return self.Adapter.ParseTags(self.__Read(self.Adapter.Read, ResourceId))
+        except ClientError as c:
+            if GetErrorCode(c) in self.Adapter.EmptyCodes:
+                return {}
+            raise
+
+    def GetTagsBatch(self, ResourceIds):
+        """Read the tags of many resources with as few calls as the service's read method allows
+
+        Returns (Tags, Failed): dictionaries of ResourceId to tags dictionary and of ResourceId
+        to error message. Resources the tag cache knows are not read. The rest are grouped by
+        region and linked account and read MaxReadBatch ids per call, i.e. 200 per ec2
+        describe_tags() or 20 per cloudtrail list_tags(); a call failing for a reason other
+        than throttling is split in half so one bad id only fails itself. Services reading
+        one id per call are read one by one.
+        """
+
+        Tags = {}
+        Groups = {}
+        for ResourceId in dict.fromkeys(ResourceIds):
+            Cached = self.GetCachedTags(ResourceId)
+            if Cached is not None:
+                Tags[ResourceId] = Cached
             else:
-                raise TagNotSupportedError(self.Service)
-        except Exception as e:
-            raise e
+                Groups.setdefault((self.GetRegion(ResourceId), self.GetAccount(ResourceId)), []).append(ResourceId)
+
+        Size = self.Adapter.MaxReadBatch if self.Adapter.IsReadBatched() else 1
+        Failed = {}
+        Pending = [Group[Start:Start + Size] for Group in Groups.values() for Start in range(0, len(Group), Size)]
+        while Pending:
+            Batch = Pending.pop()
+            try:
+                if not self.Adapter.IsReadBatched():
+                    Found = {Batch[0]: Call(self.Service, self.GetRegion(Batch[0]), self.__GetTags, Batch[0])}
+                else:
+                    Found = Call(self.Service, self.GetRegion(Batch[0]), self.__GetTagsEach, Batch)
+            except Exception as e:
+                if len(Batch) > 1 and not IsThrottlingError(e):
+                    Pending.append(Batch[:len(Batch) // 2])
+                    Pending.append(Batch[len(Batch) // 2:])
+                    continue
+                for ResourceId in Batch:
+                    Failed[ResourceId] = str(e)
+                continue
+            for ResourceId, ResourceTags in Found.items():
+                Tags[ResourceId] = ResourceTags
+                self.CacheTags(ResourceId, ResourceTags, True)
+
+        return Tags, Failed
+
+    def __GetTagsEach(self, ResourceIds):
+        """Read tags of resources of one region and account in one call, following pages, as dictionary of
+        ResourceId to tags; resources missing from the response have none"""
+
+        self.__Require(self.Adapter.Read, True)
+        Client = self.GetClient(Region=self.GetRegion(ResourceIds[0]), Account=self.GetAccount(ResourceIds[0]))
+        Params = self.Adapter.GetReadParams(ResourceIds)
+        Found = {}
+        while True:
+            Response = getattr(Client, self.Adapter.Read)(**Params)
+            for Id, IdTags in self.Adapter.ParseTagsEach(Response).items():
+                Found.setdefault(Id, {}).update(IdTags)
+            ### describe_tags and list_tags page their results
+            if not Response.get('NextToken'):
+                break
+            Params['NextToken'] = Response['NextToken']
+
+        return {ResourceId: Found.get(self.Adapter.GetId(ResourceId), {}) for ResourceId in ResourceIds}
+
+
+def UpdateTag(Service, ResourceId, TagName, TagValue, Region=None, Profile=None, Account=None):
+    """Update tag for services"""
 
-        return False
+    return UpdateTags(Service, ResourceId, {TagName: TagValue}, Region, Profile, Account)
 
 
-def UpdateTag(Service, ResourceId, TagName, TagValue):
-    """Update tag for services"""
+def UpdateTags(Service, ResourceId, Tags, Region=None, Profile=None, Account=None):
+    """Update tags given as dictionary of name to value in one call"""
 
     try:
-        Tag = AwsTag(Service)
-        Tag.UpdateTag(ResourceId, TagName, TagValue)
+        Tag = AwsTag(Service, Region, Profile, Account=Account)
+        Tag.UpdateTags(ResourceId, Tags)
     except ClientError as c:
-        raise Exception(type(c))
+        raise Exception(str(c))
     except Exception as e:
         raise e
 
     return True
 
 
-def IsTagExists(Service, ResourceId, TagName):
-    """Check if tag name exists"""
+def RemoveTags(Service, ResourceId, TagNames, Region=None, Profile=None, Account=None):
+    """Remove tags given as list of names in one call"""
 
     try:
-        Tag = AwsTag(Service)
-        if Tag.IsTagExists(ResourceId, TagName):
-            return True
+        Tag = AwsTag(Service, Region, Profile, Account=Account)
+        Tag.RemoveTags(ResourceId, TagNames)
+    except ClientError as c:
+        raise Exception(str(c))
     except Exception as e:
         raise e
 
-    return False
+    return True
+
+
+def IsTagExists(Service, ResourceId, TagName, Region=None, Profile=None, Account=None):
+    """Check if tag name exists"""
+
+    return TagName in GetTags(Service, ResourceId, Region, Profile, Account)
+
+
+def GetTags(Service, ResourceId, Region=None, Profile=None, Account=None):
+    """Return tags of a resource as dictionary of name to value"""
+
+    try:
+        Tag = AwsTag(Service, Region, Profile, Account=Account)
+        return Tag.GetTags(ResourceId)
+    except Exception as e:
+        raise e
 
 if __name__ == '__main__':
     Tag = AwsTag('ec2')
@@ -874,3 +550,53 @@ if __name__ == '__main__':
     print('TEST 1: check number of services is', ServicesExpected, 'or more', end='')
     assert Tag.GetServicesCount() >= ServicesExpected
     print('...OK')
+    print('TEST 2: convert tags between dictionary and list', end='')
+    assert ToTagDict(ToTagList({'Channel': 'web'}, 'key', 'value'), 'key', 'value') == {'Channel': 'web'}
+    print('...OK')
+    print('TEST 3: get names from ARNs', end='')
+    assert GetLogGroupName('arn:aws:logs:us-east-1:123456789012:log-group:/aws/app:*') == '/aws/app'
+    assert GetEc2ResourceId('arn:aws:ec2:us-east-1:123456789012:volume/vol-1') == 'vol-1'
+    print('...OK')
+    print('TEST 4: one missing id of 1000 fails only its row, dropped in one more call', end='')
+    import math
+    from aws.fake import InstallFake
+    Fake = InstallFake()
+    Ids = ['i-%05d' % Number for Number in range(1000)]
+    Fake.Delete('ec2', Ids[517])
+    Failed = AwsTag('ec2').CreateTagsBatch(Ids, {'Channel': 'web'})
+    assert list(Failed) == [Ids[517]] and Fake.GetTags('ec2', Ids[518]) == {'Channel': 'web'}
+    assert Fake.GetCalls()[('ec2', 'create_tags')] == 2
+    print('...OK')
+    print('TEST 5: one id of 1000 an error does not name fails only its row in a logarithmic number of calls', end='')
+    Ids = ['i-%05d' % Number for Number in range(1000, 2000)]
+    Fake.Delete('ec2', Ids[301], Named=False)
+    Failed = AwsTag('ec2').CreateTagsBatch(Ids, {'Channel': 'web'})
+    assert list(Failed) == [Ids[301]] and Fake.GetTags('ec2', Ids[302]) == {'Channel': 'web'}
+    assert Fake.GetCalls()[('ec2', 'create_tags')] - 2 <= 2 * math.ceil(math.log2(len(Ids))) + 1
+    print('...OK')
+    print('TEST 6: one missing id of 1000 read in batches fails only its row', end='')
+    Ids = ['arn:aws:cloudtrail:us-east-1:123456789012:trail/t%04d' % Number for Number in range(1000)]
+    for Id in Ids:
+        Fake.Put('cloudtrail', Id, {'Channel': 'web'})
+    Fake.Delete('cloudtrail', Ids[42])
+    Tags, Failed = AwsTag('cloudtrail').GetTagsBatch(Ids)
+    Size = GetAdapter('cloudtrail').MaxReadBatch
+    assert list(Failed) == [Ids[42]] and len(Tags) == 999 and Tags[Ids[0]] == {'Channel': 'web'}
+    assert Fake.GetCalls()[('cloudtrail', 'list_tags')] <= len(Ids) // Size + 2 * math.ceil(math.log2(Size))
+    print('...OK')
+    print('TEST 7: tags of a service and region share one client of the process-wide pool', end='')
+    Pool = GetPool()
+    Count = Pool.GetClientsCount()
+    Client = AwsTag('kms', 'eu-west-1').GetClient()
+    assert AwsTag('kms', 'eu-west-1').GetClient() is Client and Pool is GetPool()
+    assert AwsTag('kms', 'eu-central-1').GetClient() is not Client and Pool.GetClientsCount() == Count + 2
+    print('...OK')
+    print('TEST 8: cached tags are kept apart per resolved region and per account of the base credentials', end='')
+    from aws.cache import ConfigureCache
+    ConfigureCache()
+    AwsTag('logs', 'eu-west-1').CacheTags('/app', {'Channel': 'web'}, True)
+    assert AwsTag('logs', 'eu-west-1').GetCachedTags('/app') == {'Channel': 'web'}
+    assert AwsTag('logs', 'eu-central-1').GetCachedTags('/app') is None and AwsTag('logs').GetCachedTags('/app') is None
+    assert AwsTag('logs', 'eu-west-1').GetCacheKey('/app') == ('logs', 'eu-west-1', '@123456789012', '/app')
+    assert AwsTag('logs').GetCacheKey('/app')[1] == 'us-east-1'
+    print('...OK')
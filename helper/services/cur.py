@@ -0,0 +1,359 @@
+"""This module provides streaming access to Cost and Usage Report files and de-duplication of their resources"""
+import csv
+import gzip
+import json
+import os
+import sys
+from operator import itemgetter
+### run as a script, i.e. python3 helper/services/cur.py, the script folder is first on the path and its services.py
+### shadows the services package, so the helper folder takes its place
+if __name__ == '__main__':
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+from aws.arn import IsRegion, IsAccount
+from services.services import GetServices
+
+### pyarrow is only needed for parquet reports
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+### tag values which mean the resource should not get the tag
+UnknownValues = ['unknown', 'none']
+
+
+def IsGzip(FileName):
+    """Return True if file starts with the gzip magic number"""
+
+    with open(FileName, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def OpenCsv(FileName):
+    """Return a text stream of a plain or gzip'd csv file"""
+
+    if IsGzip(FileName):
+        return gzip.open(FileName, 'rt', newline='')
+
+    return open(FileName, 'r', newline='')
+
+def IsParquet(FileName):
+    """Return True if file name is a parquet file, i.e. report-00001.snappy.parquet"""
+
+    return FileName.endswith('.parquet')
+
+def GetCurFiles(FileName):
+    """Return files of a report: the file itself, the files of a folder, or every part listed in a manifest
+
+    Manifest keys are s3 keys, so each part is looked up relative to the manifest's folder
+    first with its full key and then by its file name.
+    """
+
+    if os.path.isdir(FileName):
+        return sorted(os.path.join(FileName, Name) for Name in os.listdir(FileName) \
+                      if IsParquet(Name) or Name.endswith('.csv') or Name.endswith('.csv.gz'))
+
+    if not FileName.endswith('.json'):
+        return [FileName]
+
+    with open(FileName, 'r') as f:
+        Manifest = json.load(f)
+
+    Folder = os.path.dirname(FileName)
+    Files = []
+    for Key in Manifest.get('reportKeys', []):
+        Candidates = [os.path.join(Folder, Key), os.path.join(Folder, os.path.basename(Key))]
+        Found = [Candidate for Candidate in Candidates if os.path.exists(Candidate)]
+        if not Found:
+            raise Exception('Report part ' + Key + ' of ' + FileName + ' not found')
+        Files.append(Found[0])
+
+    return Files
+
+
+class CurReader:
+    """Stream the rows of a csv, csv.gz or manifest of csv.gz parts, keeping only the needed columns
+
+    Rows are read one at a time so multi-GB reports never sit in memory, and each row is
+    cut down to the requested columns as soon as it is parsed. Every part of a manifest
+    has its own header, so columns are located per part.
+    """
+
+    def __init__(self, FileName):
+        """Constructor"""
+
+        self.FileName = FileName
+        self.Files = GetCurFiles(FileName)
+        self.RowsCount = 0
+        self.UnsupportedCount = 0
+        self.UnknownCount = 0
+
+    def GetHeader(self):
+        """Return the header of the first part"""
+
+        with OpenCsv(self.Files[0]) as f:
+            return next(csv.reader(f))
+
+    def ReadRows(self, Columns):
+        """Yield (RowNumber, Values) with Values ordered as Columns; RowNumber counts across parts"""
+
+        for FileName in self.Files:
+            with OpenCsv(FileName) as f:
+                Reader = csv.reader(f)
+                Header = next(Reader, None)
+                if Header is None:
+                    continue
+                Missing = [Column for Column in Columns if Column not in Header]
+                if Missing:
+                    raise Exception('Column ' + ', '.join(Missing) + ' not found in ' + FileName)
+
+                ### itemgetter returns a scalar for one column, so always ask for two or more
+                Project = itemgetter(*[Header.index(Column) for Column in Columns] + [0])
+                for Row in Reader:
+                    self.RowsCount += 1
+                    yield self.RowsCount, Project(Row)[:-1]
+
+    def ReadTagRows(self, TagColumns, RegionColumn=None, AccountColumn=None):
+        """Yield (RowNumber, Service, ResourceId, Tags, Region, Account) for TagColumns as dictionary of AwsTagName
+        to CsvTagName
+
+        Rows of unsupported services and rows whose tags are all Unknown or None are
+        counted and dropped; Unknown or None tags of the remaining rows are left out.
+        Region is the value of RegionColumn if it is a region code and Account the value
+        of AccountColumn if it is an account id, otherwise None.
+        """
+
+        Services = GetServices()
+        AwsTagNames = list(TagColumns)
+        Regions = CheckedValues(IsRegion)
+        Accounts = CheckedValues(IsAccount)
+        Count = len(TagColumns)
+        Columns = list(TagColumns.values()) + ['resource_id', 'service', RegionColumn or 'service',
+                                               AccountColumn or 'service']
+        for RowNumber, Values in self.ReadRows(Columns):
+            Service = Services.get(Values[Count + 1])
+            if Service is None:
+                self.UnsupportedCount += 1
+                continue
+            Tags = {AwsTagName: Value for AwsTagName, Value in zip(AwsTagNames, Values) \
+                    if Value.lower() not in UnknownValues}
+            if not Tags:
+                self.UnknownCount += 1
+                continue
+            yield RowNumber, Service, Values[Count], Tags, Regions[Values[Count + 2]] if RegionColumn else None, \
+                  Accounts[Values[Count + 3]] if AccountColumn else None
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return 'Input: Rows=' + str(self.RowsCount) + ' Files=' + str(len(self.Files)) + ' Unsupported=' \
+               + str(self.UnsupportedCount) + ' Unknown=' + str(self.UnknownCount)
+
+
+class ParquetReader:
+    """Read parquet reports in record batches, filtering and mapping whole columns at once
+
+    Only the tag, resource_id and service columns are loaded. Each batch maps service to
+    its boto3 name, drops rows of unsupported services and rows whose tags are all
+    Unknown, None or null, and blanks out Unknown tags, all as column operations, so
+    per-row Python work is only done for rows which will be tagged.
+    Requires pyarrow.
+    """
+
+    def __init__(self, FileName, BatchSize=65536):
+        """Constructor"""
+
+        if pq is None:
+            raise Exception('Reading parquet requires pyarrow; install it with pip install pyarrow')
+
+        self.FileName = FileName
+        self.Files = GetCurFiles(FileName)
+        self.BatchSize = BatchSize
+        self.RowsCount = 0
+        self.UnsupportedCount = 0
+        self.UnknownCount = 0
+
+    def GetHeader(self):
+        """Return the column names of the first part"""
+
+        return pq.ParquetFile(self.Files[0]).schema_arrow.names
+
+    def ReadTagRows(self, TagColumns, RegionColumn=None, AccountColumn=None):
+        """Yield (RowNumber, Service, ResourceId, Tags, Region, Account) for TagColumns as dictionary of AwsTagName
+        to CsvTagName
+
+        Region is the value of RegionColumn if it is a region code and Account the value
+        of AccountColumn if it is an account id, otherwise None.
+        """
+
+        Services = GetServices()
+        CsvNames = pa.array(list(Services), pa.string())
+        B3Names = pa.array(list(Services.values()), pa.string())
+        Unknown = pa.array(UnknownValues, pa.string())
+        AwsTagNames = list(TagColumns)
+        Regions = CheckedValues(IsRegion)
+        Accounts = CheckedValues(IsAccount)
+        Columns = list(dict.fromkeys(list(TagColumns.values()) + ['resource_id', 'service'] \
+                                     + [Column for Column in (RegionColumn, AccountColumn) if Column]))
+
+        for FileName in self.Files:
+            for Batch in pq.ParquetFile(FileName).iter_batches(batch_size=self.BatchSize, columns=Columns):
+                RowNumbers = pa.array(range(self.RowsCount + 1, self.RowsCount + Batch.num_rows + 1), pa.int64())
+                self.RowsCount += Batch.num_rows
+
+                ### map csv service names to boto3 names; unsupported services become null
+                Service = pc.take(B3Names, pc.index_in(Batch.column('service').cast(pa.string()), value_set=CsvNames))
+                Supported = pc.is_valid(Service)
+                self.UnsupportedCount += Batch.num_rows - pc.sum(Supported.cast(pa.int64())).as_py()
+
+                ### null out Unknown and None tag values, then keep rows with any tag left
+                Tags = []
+                for CsvTagName in TagColumns.values():
+                    Column = Batch.column(CsvTagName).cast(pa.string())
+                    IsUnknown = pc.fill_null(pc.is_in(pc.utf8_lower(Column), value_set=Unknown), True)
+                    Tags.append(pc.if_else(IsUnknown, pa.scalar(None, pa.string()), Column))
+                AnyTag = pc.is_valid(Tags[0])
+                for Column in Tags[1:]:
+                    AnyTag = pc.or_(AnyTag, pc.is_valid(Column))
+                self.UnknownCount += pc.sum(pc.and_(Supported, pc.invert(AnyTag)).cast(pa.int64())).as_py()
+
+                ResourceId = pc.fill_null(Batch.column('resource_id').cast(pa.string()), '')
+                Keep = pc.and_(Supported, AnyTag)
+
+                Region, Account = [Batch.column(Column).cast(pa.string()) if Column else \
+                                   pa.nulls(Batch.num_rows, pa.string()) for Column in (RegionColumn, AccountColumn)]
+                Values = [pc.filter(Column, Keep).to_pylist() for Column in [RowNumbers, Service, ResourceId, Region,
+                                                                              Account] + Tags]
+                for Row in zip(*Values):
+                    yield Row[0], Row[1], Row[2], \
+                          {AwsTagName: Value for AwsTagName, Value in zip(AwsTagNames, Row[5:]) if Value is not None}, \
+                          Regions[Row[3]] if Row[3] else None, Accounts[Row[4]] if Row[4] else None
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return 'Input: Rows=' + str(self.RowsCount) + ' Files=' + str(len(self.Files)) + ' Unsupported=' \
+               + str(self.UnsupportedCount) + ' Unknown=' + str(self.UnknownCount)
+
+
+class CheckedValues(dict):
+    """Dictionary of report value to itself if Check(value) is True, else None, checking each value once
+
+    i.e. region codes of product_region, where global or a location name give None
+    """
+
+    def __init__(self, Check):
+        """Constructor"""
+
+        super().__init__()
+        self.Check = Check
+
+    def __missing__(self, Value):
+        """Check a value seen for the first time"""
+
+        Checked = Value if self.Check(Value) else None
+        self[Value] = Checked
+
+        return Checked
+
+
+def OpenReport(FileName):
+    """Return a ParquetReader for parquet reports, otherwise a CurReader"""
+
+    if any(IsParquet(Name) for Name in GetCurFiles(FileName)):
+        return ParquetReader(FileName)
+
+    return CurReader(FileName)
+
+
+class ResourceCoalescer:
+    """Pass each (service, resource id, region, account) on once and report rows which disagree on a tag value
+
+    A report repeats a resource on every hourly line item, so only its first row is kept;
+    later rows are counted as duplicates and only pass on the tags no earlier row of the
+    resource had, since the reader drops Unknown and empty values row by row. A tag whose
+    value differs from the kept one is recorded as a conflict with every value seen. Rows
+    without a resource id, i.e. tax or support line items, cannot be tagged and are dropped.
+    A name such as a log group in another region or linked account is another resource.
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self.__Seen = {}
+        self.__Conflicts = {}
+        self.Resources = 0
+        self.Duplicates = 0
+        self.NoResource = 0
+
+    def Add(self, Service, ResourceId, Tags, Region=None, Account=None):
+        """Return the tags of the row to process: all of them for the first row of its resource, those no earlier row
+        had for later rows, or an empty dictionary if there is nothing new"""
+
+        if not ResourceId:
+            self.NoResource += 1
+            return {}
+
+        Key = (Service, ResourceId, Region, Account)
+        Kept = self.__Seen.get(Key)
+        if Kept is None:
+            self.__Seen[Key] = dict(Tags)
+            self.Resources += 1
+            return Tags
+
+        self.Duplicates += 1
+        Missing = {}
+        if Tags != Kept:
+            for TagName, TagValue in Tags.items():
+                if TagName not in Kept:
+                    Kept[TagName] = TagValue
+                    Missing[TagName] = TagValue
+                elif Kept[TagName] != TagValue:
+                    Values = self.__Conflicts.setdefault(Key, {}).setdefault(TagName, [Kept[TagName]])
+                    if TagValue not in Values:
+                        Values.append(TagValue)
+
+        return Missing
+
+    def GetConflicts(self):
+        """Return dictionary of (service, resource id, region, account) to dictionary of tag name to values seen,
+        kept value first"""
+
+        return self.__Conflicts
+
+    def GetSummary(self):
+        """Return the summary line"""
+
+        return 'Input: Resources=' + str(self.Resources) + ' Duplicates=' + str(self.Duplicates) + ' Conflicts=' \
+               + str(len(self.__Conflicts)) + ' NoResource=' + str(self.NoResource)
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: keep the first row of a resource', end='')
+    Coalescer = ResourceCoalescer()
+    assert Coalescer.Add('ec2', 'i-1', {'Channel': 'web'}) == {'Channel': 'web'}
+    assert not Coalescer.Add('ec2', 'i-1', {'Channel': 'web'}) and not Coalescer.Add('ec2', '', {'Channel': 'web'})
+    assert Coalescer.Resources == 1 and Coalescer.Duplicates == 1 and Coalescer.NoResource == 1
+    print('...OK')
+    print('TEST 2: report conflicting tag values', end='')
+    Coalescer.Add('ec2', 'i-1', {'Channel': 'app'})
+    assert Coalescer.GetConflicts() == {('ec2', 'i-1', None, None): {'Channel': ['web', 'app']}}
+    print('...OK')
+    print('TEST 3: a later row adds the tags the first row of its resource did not have', end='')
+    assert Coalescer.Add('s3', 'b', {'Channel': 'web'}) == {'Channel': 'web'}
+    assert Coalescer.Add('s3', 'b', {'Channel': 'web', 'Owner': 'ops'}) == {'Owner': 'ops'}
+    assert Coalescer.Add('s3', 'b', {'Owner': 'ops'}) == {} and ('s3', 'b', None, None) not in Coalescer.GetConflicts()
+    print('...OK')
+    print('TEST 4: a name in another region or account is another resource', end='')
+    assert Coalescer.Add('logs', '/app', {'Channel': 'web'}, 'us-east-1', '111111111111')
+    assert Coalescer.Add('logs', '/app', {'Channel': 'web'}, 'us-east-1', '222222222222')
+    assert Coalescer.Add('logs', '/app', {'Channel': 'web'}, 'eu-west-1', '111111111111')
+    assert not Coalescer.Add('logs', '/app', {'Channel': 'web'}, 'eu-west-1', '111111111111')
+    print('...OK')
+    print('TEST 5: only region codes and account ids of the report route calls', end='')
+    Regions = CheckedValues(IsRegion)
+    assert Regions['eu-west-1'] == 'eu-west-1' and Regions['global'] is None
+    assert Regions['US East (N. Virginia)'] is None
+    assert CheckedValues(IsAccount)['123456789012'] == '123456789012' and CheckedValues(IsAccount)['1e11'] is None
+    print('...OK')
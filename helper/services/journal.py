@@ -0,0 +1,174 @@
+"""This module provides an append-only journal of per-row outcomes used to resume interrupted runs"""
+import glob
+import hashlib
+import os
+import threading
+import time
+
+
+### outcomes which mean a row needs no more work
+DoneOutcomes = ('ok', 'skip')
+
+def GetFingerprint(Files, SampleSize=1 << 20):
+    """Return a fingerprint of input files from their names, sizes and first SampleSize bytes"""
+
+    Hash = hashlib.sha1()
+    for FileName in Files:
+        Hash.update(os.path.basename(FileName).encode() + b'\0' + str(os.path.getsize(FileName)).encode() + b'\0')
+        with open(FileName, 'rb') as f:
+            Hash.update(f.read(SampleSize))
+
+    return Hash.hexdigest()[:16]
+
+
+class Journal:
+    """Append one line per finished row, i.e. fingerprint, row, outcome and resource id separated by tabs
+
+    Record() only appends to a buffer under a lock; the buffer is written and fsync'd
+    once SyncEvery lines are pending or SyncInterval seconds have passed, so workers
+    share one fsync per batch and a crash loses at most the last unsynced batch, whose
+    rows are simply redone. Lines of other inputs may share the file; a torn last line
+    is ignored when loading.
+    """
+
+    def __init__(self, FileName, Fingerprint, SyncEvery=1000, SyncInterval=1.0):
+        """Constructor"""
+
+        self.FileName = FileName
+        self.Fingerprint = Fingerprint
+        self.SyncEvery = SyncEvery
+        self.SyncInterval = SyncInterval
+        self.RecordsCount = 0
+        self.SyncCount = 0
+        self.__Pending = []
+        self.__LastSync = time.monotonic()
+        self.__Lock = threading.Lock()
+        self.__WriteLock = threading.Lock()
+        self.__File = None
+
+    def Load(self):
+        """Return set of (row, resource id) of this input whose latest outcome needs no more work"""
+
+        Outcomes = {}
+        if not os.path.exists(self.FileName):
+            return set()
+
+        with open(self.FileName, 'r', newline='', errors='replace') as f:
+            for Line in f:
+                if not Line.endswith('\n'):
+                    continue
+                Fields = Line[:-1].split('\t', 3)
+                if len(Fields) != 4 or Fields[0] != self.Fingerprint or not Fields[1].isdigit():
+                    continue
+                Outcomes[(int(Fields[1]), Fields[3])] = Fields[2]
+
+        return {Key for Key, Outcome in Outcomes.items() if Outcome in DoneOutcomes}
+
+    def GetPartName(self, Number):
+        """Return file name of the journal part of worker process Number, i.e. tagging.journal.1"""
+
+        return self.FileName + '.' + str(Number)
+
+    def Merge(self, FileName):
+        """Append the complete lines of a journal part, then delete the part; return the number of lines"""
+
+        if not os.path.exists(FileName):
+            return 0
+
+        with open(FileName, 'r', newline='', errors='replace') as f:
+            Lines = [Line for Line in f if Line.endswith('\n')]
+        with self.__Lock:
+            self.RecordsCount += len(Lines)
+            self.__Pending.extend(Lines)
+        self.Sync()
+        os.remove(FileName)
+
+        return len(Lines)
+
+    def MergeParts(self):
+        """Merge the parts left by worker processes of an interrupted run; return the number of lines"""
+
+        Parts = [FileName for FileName in glob.glob(glob.escape(self.FileName) + '.*') \
+                 if FileName[len(self.FileName) + 1:].isdigit()]
+
+        return sum(self.Merge(FileName) for FileName in sorted(Parts))
+
+    def Record(self, Row, ResourceId, Outcome):
+        """Queue the outcome of a row, writing the queue if it is due"""
+
+        Line = self.Fingerprint + '\t' + str(Row) + '\t' + Outcome + '\t' + str(ResourceId).replace('\n', ' ') + '\n'
+        with self.__Lock:
+            self.RecordsCount += 1
+            self.__Pending.append(Line)
+            if len(self.__Pending) < self.SyncEvery and time.monotonic() - self.__LastSync < self.SyncInterval:
+                return
+            Lines = self.__Pending
+            self.__Pending = []
+            self.__LastSync = time.monotonic()
+
+        self.__Write(Lines)
+
+    def Sync(self):
+        """Write and fsync every queued line"""
+
+        with self.__Lock:
+            Lines = self.__Pending
+            self.__Pending = []
+            self.__LastSync = time.monotonic()
+
+        self.__Write(Lines)
+
+    def Close(self):
+        """Sync and close the journal file"""
+
+        self.Sync()
+        with self.__WriteLock:
+            if self.__File:
+                self.__File.close()
+                self.__File = None
+
+    def __Write(self, Lines):
+        """Append lines and fsync, one writer at a time"""
+
+        if not Lines:
+            return
+
+        with self.__WriteLock:
+            if self.__File is None:
+                self.__File = open(self.FileName, 'ab')
+                ### end a line torn by a crash so it does not swallow the first new line
+                if self.__File.tell() > 0:
+                    with open(self.FileName, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            self.__File.write(b'\n')
+            self.__File.write(''.join(Lines).encode())
+            self.__File.flush()
+            os.fsync(self.__File.fileno())
+            self.SyncCount += 1
+
+if __name__ == '__main__':
+    import tempfile
+    print('I prefer to be a module; however, I can run some tests')
+    FileName = os.path.join(tempfile.mkdtemp(), 'test.journal')
+    print('TEST 1: latest outcome of this input wins', end='')
+    J = Journal(FileName, 'a', SyncEvery=2)
+    J.Record(1, 'i-1', 'fail')
+    J.Record(2, 'i-2', 'ok')
+    J.Record(1, 'i-1', 'ok')
+    J.Record(3, 'i-3', 'fail')
+    J.Close()
+    assert Journal(FileName, 'a').Load() == {(1, 'i-1'), (2, 'i-2')} and J.SyncCount == 2
+    print('...OK')
+    print('TEST 2: ignore other inputs and torn lines', end='')
+    with open(FileName, 'a') as f:
+        f.write('b\t4\tok\ti-4\na\t5\tok\ti-')
+    assert Journal(FileName, 'b').Load() == {(4, 'i-4')} and (5, 'i-') not in Journal(FileName, 'a').Load()
+    print('...OK')
+    print('TEST 3: parts of worker processes are merged into the journal', end='')
+    Part = Journal(J.GetPartName(1), 'b')
+    Part.Record(6, 'i-6', 'ok')
+    Part.Close()
+    assert Journal(FileName, 'b').MergeParts() == 1 and not os.path.exists(J.GetPartName(1))
+    assert Journal(FileName, 'b').Load() == {(4, 'i-4'), (6, 'i-6')}
+    print('...OK')
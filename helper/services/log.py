@@ -1,31 +1,188 @@
 """This module provides logging abstraction over Python's logging module"""
 
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one json line, i.e. {"time": ..., "level": "INFO", "row": 12, "msg": ...}"""
+
+    def format(self, record):
+        """Return the json line"""
+
+        Line = {'time': self.formatTime(record), 'level': record.levelname}
+        if getattr(record, 'row', None) is not None:
+            Line['row'] = record.row
+        Line['msg'] = record.getMessage()
+
+        return json.dumps(Line)
 
 class Log:
 
-    def __init__(self, Filename=None, Level=None):
+    def __init__(self, Filename=None, Level=None, Async=False, Json=False, MaxBytes=0, BackupCount=5):
         """Constructor"""
 
         self.Level = Level
         self.Filename = Filename
+        self.Async = Async
+        self.Progress = None
+        self.__Lock = threading.Lock()
+        self.__Listener = None
 
-        if self.Level == 'DEBUG':
-            logging.basicConfig(filename=self.Filename, level=logging.DEBUG)
-        elif self.Level == 'INFO':
-            logging.basicConfig(filename=self.Filename, level=logging.INFO)
-        elif self.Level == 'WARNING':
-            logging.basicConfig(filename=self.Filename, level=logging.WARNING)
-        elif self.Level == 'ERROR':
-            logging.basicConfig(filename=self.Filename, level=logging.ERROR)
-        elif self.Level == 'CRITICAL':
-            logging.basicConfig(filename=self.Filename, level=logging.CRITICAL)
+        if self.Level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+            raise Exception('Invalid log level ' + str(self.Level))
+
+        ### both modes write, format and rotate alike
+        if MaxBytes and Filename:
+            Handler = logging.handlers.RotatingFileHandler(Filename, maxBytes=MaxBytes, backupCount=BackupCount)
+        elif Filename:
+            Handler = logging.FileHandler(Filename)
         else:
-            raise Exception('Invalid log level ' + self.Level)
+            Handler = logging.StreamHandler(sys.stderr)
+        Handler.setFormatter(JsonFormatter() if Json else logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+
+        if not self.Async:
+            logging.basicConfig(level=getattr(logging, self.Level), handlers=[Handler])
+            self.Logger = logging.getLogger()
+            return
 
-    def TeeLog(self, msg=None, level=0):
-        """print to console and log"""
+        ### the calling thread only queues the record; a listener thread formats, writes and rotates
+        Queue = queue.SimpleQueue()
+        self.__Listener = logging.handlers.QueueListener(Queue, Handler)
+        self.__Listener.start()
+        self.Logger = logging.getLogger('tagging')
+        self.Logger.setLevel(getattr(logging, self.Level))
+        self.Logger.propagate = False
+        self.Logger.addHandler(logging.handlers.QueueHandler(Queue))
+        atexit.register(self.Close)
+
+    def TeeLog(self, msg=None, level=0, Row=None):
+        """print to console and log; row messages only go to the log while a progress line is shown"""
 
         if msg != None:
-            print(msg)
-            logging.info(msg) if level == 0 else logging.warning(msg)
+            if Row is None or self.Progress is None:
+                with self.__Lock:
+                    if self.Progress:
+                        self.Progress.Clear()
+                    print(msg)
+            if self.Async:
+                self.Logger.log(logging.INFO if level == 0 else logging.WARNING, msg, extra={'row': Row})
+            else:
+                with self.__Lock:
+                    self.Logger.log(logging.INFO if level == 0 else logging.WARNING, msg, extra={'row': Row})
+
+    def ShowProgress(self, GetCounts, Total=None, Interval=1.0):
+        """Replace per-row console lines with a progress line redrawn every Interval seconds"""
+
+        self.Progress = Progress(GetCounts, Total, Interval, self.__Lock)
+        self.Progress.Start()
+
+        return self.Progress
+
+    def Close(self):
+        """Stop the progress line and write every queued record"""
+
+        if self.Progress:
+            self.Progress.Stop()
+            self.Progress = None
+        if self.__Listener:
+            self.__Listener.stop()
+            self.__Listener = None
+
+class Progress:
+    """Progress line of rows/s, ETA and per-status counts, redrawn in place by a background thread
+
+    GetCounts() returns a dictionary whose 'Total' is the number of rows processed so far;
+    the other entries are shown as they are, i.e. Successful, Skip and Failed.
+    """
+
+    def __init__(self, GetCounts, Total=None, Interval=1.0, Lock=None):
+        """Constructor"""
+
+        self.GetCounts = GetCounts
+        self.Total = Total
+        self.Interval = Interval
+        self.__Lock = Lock if Lock else threading.Lock()
+        self.__Stop = threading.Event()
+        self.__Thread = None
+        self.__Started = time.monotonic()
+        self.__Width = 0
+
+    def Start(self):
+        """Start redrawing"""
+
+        self.__Started = time.monotonic()
+        self.__Thread = threading.Thread(target=self.__Run, name='log-progress', daemon=True)
+        self.__Thread.start()
+
+    def Stop(self):
+        """Draw the final line and stop"""
+
+        self.__Stop.set()
+        if self.__Thread:
+            self.__Thread.join()
+        with self.__Lock:
+            self.Draw()
+            print()
+
+    def GetLine(self):
+        """Return the progress line"""
+
+        Counts = self.GetCounts()
+        Done = Counts.get('Total', 0)
+        Elapsed = max(time.monotonic() - self.__Started, 1e-6)
+        Rate = Done / Elapsed
+        Line = 'Rows=' + str(Done) + (('/' + str(self.Total)) if self.Total else '') + ' ' + '%.0f' % Rate + '/s'
+        if self.Total and Rate > 0:
+            Line += ' ETA=' + '%.0f' % max(0, (self.Total - Done) / Rate) + 's'
+        for Name, Count in Counts.items():
+            if Name != 'Total':
+                Line += ' ' + Name + '=' + str(Count)
+
+        return Line
+
+    def Draw(self):
+        """Redraw the line in place; caller holds the console lock"""
+
+        Line = self.GetLine()
+        sys.stdout.write('\r' + Line.ljust(self.__Width))
+        sys.stdout.flush()
+        self.__Width = len(Line)
+
+    def Clear(self):
+        """Blank the line so a message can be printed; caller holds the console lock"""
+
+        if self.__Width:
+            sys.stdout.write('\r' + ' ' * self.__Width + '\r')
+            self.__Width = 0
+
+    def __Run(self):
+        """Redraw until stopped"""
+
+        while not self.__Stop.wait(self.Interval):
+            with self.__Lock:
+                self.Draw()
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    print('I prefer to be a module; however, I can run some tests')
+    Folder = tempfile.mkdtemp()
+    for Async in (False, True):
+        print('TEST ' + str(int(Async) + 1) + ': json lines and rotation with ' + ('async' if Async else 'sync') \
+              + ' logging', end='')
+        Filename = os.path.join(Folder, 'async.log' if Async else 'sync.log')
+        L = Log(Filename, 'INFO', Async=Async, Json=True, MaxBytes=500, BackupCount=2)
+        for Row in range(20):
+            L.Logger.log(logging.INFO, 'Tag #' + str(Row), extra={'row': Row})
+        L.Close()
+        with open(Filename) as File:
+            Line = json.loads(File.readlines()[-1])
+        assert Line['level'] == 'INFO' and Line['row'] == 19 and Line['msg'] == 'Tag #19'
+        assert os.path.exists(Filename + '.2') and not os.path.exists(Filename + '.3')
+        print('...OK')
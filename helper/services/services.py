@@ -1,19 +1,10 @@
 """This module provides access functions to check against services that supports tagging"""
+from aws.registry import GetCsvNames
 
 class Services:
 
-    __Names = {
-                    "AmazonEC2": "ec2", "AmazonS3": "s3", "AmazonVPC": "ec2", "AWSLambda":"lambda", 
-		    "AmazonCloudWatch":"logs", "AmazonRDS":"rds", "AmazonES":"es", "ElasticMapReduce":"emr",
-                    "AmazonDynamoDB":"dynamodb", "AmazonKinesisFirehose":"firehose", "AmazonGlacier":"glacier",
-                    "awskms":"kms", "AmazonApiGateway":"apigateway", "AmazonKinesis":"kinesis",
-		    "AWSCloudTrail":"cloudtrail", "AWSQueueService":"sqs", "AWSSecretsManager": "secretsmanager",
-		    "AmazonCloudFront": "cloudfront", "AmazonEFS": "efs", "AmazonSageMaker": "sagemaker",
-		    "AmazonRedshift": "redshift", "AmazonElastiCache": "elasticache",
-		    "AmazonWorkSpaces": "workspaces", "AWSDirectoryService": "ds", "AmazonDAX": "dax",
-		    "AmazonRoute53": "route53", "AWSDirecttConnect": "directconnect",
-                    "datapipeline": "datapipeline"
-                }
+    ### csv service names come from the registry of services which support tagging
+    __Names = GetCsvNames()
 
     def __init__(self):
         pass
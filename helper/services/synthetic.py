@@ -0,0 +1,192 @@
+"""This module provides synthetic Cost and Usage Reports for benchmarks"""
+import csv
+import gzip
+import itertools
+import os
+import random
+import sys
+### run as a script, i.e. python3 helper/services/synthetic.py, the script folder is first on the path and its
+### services.py shadows the services package, so the helper folder takes its place
+if __name__ == '__main__':
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+from services.services import GetServices
+
+### pyarrow is only needed to write parquet reports
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+### csv service names and their share of the resources of a typical account
+ServiceMix = {'AmazonEC2': 50, 'AmazonS3': 10, 'AWSLambda': 8, 'AmazonCloudWatch': 6, 'AmazonRDS': 5,
+              'AmazonDynamoDB': 5, 'AWSQueueService': 4, 'AmazonKinesis': 2, 'AmazonKinesisFirehose': 2,
+              'AmazonElastiCache': 2, 'awskms': 2, 'AWSSecretsManager': 2, 'AmazonES': 1, 'AmazonRoute53': 1}
+
+### line items without a resource id and of services which cannot be tagged
+UntaggableServices = ['AWSDataTransfer', 'AmazonSNS', 'AWSSupportBusiness', 'AmazonCloudWatchEvents']
+
+
+class SyntheticCur:
+    """Generate report rows with the service mix, duplication and tag quality of real reports
+
+    Each resource repeats on several hourly line items, some resources far more often than
+    others, and carries the same tag values on every row except for a few conflicting ones.
+    A share of the tag values is Unknown and a share of the rows has no resource id or
+    belongs to a service which cannot be tagged. Resources are spread over Regions, which
+    defaults to Region alone, and Accounts, which defaults to Account alone. The same Seed
+    gives the same report, so GetResources() tells a benchmark which resources to expect.
+    """
+
+    ### tag values drawn per resource
+    __Values = ['web', 'mobile', 'api', 'batch', 'data', 'ops', 'ml', 'search']
+
+    def __init__(self, Rows=1000, Resources=None, TagColumns=('tag_channel', 'tag_capability'), Mix=None,
+                 UnknownRate=0.1, ConflictRate=0.001, UntaggableRate=0.05, Region='us-east-1',
+                 Account='123456789012', Seed=0, Regions=None, Accounts=None):
+        """Constructor"""
+
+        self.Rows = Rows
+        self.Resources = Resources if Resources else max(1, Rows // 24)
+        self.TagColumns = list(TagColumns)
+        self.Mix = Mix if Mix else ServiceMix
+        self.UnknownRate = UnknownRate
+        self.ConflictRate = ConflictRate
+        self.UntaggableRate = UntaggableRate
+        self.Region = Region
+        self.Regions = list(Regions) if Regions else [Region]
+        self.Account = Account
+        self.Accounts = list(Accounts) if Accounts else [Account]
+        self.Seed = Seed
+
+    def GetHeader(self):
+        """Return the report columns"""
+
+        return ['identity_line_item_id', 'line_item_usage_start_date', 'service', 'resource_id',
+                'line_item_unblended_cost', 'product_region', 'line_item_usage_account_id'] + self.TagColumns
+
+    def GetResourceId(self, CsvName, Number, Region=None, Account=None):
+        """Return the resource id a report shows for the Number'th resource of a service"""
+
+        Region = Region or self.Region
+        Account = Account or self.Account
+        Prefix = 'arn:aws:{0}:' + Region + ':' + Account + ':'
+        Ids = {
+            'AmazonEC2': lambda: 'i-%017x' % Number,
+            'AmazonS3': lambda: 'bucket-%d' % Number,
+            'AWSLambda': lambda: Prefix.format('lambda') + 'function:fn-%d' % Number,
+            'AmazonCloudWatch': lambda: Prefix.format('logs') + 'log-group:/app/%d' % Number,
+            'AmazonRDS': lambda: Prefix.format('rds') + 'db:db-%d' % Number,
+            'AmazonDynamoDB': lambda: Prefix.format('dynamodb') + 'table/table-%d' % Number,
+            'AWSQueueService': lambda: 'https://sqs.' + Region + '.amazonaws.com/' + Account \
+                                       + '/queue-%d' % Number,
+            'AmazonKinesis': lambda: Prefix.format('kinesis') + 'stream/stream-%d' % Number,
+            'AmazonKinesisFirehose': lambda: Prefix.format('firehose') + 'deliverystream/firehose-%d' % Number,
+            'AmazonElastiCache': lambda: Prefix.format('elasticache') + 'cluster:cache-%d' % Number,
+            'awskms': lambda: Prefix.format('kms') + 'key/%08x-0000-0000-0000-000000000000' % Number,
+            'AWSSecretsManager': lambda: Prefix.format('secretsmanager') + 'secret:secret-%d' % Number,
+            'AmazonES': lambda: Prefix.format('es') + 'domain/search-%d' % Number,
+            'AmazonRoute53': lambda: 'Z%013d' % Number
+        }
+
+        return Ids[CsvName]() if CsvName in Ids else Prefix.format(CsvName.lower()) + 'resource/%d' % Number
+
+    def GetResources(self):
+        """Return list of (CsvServiceName, ResourceId, tag values as dictionary of column to value, Region,
+        Account)"""
+
+        Random = random.Random(self.Seed)
+        Names = list(self.Mix)
+        Weights = [self.Mix[Name] for Name in Names]
+        Resources = []
+        for Number in range(self.Resources):
+            CsvName = Random.choices(Names, Weights)[0]
+            Values = {Column: 'Unknown' if Random.random() < self.UnknownRate \
+                      else Random.choice(SyntheticCur.__Values) for Column in self.TagColumns}
+            ### only draw a region or account for several, so single region reports stay the same for a seed
+            Region = Random.choice(self.Regions) if len(self.Regions) > 1 else self.Region
+            Account = Random.choice(self.Accounts) if len(self.Accounts) > 1 else self.Account
+            Resources.append((CsvName, self.GetResourceId(CsvName, Number, Region, Account), Values, Region, Account))
+
+        return Resources
+
+    def ReadRows(self):
+        """Yield rows as lists ordered as GetHeader()"""
+
+        Resources = [(CsvName, ResourceId, [Values[Column] for Column in self.TagColumns], Region, Account) \
+                     for CsvName, ResourceId, Values, Region, Account in self.GetResources()]
+        Hours = ['2024-09-%02dT%02d:00:00Z' % (1 + Hour // 24, Hour % 24) for Hour in range(720)]
+        NoTags = [''] * len(self.TagColumns)
+        Random = random.Random(self.Seed + 1)
+        for Number in range(self.Rows):
+            Draw = Random.random()
+            if Draw < self.UntaggableRate:
+                yield ['li-%d' % Number, Hours[Number % 720], UntaggableServices[Number % len(UntaggableServices)],
+                       '', '0.01', self.Regions[Number % len(self.Regions)],
+                       self.Accounts[Number % len(self.Accounts)]] + NoTags
+                continue
+            ### squaring skews the draw so a few resources fill many more line items than the rest
+            CsvName, ResourceId, Tags, Region, Account = Resources[int(len(Resources) * Random.random() ** 2)]
+            if Draw < self.UntaggableRate + self.ConflictRate:
+                Tags = [Random.choice(SyntheticCur.__Values)] + Tags[1:]
+            yield ['li-%d' % Number, Hours[Number % 720], CsvName, ResourceId, '%.4f' % (Draw * 10), Region, Account] \
+                  + Tags
+
+    def Write(self, FileName, BatchSize=65536):
+        """Write the report as csv, csv.gz or parquet, chosen by the file name"""
+
+        if FileName.endswith('.parquet'):
+            if pq is None:
+                raise Exception('Writing parquet requires pyarrow; install it with pip install pyarrow')
+            Header = self.GetHeader()
+            Schema = pa.schema([(Column, pa.string()) for Column in Header])
+            Rows = self.ReadRows()
+            with pq.ParquetWriter(FileName, Schema) as Writer:
+                while True:
+                    Batch = list(itertools.islice(Rows, BatchSize))
+                    if not Batch:
+                        return
+                    Writer.write_table(pa.Table.from_arrays([pa.array(Column, pa.string()) for Column in zip(*Batch)],
+                                                            schema=Schema))
+
+        ### gzip's default level 9 costs twice the time of level 6 for a slightly smaller file
+        if FileName.endswith('.gz'):
+            f = gzip.open(FileName, 'wt', newline='', compresslevel=6)
+        else:
+            f = open(FileName, 'w', newline='')
+        with f:
+            Writer = csv.writer(f)
+            Writer.writerow(self.GetHeader())
+            Writer.writerows(self.ReadRows())
+
+
+def WriteSyntheticCur(FileName, Rows=1000, **Options):
+    """Write a synthetic report of Rows line items; Options are those of SyntheticCur"""
+
+    Report = SyntheticCur(Rows, **Options)
+    Report.Write(FileName)
+
+    return Report
+
+if __name__ == '__main__':
+    print('I prefer to be a module; however, I can run some tests')
+    print('TEST 1: every service of the mix can be tagged', end='')
+    assert all(CsvName in GetServices() for CsvName in ServiceMix)
+    assert not any(CsvName in GetServices() for CsvName in UntaggableServices)
+    print('...OK')
+    print('TEST 2: the same seed gives the same report with repeated resources', end='')
+    Rows = list(SyntheticCur(480).ReadRows())
+    assert Rows == list(SyntheticCur(480).ReadRows()) and len(Rows) == 480
+    assert len(set(Row[3] for Row in Rows if Row[3])) <= 20
+    print('...OK')
+    print('TEST 3: resources of several regions carry their region', end='')
+    Report = SyntheticCur(480, Regions=['us-east-1', 'eu-west-1'])
+    Resources = Report.GetResources()
+    assert set(Resource[3] for Resource in Resources) == {'us-east-1', 'eu-west-1'}
+    assert all(Resource[3] in Resource[1] for Resource in Resources if Resource[1].startswith('arn:'))
+    print('...OK')
+    print('TEST 4: resources of several accounts carry their account', end='')
+    Resources = SyntheticCur(480, Accounts=['111111111111', '222222222222']).GetResources()
+    assert set(Resource[4] for Resource in Resources) == {'111111111111', '222222222222'}
+    assert all(Resource[4] in Resource[1] for Resource in Resources if Resource[1].startswith('arn:'))
+    print('...OK')
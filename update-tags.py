@@ -1,10 +1,23 @@
-import csv, sys, argparse
+import sys, argparse
 from sys import path
 path.append('helper')
 path.append('C:/Users/cdang/Python/python3.5/packages')
-from aws.tag import UpdateTag, IsTagExists
-from ta.log import Log
-from ta.services import GetB3ServiceName
+from aws.client import ConfigurePool
+from aws.batch import Ec2TagBatcher, S3TagMerger, TagReadBatcher
+from aws.bulk import BulkTagger
+from aws.prefetch import TagIndex
+from aws.runner import TagRunner
+from aws.shard import ShardedRunner
+from aws.ratelimit import ConfigureLimiters
+from aws.cache import ConfigureCache
+from aws.account import ConfigureAccounts
+from aws.metrics import ConfigureMetrics
+from aws.plan import TagPlanner, PlanReader
+from aws.rekey import TagKeyMigrator, ParseKeyChanges
+from aws.discover import ResourceDiscoverer
+from services.log import Log
+from services.cur import OpenReport, ResourceCoalescer
+from services.journal import Journal, GetFingerprint
 
 #################################################
 #                                               #
@@ -22,7 +35,29 @@ Overwrite = False
 #                                               #
 #################################################
 
+def ParseTagColumns(Values, Header=None):
+    """Return dictionary of AwsTagName to CsvTagName from values formatted as AwsTag=CsvTag, plus
+    every tag_* column of Header when it is given, i.e. tag_cost_center as CostCenter"""
 
+    TagColumns = {}
+    for Column in Header or []:
+        if Column.startswith('tag_') and len(Column) > 4:
+            TagColumns[''.join(Part.capitalize() for Part in Column[4:].split('_'))] = Column
+    for Value in Values:
+        AwsTagName, CsvTagName = Value.split('=')
+        TagColumns[AwsTagName] = CsvTagName
+
+    return TagColumns
+
+def ParseServiceValues(Values):
+    """Return dictionary of service to number from values formatted as service=N, i.e. route53=1"""
+
+    ServiceValues = {}
+    for Value in Values:
+        Service, Number = Value.split('=')
+        ServiceValues[Service] = int(Number)
+
+    return ServiceValues
 
 #################################################
 #                                               #
@@ -42,112 +77,379 @@ if __name__ == '__main__':
 
     ### check command line arguments: --tag AwsTagName=CsvTagName
     parser = argparse.ArgumentParser()
-    parser.add_argument('--tag', nargs=1, required=True, help='key/value pair of tag formatted as AwsTag=CsvTag, \
-                        i.e. Channel=tag_channel or Capability=tag_capability')
-    args = [i[1] for i in vars(parser.parse_args()).items()] #[[Channel=tag_channel]]
-    tag = args[0][0] #Channel=tag_channel
-    ### exit if tag value does not contain =
-    if tag.find('=') != -1:
-        AwsTagName, CsvTagName = tag.split('=')
-    else:
+    parser.add_argument('mode', nargs='?', choices=['run', 'plan', 'apply', 'rekey', 'discover'], default='run', \
+                        help='run checks and updates tags row by row; plan writes only the tags which differ from \
+                        the live ones to the --plan file with the expected API calls; apply writes exactly the tags \
+                        of the --plan file; rekey renames or removes tag keys on every resource carrying them, found \
+                        by tag scans of each --region and --account instead of a report; discover lists the \
+                        resources of each --region and --account into the --output report, with the current \
+                        values of the --tag columns')
+    parser.add_argument('--plan', default='tagging.plan', help='plan file written by plan and read by apply; \
+                        default is tagging.plan')
+    parser.add_argument('--tag', action='append', default=[], help='key/value pair of tag formatted as \
+                        AwsTag=CsvTag, i.e. Channel=tag_channel or Capability=tag_capability; can be repeated to \
+                        write several tags per resource in one call')
+    parser.add_argument('--rename', action='append', default=[], help='tag key renamed by rekey formatted as \
+                        Old=New, i.e. channel=Channel; the value moves to the new key, which keeps its own value if \
+                        it exists; can be repeated')
+    parser.add_argument('--remove', action='append', default=[], help='tag key removed by rekey; can be repeated')
+    parser.add_argument('--dry-run', action='store_true', help='log what rekey would change without changing it')
+    parser.add_argument('--output', default='inventory.csv.gz', help='csv or csv.gz report written by discover, \
+                        which run reads with --input; default is inventory.csv.gz')
+    parser.add_argument('--service', action='append', default=[], help='service listed by discover, i.e. ec2 or \
+                        s3; can be repeated; default is every supported service')
+    parser.add_argument('--auto-tags', action='store_true', help='also write every tag_* column, i.e. \
+                        tag_channel as Channel and tag_cost_center as CostCenter')
+    parser.add_argument('--input', default=CsvFileName, help='csv, csv.gz or parquet report, a folder of \
+                        report parts, or a report manifest .json whose parts are next to it; default is ' + CsvFileName)
+    parser.add_argument('--no-dedup', action='store_true', help='process every row instead of only the first \
+                        row of each service and resource id')
+    parser.add_argument('--journal', default='tagging.journal', help='file the outcome of every row is \
+                        appended to; default is tagging.journal')
+    parser.add_argument('--no-journal', action='store_true', help='do not record row outcomes')
+    parser.add_argument('--resume', action='store_true', help='skip rows of the same input which the journal \
+                        records as updated or skipped by an earlier run')
+    parser.add_argument('--cache', default='tagging.cache', help='SQLite file caching resource tags across \
+                        runs; default is tagging.cache')
+    parser.add_argument('--no-cache', action='store_true', help='always ask AWS for existing tags')
+    parser.add_argument('--cache-ttl', type=int, default=86400, help='seconds cached tags are trusted; default \
+                        is 86400')
+    parser.add_argument('--service-cache-ttl', action='append', default=[], help='seconds cached tags of a \
+                        service are trusted formatted as service=N, i.e. ec2=3600; can be repeated')
+    parser.add_argument('--verbose', action='store_true', help='print every row instead of a progress line')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='format of ' + LogFileName \
+                        + ' records; json writes one object per line with time, level, row and msg')
+    parser.add_argument('--log-max-bytes', type=int, default=100 * 1024 * 1024, help='rotate ' + LogFileName \
+                        + ' when it reaches this size, keeping 5 old files; 0 never rotates')
+    parser.add_argument('--sync-log', action='store_true', help='write log records from the calling thread')
+    parser.add_argument('--metrics', default='tagging.metrics.json', help='json report of calls, outcomes, \
+                        retries, throttles and latency percentiles per service, region and operation; default is \
+                        tagging.metrics.json')
+    parser.add_argument('--metrics-prom', default='tagging.prom', help='Prometheus textfile of the same metrics, \
+                        i.e. for the node_exporter textfile collector; default is tagging.prom')
+    parser.add_argument('--metrics-interval', type=float, default=60.0, help='seconds between metrics exports \
+                        during the run; 0 only exports at the end')
+    parser.add_argument('--no-metrics', action='store_true', help='do not record per-call metrics')
+    parser.add_argument('--max-connections', type=int, default=50, help='size of the HTTP connection pool \
+                        of each shared AWS client')
+    parser.add_argument('--no-keepalive', action='store_true', help='disable TCP keep-alive on AWS connections')
+    parser.add_argument('--ec2-batch-size', type=int, default=1000, help='number of ec2 resource ids sent per \
+                        create_tags call, up to 1000; 0 updates ec2 one row at a time')
+    parser.add_argument('--backend', choices=['service', 'tagging-api'], default='service', help='write tags \
+                        with the per-service methods, or send rows whose resource_id is an ARN to the Resource \
+                        Groups Tagging API in batches of 20')
+    parser.add_argument('--no-prefetch', action='store_true', help='check whether each tag exists with one AWS \
+                        call per row instead of indexing existing tags up front')
+    parser.add_argument('--no-s3-merge', action='store_true', help='read and write s3 tags once per row \
+                        instead of once per bucket')
+    parser.add_argument('--no-read-batch', action='store_true', help='check existing tags of ec2, cloudtrail, \
+                        directconnect and datapipeline resources with one call per row instead of many ids per call')
+    parser.add_argument('--workers', type=int, default=1, help='number of rows checked and updated concurrently \
+                        in each account and region; they run in parallel with budgets of their own')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes rows are \
+                        partitioned over by resource id, each with its own clients and 1/N of the rates, for \
+                        inputs too large for one process; plan always runs in one process')
+    parser.add_argument('--region-column', default='product_region', help='report column whose region code \
+                        routes rows which are not ARNs or queue URLs; other rows use their own region and \
+                        global services their home region; default is product_region, ignored if missing')
+    parser.add_argument('--assume-role', nargs='?', const='OrganizationAccountAccessRole', help='tag resources \
+                        of linked accounts through this role, assumed once per account and refreshed before it \
+                        expires; the account comes from the ARN or queue URL, else the account column; default \
+                        role is OrganizationAccountAccessRole')
+    parser.add_argument('--account-column', default='line_item_usage_account_id', help='report column whose \
+                        account id is used for rows which are not ARNs or queue URLs; default is \
+                        line_item_usage_account_id, ignored if missing')
+    parser.add_argument('--external-id', help='external id required by the role of --assume-role')
+    parser.add_argument('--role-duration', type=int, default=3600, help='seconds each assumed role session lasts \
+                        before it is refreshed; default is 3600')
+    parser.add_argument('--region', action='append', default=[], help='region whose existing tags are \
+                        prefetched, or scanned by rekey and discover; can be repeated, i.e. --region us-east-1 \
+                        --region eu-west-1, or all for every enabled region with discover; default is the region of \
+                        the AWS configuration')
+    parser.add_argument('--account', action='append', default=[], help='linked account scanned by rekey and \
+                        discover through the role of --assume-role; can be repeated; default is the account of the \
+                        credentials')
+    parser.add_argument('--service-workers', action='append', default=[], help='concurrency cap of a service \
+                        formatted as service=N, i.e. route53=1; can be repeated')
+    parser.add_argument('--rate', type=float, default=10.0, help='initial calls per second for each service \
+                        and region; adapts to throttling')
+    parser.add_argument('--no-rate-limit', action='store_true', help='call AWS as fast as workers allow')
+    Args = parser.parse_args()
+    ### exit if no tag is given or a tag value does not contain =
+    if Args.mode in ('run', 'plan') and not Args.tag and not Args.auto_tags or \
+       [tag for tag in Args.tag if tag.count('=') != 1]:
         print('Value for --tag is incorrect. Check valid options using --help.')
         sys.exit()
+    ### exit if rekey has nothing to rename or remove
+    Changes = None
+    if Args.mode == 'rekey':
+        try:
+            Changes = ParseKeyChanges(Args.rename, Args.remove)
+        except Exception as e:
+            print('Value for --rename or --remove is incorrect: ' + str(e))
+            sys.exit()
+    ### linked accounts are scanned through the role of --assume-role
+    if Args.account and not Args.assume_role:
+        print('--account requires --assume-role')
+        sys.exit()
+
+    ### share AWS clients and their connections across all rows
+    ConfigurePool(MaxPoolConnections=Args.max_connections, TcpKeepAlive=not Args.no_keepalive)
+
+    ### pace calls per service and region, slowing down when throttled
+    Limiters = None if Args.no_rate_limit else ConfigureLimiters(Rate=Args.rate)
 
-    ### initialize local variable
-    TagPropIndex = {CsvTagName: None, 'resource_id': None, 'service': None}
+    ### time every AWS call per service, region and operation, exporting periodically and at the end
+    Metrics = None if Args.no_metrics else ConfigureMetrics(Args.metrics, Args.metrics_prom, Args.metrics_interval, \
+                                                            Limiters)
 
     ### initialize logging: Level can be INFO or DEBUG
-    L = Log(Filename='tagging.log', Level='INFO')
+    L = Log(Filename=LogFileName, Level='INFO', Async=not Args.sync_log, Json=Args.log_format == 'json', \
+            MaxBytes=Args.log_max_bytes)
 
     ### print starting divider
     L.TeeLog('----------------------------------------------------------')
 
-    ### open csv file
+    ### remember tags read and written, in memory and across runs
+    Cache = None
+    if not Args.no_cache:
+        try:
+            Cache = ConfigureCache(Args.cache, Args.cache_ttl, ParseServiceValues(Args.service_cache_ttl))
+        except Exception as e:
+            L.TeeLog('Failed to open cache, continuing without it: ' + str(e), 1)
+        if Cache:
+            Cache.Purge()
+
+    ### resources of linked accounts are tagged through a role assumed once per account
+    Accounts = None
+    if Args.assume_role:
+        try:
+            Accounts = ConfigureAccounts(Args.assume_role, Duration=Args.role_duration, ExternalId=Args.external_id)
+            L.TeeLog('Accounts: Base=' + Accounts.GetHomeAccount() + ' Role=' + Args.assume_role)
+        except Exception as e:
+            L.TeeLog('Failed to get the account of the base credentials: ' + str(e))
+            sys.exit()
+
+    ### open csv, csv.gz or parquet file, folder or manifest of parts; apply reads the plan instead, rekey and
+    ### discover nothing
     try:
-        reader = open(CsvFileName, 'r')
-        CsvReader = csv.reader(reader)
+        Reader = None if Args.mode in ('rekey', 'discover') else PlanReader(Args.plan) if Args.mode == 'apply' \
+                 else OpenReport(Args.input)
     except Exception as e:
-        L.TeeLog("Failed to open file:", e)
+        L.TeeLog('Failed to open file: ' + str(e))
         sys.exit()
 
-    ### get tag properties index in first row
+    ### a plan already holds only the tags to write, so apply neither checks existing tags nor skips any
+    if Args.mode == 'apply':
+        Overwrite = True
+
+    ### get tag columns from first row; a plan names the tags of each resource itself
+    TagColumns = None
+    RegionColumn = None
+    AccountColumn = None
     try:
-        for row in CsvReader:
-            for K in TagPropIndex.keys():
-                TagPropIndex[K] = row.index(K)
-            break
+        if Args.mode in ('run', 'plan'):
+            Header = Reader.GetHeader()
+            TagColumns = ParseTagColumns(Args.tag, Header if Args.auto_tags else None)
+            RegionColumn = Args.region_column if Args.region_column in Header else None
+            AccountColumn = Args.account_column if Accounts and Args.account_column in Header else None
+            Missing = [K for K in list(TagColumns.values()) + ['resource_id', 'service'] if K not in Header]
+            if Missing:
+                raise Exception(', '.join(Missing) + ' not in header')
+            if not TagColumns:
+                raise Exception('no tag_* columns')
     except Exception as e:
-        L.TeeLog('Failed to get index:', e)
+        L.TeeLog('Failed to get index: ' + str(e))
         sys.exit()
 
-    ### counters
-    RowCounter = 0
-    UpdateSucceedCounter = 0
-    UpdateFailedCounter = 0
-    UpdateSkipCounter = 0
+    ### record row outcomes keyed by input fingerprint; on resume skip rows already done
+    Done = set()
+    RunJournal = None
+    if Args.mode in ('run', 'apply') and (not Args.no_journal or Args.resume):
+        try:
+            RunJournal = Journal(Args.journal, GetFingerprint(Reader.Files))
+            ### journal parts of worker processes are left behind if an earlier --processes run was interrupted
+            RunJournal.MergeParts()
+            if Args.resume:
+                Done = RunJournal.Load()
+                L.TeeLog('Resuming: ' + str(len(Done)) + ' rows done by earlier runs')
+        except Exception as e:
+            L.TeeLog('Failed to open journal: ' + str(e))
+            sys.exit()
+
+    ### ec2 rows with identical tag key/value are written together
+    Batcher = Ec2TagBatcher(Args.ec2_batch_size) if Args.ec2_batch_size > 0 else None
+
+    ### rows with ARNs of any service are written together through the tagging api
+    Bulk = BulkTagger() if Args.backend == 'tagging-api' else None
+
+    ### index existing tags with a few paginated scans instead of one call per row
+    Index = None
+    if (not Overwrite or Args.mode == 'plan') and not Args.no_prefetch and Args.mode in ('run', 'plan', 'apply'):
+        try:
+            Index = TagIndex()
+            for Region in Args.region or [None]:
+                Index.PrefetchTaggingApi(list(TagColumns), Region)
+                Index.PrefetchEc2(list(TagColumns), Region)
+            L.TeeLog('Prefetched ' + str(Index.GetResourcesCount()) + ' tagged resources in ' \
+                     + str(Index.CallsCount) + ' calls')
+        except Exception as e:
+            L.TeeLog('Prefetch failed, checking tags per row: ' + str(e), 1)
+            Index = None
+
+    ### s3 rows of the same bucket are merged into one read and one write
+    Merger = None if Args.no_s3_merge else S3TagMerger(Overwrite)
+
+    ### existing tags of services reading many ids per call are read for many rows at once
+    ReadBatcher = None if Args.no_read_batch or Overwrite else TagReadBatcher()
 
-    ### continue to process csv file
+    ### process rows sequentially or on per-service thread pools, in this process or in worker processes
     try:
-        TagIdx = TagPropIndex[CsvTagName]
-        ResourceIdx = TagPropIndex['resource_id']
-        ServiceIdx = TagPropIndex['service']
-
-        ### each row in csv
-        for row in CsvReader:
-            TagName = AwsTagName
-            TagValue = row[TagIdx]
-            ResourceId = row[ResourceIdx]
-            Service = GetB3ServiceName(row[ServiceIdx])
-
-            RowCounter += 1
-
-            L.TeeLog('Tag #' + str(RowCounter) + ': ResourceId=' + str(ResourceId) + ' TagName='\
-	                + str(TagName) + ' TagValue=' + str(TagValue) + ' Service=' + str(Service))
-
-            ### skip if tag value is Unknown or None
-            if TagValue.lower() == 'unknown' or TagValue.lower() == 'none':
-                L.TeeLog('Skip update since tag equals None or Unknown')
-                UpdateSkipCounter += 1
-                continue
+        if Args.mode == 'rekey':
+            if Args.processes > 1:
+                L.TeeLog('Processes: rekey runs in one process, ignoring --processes', 1)
+            Runner = TagKeyMigrator(L, Changes, Overwrite, Args.workers, Bulk is not None, Args.ec2_batch_size, \
+                                    ServiceWorkers=ParseServiceValues(Args.service_workers), DryRun=Args.dry_run)
+        elif Args.mode == 'discover':
+            if Args.processes > 1:
+                L.TeeLog('Processes: discover runs in one process, ignoring --processes', 1)
+            Runner = ResourceDiscoverer(L, Args.output, ParseTagColumns(Args.tag), Args.service, Args.workers)
+        elif Args.processes > 1 and Args.mode != 'plan':
+            Runner = ShardedRunner(L, Args.processes, {'Overwrite': Overwrite, 'Workers': Args.workers, \
+                'ServiceWorkers': ParseServiceValues(Args.service_workers), 'Ec2BatchSize': Args.ec2_batch_size, \
+                'Bulk': Bulk is not None, 'S3Merge': Merger is not None, 'ReadBatch': ReadBatcher is not None, \
+                'MaxConnections': Args.max_connections, \
+                'TcpKeepAlive': not Args.no_keepalive, 'Rate': None if Args.no_rate_limit else Args.rate, \
+                'Metrics': (Args.metrics, Args.metrics_prom, Args.metrics_interval) if Metrics else None, \
+                'Cache': (Args.cache, Args.cache_ttl, ParseServiceValues(Args.service_cache_ttl)) if Cache else None, \
+                'AssumeRole': (Args.assume_role, Args.role_duration, Args.external_id) if Accounts else None}, \
+                Index, RunJournal)
+            L.TeeLog('Processes: ' + str(Args.processes) + ' sharded by resource id')
+        else:
+            if Args.processes > 1:
+                L.TeeLog('Processes: plan runs in one process, ignoring --processes', 1)
+            Runner = TagRunner(L, Overwrite, Args.workers, ParseServiceValues(Args.service_workers), Index, \
+                               Batcher, Bulk, Merger, RunJournal, ReadBatcher)
+    except Exception as e:
+        L.TeeLog('Value for ' + ('--service' if Args.mode == 'discover' else '--service-workers') + ' is incorrect: ' \
+                 + str(e))
+        sys.exit()
 
-            ### skip s3 until issue resolved where tag update cleared all other tags
-            #if Service == 's3':
-            #    L.TeeLog('Skip service ' + Service + ' until issue resolved where tag update cleared all other tags')
-            #    UpdateSkipCounter += 1
-            #    continue
+    ### plan writes the differences to the plan file instead of updating tags
+    Planner = None
+    if Args.mode == 'plan':
+        try:
+            Planner = TagPlanner(Args.plan, Overwrite, Index, Args.ec2_batch_size, not Args.no_s3_merge, \
+                                 Args.backend == 'tagging-api', {'input': Args.input, \
+                                 'fingerprint': GetFingerprint(Reader.Files)})
+        except Exception as e:
+            L.TeeLog('Failed to open plan file: ' + str(e))
+            sys.exit()
 
-            ### skip if Overwrite is False and tag already exists
-            try:
-                if not Overwrite and IsTagExists(Service, ResourceId, TagName):
-                    L.TeeLog('Skip update for ' + ResourceId + ' since tag ' + TagName + ' exists and Overwrite is ' \
-                             + str(Overwrite))
-                    UpdateSkipCounter += 1
+    ### show rows/s and counts on one console line instead of a line per row
+    if not Args.verbose:
+        L.ShowProgress(Planner.GetCounts if Planner else Runner.GetCounts, \
+                       Reader.GetResourcesCount() if Args.mode == 'apply' else None)
+
+    ### each resource repeats on every hourly line item, so only its first row is processed
+    Coalescer = None if Args.no_dedup or Args.mode in ('apply', 'rekey', 'discover') else ResourceCoalescer()
+
+    ### continue to process csv file, reading only the tag, resource_id and service columns; rows of
+    ### unsupported services and rows whose tags are all Unknown or None are dropped by the reader
+    Resumed = 0
+    try:
+        ### rekey and discover find their resources by scanning instead of reading rows
+        if Args.mode in ('rekey', 'discover'):
+            Runner.Run(Args.region, Args.account)
+        Rows = Reader.ReadTagRows(TagColumns, RegionColumn, AccountColumn) if Reader else []
+        for RowCounter, Service, ResourceId, Tags, Region, Account in Rows:
+            ### later rows of a resource only write the tags its earlier rows lacked
+            if Coalescer:
+                Tags = Coalescer.Add(Service, ResourceId, Tags, Region, Account)
+                if not Tags:
                     continue
-            except Exception as e:
-                L.TeeLog('Skip update since we cannot verify whether tag name ' + TagName + ' exists: ' + str(e), 1)
-                UpdateSkipCounter += 1
+            if (RowCounter, ResourceId) in Done:
+                Resumed += 1
                 continue
+            if Planner:
+                try:
+                    Planner.Add(RowCounter, Service, ResourceId, Tags, Region, Account)
+                except Exception as e:
+                    L.TeeLog('Tag #' + str(RowCounter) + ': Not planned since we cannot read tags of ' \
+                             + ResourceId + ': ' + str(e), 1)
+                continue
+            Runner.Submit(RowCounter, Service, ResourceId, Tags, Region, Account)
 
-            ### update tag
-            try:
-                if UpdateTag(Service, ResourceId, TagName, TagValue):
-                    L.TeeLog('Successfully updated resourceid=' + ResourceId)
-                    UpdateSucceedCounter += 1
-                else:
-                    L.TeeLog('Failed to update resourceid=' + ResourceId)
-                    UpdateFailedCounter += 1
-            except Exception as e:
-                L.TeeLog('Failed to update resourceid=' + ResourceId + ': ' + str(e))
-                UpdateFailedCounter += 1
+        ### wait for workers and update remaining queued ARNs and ec2 tags
+        if Planner:
+            Planner.Close()
+        elif Args.mode not in ('rekey', 'discover'):
+            Runner.Finish()
     except Exception as e:
-        L.TeeLog('Error processing csv file:', e)
+        L.TeeLog('Error processing ' + ('resources' if Args.mode in ('rekey', 'discover') else 'csv file') + ': ' \
+                 + str(e))
     finally:
-        reader.close()
+        ### keep outcomes recorded so far even on Ctrl-C
+        if RunJournal:
+            RunJournal.Close()
+        if Cache:
+            Cache.Close()
+        if Metrics:
+            try:
+                Metrics.Stop()
+            except Exception as e:
+                L.TeeLog('Failed to write metrics: ' + str(e), 1)
+        if L.Progress:
+            L.Progress.Stop()
+            L.Progress = None
+
+    ### report resources whose rows disagree on a tag value; the first row's value was used
+    if Coalescer:
+        for (Service, ResourceId, Region, Account), Conflicts in Coalescer.GetConflicts().items():
+            for TagName, Values in Conflicts.items():
+                L.TeeLog('Conflict: Service=' + str(Service) + ' ResourceId=' + ResourceId \
+                         + (' Region=' + Region if Region else '') + (' Account=' + Account if Account else '') \
+                         + ' Tag=' + TagName \
+                         + ' Values=' + ', '.join(str(Value) for Value in Values) + ' Used=' + str(Values[0]), 1)
 
     ### print summary
-    L.TeeLog('Summary: Total=' + str(RowCounter) + ' Successful=' + str(UpdateSucceedCounter) + ' Skip=' + \
-            str(UpdateSkipCounter) + ' Failed=' + str(UpdateFailedCounter))
+    if Reader:
+        L.TeeLog(Reader.GetSummary())
+    if Coalescer:
+        L.TeeLog(Coalescer.GetSummary())
+    if Args.resume:
+        L.TeeLog('Resumed: ' + str(Resumed) + ' rows skipped as done by earlier runs')
+    if Planner:
+        L.TeeLog('Plan: File=' + Args.plan + ' Resources=' + str(Planner.Resources) + ' Unchanged=' \
+                 + str(Planner.Unchanged) + ' Unverified=' + str(Planner.Unverified))
+        ### services run concurrently, so the slowest service and region bounds the runtime
+        Seconds = 0
+        for (Service, Region), Calls in sorted(Planner.GetCalls().items()):
+            Rate = Limiters.Rates.get(Service, (Limiters.Rate, Limiters.MaxRate))[0] if Limiters else None
+            Seconds = max(Seconds, Calls / Rate if Rate else 0)
+            L.TeeLog('Plan: Service=' + Service + ' Region=' + Region + ' Calls=' + str(Calls) \
+                     + (' Seconds=' + '%.0f' % (Calls / Rate) if Rate else ''))
+        if Limiters:
+            L.TeeLog('Plan: EstimatedSeconds=' + '%.0f' % Seconds + ' at the initial rate of each service')
+    else:
+        L.TeeLog(Runner.GetSummary())
+    if Cache:
+        L.TeeLog('Cache: Hits=' + str(Cache.Hits) + ' Misses=' + str(Cache.Misses))
+    if Accounts:
+        L.TeeLog('Accounts: Assumed=' + str(Accounts.GetAccountsCount()) + ' AssumeCalls=' \
+                 + str(Accounts.AssumeCount))
+    if Limiters:
+        for (Service, Region), (Rate, SafeRate, Calls, Throttles, Wait) in sorted(Limiters.GetRates().items(), \
+                                                                                  key=lambda x: str(x[0])):
+            L.TeeLog('Rate: Service=' + Service + ' Region=' + str(Region) + ' Calls=' + str(Calls) \
+                     + ' Throttles=' + str(Throttles) + ' SafeRate=' + '%.1f' % SafeRate + '/s' \
+                     + ' Waited=' + '%.1f' % Wait + 's')
+    if Metrics:
+        for Line in Metrics.GetSummary():
+            L.TeeLog(Line)
+    L.Close()
 
-else:
+### worker processes started with spawn import this file as __mp_main__
+elif __name__ != '__mp_main__':
     L.TeeLog('I\'m not a module.')
     sys.exit()